@@ -0,0 +1,229 @@
+"""
+Batch Image Processing
+
+Runs the same pipeline of transforms on a whole directory (or glob) of PNG files, several files at
+a time in a pool of worker processes, and reports how long each stage took. For example
+
+    python batch.py input/ --pipeline blur:15,edges --output output/
+
+blurs every PNG in input/, runs the sobel edge detector on the result and writes the edges to
+output/ under the same file name (files from different directories keep their path relative to
+the directory they're all in, so they can't overwrite each other). A file that can't be read or
+processed is reported and skipped, and the exit status is 1 if any file failed.
+
+Each file goes through stream.py, so decoding, the transforms and encoding are interleaved a strip
+of rows at a time: a worker never holds a whole decoded image, and the PNG file is read and
+written while the transforms run, instead of before and after them.
+
+The pipeline is a comma separated list of stages that work on a stack of images (the file starts
+out as the only image on the stack):
+
+    brighten:FACTOR           brighten the top image
+    contrast:FACTOR[:MID]     adjust the contrast of the top image (MID defaults to 0.5)
+    blur:KERNEL_SIZE          blur the top image
+    sobel_x, sobel_y          replace the top image by its horizontal or vertical edges
+    sobel                     replace the top image by both its sobel_x and sobel_y edges
+    edges                     replace the top image by its edges (the same as sobel,combine, in one pass)
+    combine                   combine the top two images into one (see transform.combine_images)
+
+and the pipeline has to end with exactly one image on the stack.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import stream
+
+sobel_x = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+sobel_y = np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]])
+
+# stage name: (number of images it takes off the stack, number of arguments it takes)
+stages = {
+    'brighten': (1, (1, 1)),
+    'contrast': (1, (1, 2)),
+    'blur': (1, (1, 1)),
+    'sobel_x': (1, (0, 0)),
+    'sobel_y': (1, (0, 0)),
+    'sobel': (1, (0, 0)),
+    'edges': (1, (0, 0)),
+    'combine': (2, (0, 0)),
+}
+
+
+def parse_pipeline(spec):
+    # 'blur:15,sobel,combine' -> [('blur', [15.0]), ('sobel', []), ('combine', [])]
+    # raises ValueError if the pipeline doesn't make sense
+    pipeline = []
+    depth = 1
+    for text in spec.split(','):
+        name, *args = text.strip().split(':')
+        if name not in stages:
+            raise ValueError('unknown stage %r (known stages: %s)' % (name, ', '.join(sorted(stages))))
+        inputs, (least, most) = stages[name]
+        if not least <= len(args) <= most:
+            raise ValueError('stage %r takes %d to %d arguments, not %d' % (name, least, most, len(args)))
+        try:
+            args = [float(arg) for arg in args]
+        except ValueError:
+            raise ValueError('bad argument for stage %r: %r' % (name, text))
+        if name == 'blur' and (args[0] != int(args[0]) or args[0] < 1):
+            raise ValueError('blur needs a whole, positive kernel size, not %r' % text)
+        if depth < inputs:
+            raise ValueError('stage %r needs %d images, but there are only %d' % (name, inputs, depth))
+        depth += {'sobel': 1, 'combine': -1}.get(name, 0)
+        pipeline.append((name, args))
+    if depth != 1:
+        raise ValueError('the pipeline ends with %d images instead of 1 (missing a combine?)' % depth)
+    return pipeline
+
+
+def build(source, pipeline):
+    # returns the stream for the pipeline's result, and a list of (stage name, stream) to time each stage
+    stack = [source]
+    timed = [('decode', source)]
+    for name, args in pipeline:
+        if name == 'brighten':
+            results = [stream.brighten(stack.pop(), args[0])]
+        elif name == 'contrast':
+            results = [stream.adjust_contrast(stack.pop(), args[0], args[1] if len(args) > 1 else 0.5)]
+        elif name == 'blur':
+            results = [stream.blur(stack.pop(), int(args[0]))]
+        elif name == 'sobel_x':
+            results = [stream.apply_kernel(stack.pop(), sobel_x)]
+        elif name == 'sobel_y':
+            results = [stream.apply_kernel(stack.pop(), sobel_y)]
+        elif name == 'sobel':
+            top = stack.pop()
+            results = [stream.apply_kernel(top, sobel_x), stream.apply_kernel(top, sobel_y)]
+        elif name == 'edges':
+            results = [stream.sobel_magnitude(stack.pop())]
+        elif name == 'combine':
+            second, first = stack.pop(), stack.pop()
+            results = [stream.combine_images(first, second)]
+        stack.extend(results)
+        for result in results:
+            timed.append((name, result))
+    return stack[0], timed
+
+
+def process(input_file, output_dir, pipeline, gamma=2.2, strip_size=64, output_name=None):
+    # runs in a worker process: returns the seconds spent in each stage, in pipeline order
+    # output_name is where the result goes in output_dir (by default, the input's file name)
+    started = time.perf_counter()
+    if output_name is None:
+        output_name = os.path.basename(input_file)
+    os.makedirs(os.path.join(output_dir, os.path.dirname(output_name)), exist_ok=True)
+    source = stream.open_image(input_file, gamma=gamma, input_path='')
+    result, timed = build(source, pipeline)
+    try:
+        result.write_image(output_name, gamma=gamma, strip_size=strip_size, output_path=os.path.join(output_dir, ''))
+    except BaseException:
+        # don't leave half a file behind
+        if os.path.exists(os.path.join(output_dir, output_name)):
+            os.remove(os.path.join(output_dir, output_name))
+        raise
+    seconds = {}
+    for name, timed_stream in timed:
+        seconds[name] = seconds.get(name, 0.0) + timed_stream.seconds
+    # whatever time isn't spent decoding or transforming is spent encoding and writing the file
+    seconds['encode'] = time.perf_counter() - started - sum(seconds.values())
+    return seconds
+
+
+def find_files(pattern):
+    # a directory means all the PNG files in it
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.png')
+    return sorted(glob.glob(pattern))
+
+
+def output_names(files):
+    # where each file's result goes in the output directory: its path relative to the directory all the files are in
+    # (just the file name, if they're all in the same one), so that files with the same name don't overwrite each other
+    if not files:
+        return []
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(input_file)) for input_file in files])
+    return [os.path.relpath(os.path.abspath(input_file), base) for input_file in files]
+
+
+def run(files, output_dir, pipeline, workers=None, max_in_flight=None, gamma=2.2, strip_size=64, report=print):
+    # processes all the files, returns the total seconds spent in each stage (over all the workers), and a list of
+    # (file, error) for the files that failed (they're reported and skipped, and the rest carry on)
+    # at most max_in_flight files (by default, two per worker) are submitted at a time, so that a huge batch
+    # doesn't queue up a task for every file at once
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    os.makedirs(output_dir, exist_ok=True)
+    totals = {}
+    failed = []
+    started = time.perf_counter()
+    done_count = 0
+    files = list(files)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        jobs = zip(files, output_names(files))
+        while True:
+            for input_file, output_name in jobs:
+                future = executor.submit(process, input_file, output_dir, pipeline, gamma, strip_size, output_name)
+                pending[future] = input_file
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                input_file = pending.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    failed.append((input_file, e))
+                    report('%s: failed: %s: %s' % (input_file, type(e).__name__, e))
+                    continue
+                for name, value in seconds.items():
+                    totals[name] = totals.get(name, 0.0) + value
+                done_count += 1
+                elapsed = time.perf_counter() - started
+                report('%s: %.3fs (%d done, %.2f images/sec)' % (
+                    input_file, sum(seconds.values()), done_count, done_count / elapsed))
+    elapsed = time.perf_counter() - started
+    report('%d images in %.2fs, %.2f images/sec' % (done_count, elapsed, done_count / elapsed if elapsed else 0.0))
+    if failed:
+        report('%d images failed' % len(failed))
+    busy = sum(totals.values())
+    for name, value in totals.items():
+        report('  %-10s %8.3fs  %5.1f%%' % (name, value, 100 * value / busy if busy else 0.0))
+    return totals, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a pipeline of transforms on a batch of PNG files.')
+    parser.add_argument('input', help='a directory of PNG files, or a glob pattern like "input/*.png"')
+    parser.add_argument('--pipeline', required=True, help='comma separated stages, eg blur:15,sobel,combine')
+    parser.add_argument('--output', default='output/', help='directory to write the results to (default output/)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='most files submitted to the workers at once (default: two per worker)')
+    parser.add_argument('--gamma', type=float, default=2.2)
+    parser.add_argument('--strip-size', type=int, default=64, help='rows processed at a time in each file')
+    args = parser.parse_args(argv)
+    try:
+        pipeline = parse_pipeline(args.pipeline)
+    except ValueError as e:
+        parser.error(str(e))
+    files = find_files(args.input)
+    if not files:
+        parser.error('no files match %r' % args.input)
+    totals, failed = run(files, args.output, pipeline, workers=args.workers, max_in_flight=args.max_in_flight,
+                         gamma=args.gamma, strip_size=args.strip_size)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+Benchmarks
+
+Times importing the modules, PNG decoding (png.Reader) and encoding (png.Writer), every transform,
+resizing and the histogram statistics, on synthetic images generated here (so the numbers don't
+depend on what's in input/), and saves the results as JSON so runs can be compared over time:
+
+    python benchmark.py --output before.json
+    ... make some changes ...
+    python benchmark.py --output after.json --compare before.json
+
+Each benchmark is run `repeat` times and we keep the best and the median time per call; the best
+time is the least noisy measure of how fast the code can go, and is what --compare uses.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import histogram
+import numpy as np
+import png
+import resize
+import transform
+from image import Image
+
+
+def synthetic_pixels(height, width, planes, bitdepth, seed=0):
+    # smooth gradients plus some noise, so that the PNG filters and zlib have something realistic to do
+    # (pure noise doesn't compress at all, and flat images compress far too well)
+    random = np.random.RandomState(seed)
+    top = 2**bitdepth - 1
+    y, x = np.mgrid[0:height, 0:width]
+    gradient = (x / max(1, width - 1) + y / max(1, height - 1)) / 2
+    pixels = gradient[:, :, None] * np.linspace(0.6, 1, planes) * top
+    pixels = pixels + random.normal(0, top / 50, (height, width, planes))
+    return np.clip(np.rint(pixels), 0, top).astype(np.uint16 if bitdepth > 8 else np.uint8)
+
+
+def encode(pixels, bitdepth, interlace=False, compression=None, filter_type=0):
+    height, width, planes = pixels.shape
+    writer = png.Writer(width, height, bitdepth=bitdepth, alpha=planes == 4, interlace=interlace,
+                        compression=compression, filter_type=filter_type)
+    out = io.BytesIO()
+    writer.write_ndarray(out, pixels)
+    return out.getvalue()
+
+
+def synthetic_image(size, seed=0):
+    im = Image(x_pixels=size, y_pixels=size, num_channels=3)
+    im.array = synthetic_pixels(size, size, 3, 8, seed) / 255.0
+    return im
+
+
+def benchmarks(quick=False):
+    # yields (name, function to time) for every benchmark
+    size = 256 if quick else 1024
+    # decoding
+    for bitdepth in (8, 16):
+        for planes, color in ((3, 'rgb'), (4, 'rgba')):
+            for interlace in (False, True):
+                data = encode(synthetic_pixels(size, size, planes, bitdepth), bitdepth, interlace=interlace)
+                name = 'decode/%s%d%s' % (color, bitdepth, '/interlaced' if interlace else '')
+                yield name, lambda data=data: png.Reader(bytes=data).asarray()
+    # encoding
+    pixels = synthetic_pixels(size, size, 3, 8)
+    for compression in (1, 6, 9):
+        for filter_type in (0, 'adaptive'):
+            name = 'encode/rgb8/level%d/filter-%s' % (compression, filter_type)
+            yield name, lambda compression=compression, filter_type=filter_type: encode(
+                pixels, 8, compression=compression, filter_type=filter_type)
+    # transforms
+    sizes = (64, 256) if quick else (64, 256, 1024)
+    for size in sizes:
+        im = synthetic_image(size, seed=1)
+        other = synthetic_image(size, seed=2)
+        yield 'transform/brighten/%d' % size, lambda im=im: transform.brighten(im, 1.5)
+        yield 'transform/adjust_contrast/%d' % size, lambda im=im: transform.adjust_contrast(im, 2, 0.5)
+        yield 'transform/combine_images/%d' % size, lambda im=im, other=other: transform.combine_images(im, other)
+        for kernel_size in (3, 9, 15):
+            yield 'transform/blur/%d/k%d' % (size, kernel_size), lambda im=im, k=kernel_size: transform.blur(im, k)
+            kernel = np.random.RandomState(kernel_size).uniform(-1, 1, (kernel_size, kernel_size))
+            yield 'transform/apply_kernel/%d/k%d' % (size, kernel_size), lambda im=im, kernel=kernel: transform.apply_kernel(im, kernel)
+        for sigma in (1, 5, 25):
+            yield 'transform/gaussian_blur/%d/s%d' % (size, sigma), lambda im=im, sigma=sigma: transform.gaussian_blur(im, sigma)
+        yield 'transform/gaussian_pyramid/%d' % size, lambda im=im: transform.gaussian_pyramid(im, 5)
+        yield 'image/level/%d' % size, lambda im=im: (im.pixels_changed(), im.level(4))
+        for filter in resize.filters:
+            yield 'resize/%s/%d/half' % (filter, size), lambda im=im, filter=filter: resize.resize(
+                im, size // 2, size // 2, filter)
+            yield 'resize/%s/%d/double' % (filter, size), lambda im=im, filter=filter: resize.resize(
+                im, size * 2, size * 2, filter)
+        yield 'resize/thumbnail/%d' % size, lambda im=im: resize.thumbnail(im, 64)
+        im8 = Image(x_pixels=size, y_pixels=size, num_channels=3, dtype=np.uint8)
+        im8.array = synthetic_pixels(size, size, 3, 8, seed=3)
+        for name, test_im in (('float', im), ('uint8', im8)):
+            yield 'histogram/statistics/%s/%d' % (name, size), lambda im=test_im: (im.pixels_changed(), histogram.compute(im))
+            yield 'histogram/auto_contrast/%s/%d' % (name, size), lambda im=test_im: histogram.auto_contrast(im)
+            yield 'histogram/equalize/%s/%d' % (name, size), lambda im=test_im: histogram.equalize(im)
+        sobel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+        yield 'transform/apply_kernel/%d/sobel' % size, lambda im=im: transform.apply_kernel(im, sobel)
+        yield 'transform/sobel_three_passes/%d' % size, lambda im=im: transform.combine_images(
+            transform.apply_kernel(im, sobel), transform.apply_kernel(im, sobel.T))
+        yield 'transform/sobel_magnitude/%d' % size, lambda im=im: transform.sobel_magnitude(im)
+        yield 'transform/sobel_magnitude/%d/uint8' % size, lambda im=im: transform.sobel_magnitude(im, np.uint8)
+
+
+def measure(function, repeat=5):
+    # returns (best, median) seconds per call, and the number of calls per timing
+    timer = timeit.Timer(function)
+    number, seconds = timer.autorange()  # enough calls to take at least 0.2 seconds
+    times = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    return times[0], times[len(times) // 2], number
+
+
+def measure_import(module, repeat=5):
+    # returns (best, median) seconds to import module in a fresh Python process, like measure
+    # (the time is taken inside the new process, so starting Python itself isn't counted)
+    code = 'import time; started = time.perf_counter(); import %s; print(time.perf_counter() - started)' % module
+    times = sorted(float(subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__))))
+                   for _ in range(repeat))
+    return times[0], times[len(times) // 2], 1
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(quick=False, select=None, repeat=5, report=print):
+    results = {}
+    for module in ('png', 'image'):
+        name = 'import/%s' % module
+        if select and select not in name:
+            continue
+        best, median, number = measure_import(module, repeat=repeat)
+        results[name] = {'best': best, 'median': median, 'number': number, 'repeat': repeat}
+        report('%-45s %10.3f ms  (median %.3f ms)' % (name, best * 1000, median * 1000))
+    for name, function in benchmarks(quick):
+        if select and select not in name:
+            continue
+        best, median, number = measure(function, repeat=repeat)
+        results[name] = {'best': best, 'median': median, 'number': number, 'repeat': repeat}
+        report('%-45s %10.3f ms  (median %.3f ms)' % (name, best * 1000, median * 1000))
+    return {
+        'machine': {'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+                    'processor': platform.processor()},
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'quick': quick,
+        'results': results,
+    }
+
+
+def compare(old, new, threshold=1.1, report=print):
+    # prints the change for each benchmark in both runs, returns the names of the ones that got slower by threshold
+    slower = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        ratio = result['best'] / old['results'][name]['best']
+        flag = ''
+        if ratio > threshold:
+            flag = '  SLOWER'
+            slower.append(name)
+        elif ratio < 1 / threshold:
+            flag = '  faster'
+        report('%-45s %6.2fx%s' % (name, ratio, flag))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark PNG decoding, encoding and the transforms.')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='a JSON file from an earlier run to compare against')
+    parser.add_argument('--quick', action='store_true', help='smaller images, for a fast check')
+    parser.add_argument('--select', help='only run benchmarks whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+    results = run(quick=args.quick, select=args.select, repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, results):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Result Cache
+
+Keeps the results of decoding PNG files and of the transform.py functions on disk, so running the
+same filters on the same images again just reads the old results back. Results are looked up by a
+hash of everything that went into them (the pixel values of the input images, or the bytes of the
+PNG file, plus the function name and its parameters), so a cached result is never used for an
+input that changed, and two files with the same contents share their results.
+
+Results are stored as .npy files, which are read back with np.load(mmap_mode='c'): nothing is
+decoded or even read until the pixels are used, and pages that are never touched never leave the
+disk. When the cache gets bigger than max_bytes, the least recently used results are deleted. The
+size is kept as a running total, so only going over max_bytes costs a scan of the directory.
+
+Nothing is cached until enable() is called:
+
+    import cache
+    cache.enable('cache/', max_bytes=2**30)
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+# the Cache used by Image.read_image and the transform.py functions, or None if caching is off
+active = None
+
+
+def enable(directory='cache/', max_bytes=2**30):
+    global active
+    active = Cache(directory, max_bytes)
+    return active
+
+def disable():
+    global active
+    active = None
+
+
+def feed(hasher, part):
+    # adds part to the hash, in a way that two different parts never add the same bytes
+    if hasattr(part, 'array'):
+        # an Image is just its pixels
+        part = part.array
+    if isinstance(part, np.ndarray):
+        hasher.update(b'array %s %r ' % (part.dtype.str.encode(), part.shape))
+        hasher.update(np.ascontiguousarray(part).data)
+    elif isinstance(part, (bytes, bytearray, memoryview)):
+        hasher.update(b'bytes %d ' % len(part))
+        hasher.update(part)
+    elif isinstance(part, (list, tuple)):
+        hasher.update(b'list %d ' % len(part))
+        for item in part:
+            feed(hasher, item)
+    elif isinstance(part, dict):
+        hasher.update(b'dict %d ' % len(part))
+        for name in sorted(part):
+            feed(hasher, name)
+            feed(hasher, part[name])
+    else:
+        # numbers, strings, dtypes, None
+        text = ('%s %r' % (type(part).__name__, part)).encode()
+        hasher.update(b'value %d ' % len(text))
+        hasher.update(text)
+
+
+class Cache:
+    def __init__(self, directory='cache/', max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # how many bytes the cache holds, counted once here and then kept up to date by put and evict
+        # (other processes using the same directory aren't counted until the next evict scans it)
+        self.total = self.size()
+
+    def key(self, *parts):
+        # the name for a result computed from parts
+        hasher = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            feed(hasher, part)
+        return hasher.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        # the cached array, memory mapped (copy on write, so changing it doesn't change the file), or None
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode='c')
+            # mark it as recently used
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return np.asarray(array)
+
+    def put(self, key, array):
+        if array.nbytes > self.max_bytes:
+            return
+        # write to a temporary file first, so that nobody ever reads half a result
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+                size = f.tell()
+            try:
+                # a result we already had is replaced, so it doesn't count twice
+                self.total -= os.stat(self.path(key)).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.total += size
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        # (last used time, size, path) for every cached result, oldest first
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # somebody else just evicted it
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for used, size, path in self.entries())
+
+    def evict(self):
+        # delete the least recently used results until the cache fits in max_bytes
+        entries = self.entries()
+        total = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
@@ -0,0 +1,189 @@
+"""
+Histograms and Image Statistics
+
+Per channel histograms and summary numbers (minimum, maximum, mean, percentiles) for an image, and two
+transforms built on them that pick their own settings:
+
+    auto_contrast   stretches the values so that the darkest and brightest ones (ignoring a small
+                    cutoff percentage at each end) become black and full intensity, instead of
+                    guessing a factor and mid for transform.adjust_contrast
+    equalize        spreads the values out so that every brightness is about equally common
+
+Everything comes from a Statistics object, which is filled in a single pass over the pixels, a strip
+of rows at a time (Statistics.add), so it works on the strips of a stream.py ImageStream as well as on
+a whole Image. The histogram counts the values with np.bincount, after quantizing them to bins: one bin
+per value for uint8 and uint16 images (so those are exact), and 4096 bins between 0 and 1 for floating
+point images. Percentiles are read off the histogram. NaN and infinite values (which floating point
+images can have, eg after dividing by 0) are left out of everything.
+
+The statistics of an Image are kept on it (until its pixels change), so asking again is free, and
+auto_contrast and equalize on integer images are just one table lookup per pixel after that.
+"""
+
+import numpy as np
+from image import Image, max_value, to_dtype
+
+# how many histogram bins floating point images get (integer images get one per value)
+float_bins = 4096
+
+
+class Statistics:
+    def __init__(self, num_channels, dtype=np.float64, bins=None):
+        self.num_channels = num_channels
+        self.dtype = np.dtype(dtype)
+        self.top = max_value(self.dtype)
+        # integer images have one bin per value, unless they ask for fewer
+        self.exact = self.dtype.kind != 'f' and bins in (None, self.top + 1)
+        if bins is None:
+            bins = self.top + 1 if self.dtype.kind != 'f' else float_bins
+        self.bins = bins
+        # the value each bin stands for (what percentile returns): the value itself, or the middle of the bin
+        if self.exact:
+            self.values = np.arange(bins, dtype=np.float64)
+        else:
+            self.values = (np.arange(bins) + 0.5) * (self.top / bins)
+        self.histogram = np.zeros((num_channels, bins), dtype=np.int64)
+        self.count = np.zeros(num_channels, dtype=np.int64)
+        self.total = np.zeros(num_channels)
+        self.minimum = np.full(num_channels, np.inf)
+        self.maximum = np.full(num_channels, -np.inf)
+
+    def bin(self, values):
+        # the bin of each value (values outside 0..max_value go in the first or last bin; the values should be finite)
+        if self.exact:
+            return values.astype(np.intp)
+        scaled = values * (self.bins / self.top)
+        return np.clip(scaled, 0, self.bins - 1).astype(np.intp)
+
+    def add(self, array):
+        # counts some more pixels: a (rows, y_pixels, num_channels) array, like a strip of an image
+        values = array.reshape(-1, self.num_channels)
+        if len(values) == 0:
+            return self
+        finite = None
+        if values.dtype.kind == 'f':
+            finite = np.isfinite(values)
+            if finite.all():
+                finite = None
+        if finite is None:
+            self.count += len(values)
+            self.total += values.sum(axis=0, dtype=np.float64)
+            self.minimum = np.minimum(self.minimum, values.min(axis=0))
+            self.maximum = np.maximum(self.maximum, values.max(axis=0))
+        else:
+            # NaN and infinity have no bin (converting NaN to a bin number gives any number at all), so we leave them out
+            self.count += finite.sum(axis=0)
+            self.total += np.where(finite, values, 0).sum(axis=0, dtype=np.float64)
+            self.minimum = np.minimum(self.minimum, np.where(finite, values, np.inf).min(axis=0))
+            self.maximum = np.maximum(self.maximum, np.where(finite, values, -np.inf).max(axis=0))
+            values = np.where(finite, values, 0)
+        # one bincount for all the channels, with each channel's bins after the ones before it
+        bins = self.bin(values)
+        bins += np.arange(self.num_channels) * self.bins
+        bins = bins.ravel() if finite is None else bins[finite]
+        counts = np.bincount(bins, minlength=self.num_channels * self.bins)
+        self.histogram += counts.reshape(self.num_channels, self.bins)
+        return self
+
+    def mean(self):
+        return self.total / self.count
+
+    def percentile(self, q, channels='each'):
+        # the value that q percent of the pixels are at or below, for each channel
+        # (or one value for all the channels together, with channels='all')
+        histogram = self.histogram if channels == 'each' else self.histogram.sum(axis=0, keepdims=True)
+        minimum = self.minimum if channels == 'each' else self.minimum.min(keepdims=True)
+        maximum = self.maximum if channels == 'each' else self.maximum.max(keepdims=True)
+        cumulative = np.cumsum(histogram, axis=1)
+        wanted = q / 100 * cumulative[:, -1]
+        index = np.array([np.searchsorted(row, target) for row, target in zip(cumulative, wanted)])
+        index = np.minimum(index, self.bins - 1)
+        # the bin's value, but never past the smallest and biggest values actually seen
+        return np.clip(self.values[index], minimum, maximum)
+
+    def cdf(self):
+        # for each channel and bin, the fraction of the pixels in that bin or below
+        cumulative = np.cumsum(self.histogram, axis=1)
+        return cumulative / np.maximum(cumulative[:, -1:], 1)
+
+
+def compute(image, bins=None):
+    # the Statistics of an Image, computed once and then kept on the image until its pixels change
+    # (see Image.pixels_changed)
+    statistics = image.statistics
+    if (statistics is None or image.statistics_source is not image.array or
+            (bins is not None and statistics.bins != bins)):
+        statistics = Statistics(image.array.shape[2], image.array.dtype, bins).add(image.array)
+        image.statistics = statistics
+        image.statistics_source = image.array
+    return statistics
+
+def stream_statistics(image_stream, strip_size=64, bins=None):
+    # the Statistics of a stream.py ImageStream, computed a strip at a time (this reads the whole stream, so to
+    # then process the image, open it again)
+    statistics = Statistics(image_stream.num_channels, image_stream.dtype, bins)
+    for strip in image_stream.strips(strip_size):
+        statistics.add(strip)
+    return statistics
+
+
+def apply_table(image, table):
+    # looks every pixel of an integer image up in table (one row per channel, or a single row for all of them)
+    new_im = Image(x_pixels=image.array.shape[0], y_pixels=image.array.shape[1], num_channels=image.array.shape[2],
+                   dtype=image.array.dtype)
+    if len(table) == 1:
+        new_im.array = table[0][image.array]
+    else:
+        new_im.array = table[np.arange(len(table)), image.array]
+    return new_im
+
+def auto_contrast(image, cutoff=0.5, per_channel=False, statistics=None):
+    # stretches the values so that the cutoff percent darkest become 0 and the cutoff percent brightest become
+    # max_value (for integer images, they're clipped there; floating point images can go past 0 and 1)
+    # per_channel stretches each channel by itself, which also fixes color casts but changes the colors; by default
+    # all the channels are stretched the same way
+    # statistics are the image's by default; pass others (like the whole image's, for a strip of it) to use those
+    if statistics is None:
+        statistics = compute(image)
+    channels = 'each' if per_channel else 'all'
+    low = statistics.percentile(cutoff, channels)
+    high = statistics.percentile(100 - cutoff, channels)
+    top = max_value(image.array.dtype)
+    # a channel that's all one value is just moved, not stretched
+    scale = top / np.where(high > low, high - low, top)
+    if image.array.dtype.kind == 'f':
+        new_im = Image(x_pixels=image.array.shape[0], y_pixels=image.array.shape[1],
+                       num_channels=image.array.shape[2], dtype=image.array.dtype)
+        new_im.array = to_dtype((image.array - low) * scale, image.array.dtype)
+        return new_im
+    table = to_dtype((np.arange(top + 1) - low[:, None]) * scale[:, None], image.array.dtype)
+    return apply_table(image, table)
+
+def equalize(image, statistics=None):
+    # maps each channel's values through its cumulative histogram, so that every brightness is about equally common
+    # statistics are the image's by default, like for auto_contrast
+    if statistics is None:
+        statistics = compute(image)
+    top = max_value(image.array.dtype)
+    cdf = statistics.cdf()
+    # the classic formula: the smallest value present becomes 0, the biggest becomes max_value
+    first = np.take_along_axis(cdf, (statistics.histogram > 0).argmax(axis=1)[:, None], axis=1)
+    mapped = np.clip((cdf - first) / np.maximum(1 - first, 1e-12), 0, 1) * top
+    if statistics.exact:
+        return apply_table(image, to_dtype(mapped, image.array.dtype))
+    # in between bins, we go smoothly from one bin's value to the next
+    new_im = Image(x_pixels=image.array.shape[0], y_pixels=image.array.shape[1], num_channels=image.array.shape[2],
+                   dtype=image.array.dtype)
+    result = np.empty(image.array.shape)
+    for c in range(image.array.shape[2]):
+        result[:, :, c] = np.interp(image.array[:, :, c], statistics.values, mapped[c])
+    new_im.array = to_dtype(result, image.array.dtype)
+    return new_im
+
+
+if __name__ == '__main__':
+    lake = Image(filename='lake.png')
+    statistics = compute(lake)
+    print('mean', statistics.mean(), 'median', statistics.percentile(50))
+    auto_contrast(lake).write_image('lake_auto_contrast.png')
+    equalize(lake).write_image('lake_equalized.png')
@@ -10,49 +10,189 @@ Github: https://www.github.com/kying18
 Programmer Beast Mode Spotify playlist: https://open.spotify.com/playlist/4Akns5EUb3gzmlXIdsJkPs?si=qGc4ubKRRYmPHAJAIrCxVQ 
 """
 
+from functools import lru_cache
+
 import numpy as np
+import cache
 import png
 
+def max_value(dtype):
+    # the value that means "full intensity" for an image stored as dtype: 1 for floating point
+    # images (values between 0 and 1), and the largest possible value for integer images (eg 255 for
+    # uint8), which store the same linear values scaled up to that range
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return 1.0
+    return np.iinfo(dtype).max
+
+def compute_dtype(dtype):
+    # the floating point type to do arithmetic in for images stored as dtype
+    # float64 images keep float64, everything else uses float32 (which is exact enough even for uint16)
+    if np.dtype(dtype) == np.float64:
+        return np.float64
+    return np.float32
+
+def to_dtype(values, dtype):
+    # convert computed values back to an image dtype
+    # integer images can't hold fractions or values outside 0..max_value, so those are rounded and clipped
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return values.astype(dtype, copy=False)
+    return np.clip(np.rint(values), 0, max_value(dtype)).astype(dtype)
+
+@lru_cache(maxsize=None)
+def decode_table(bitdepth, gamma, dtype):
+    # the linear value (stored as dtype) for every possible PNG sample value at this bitdepth
+    # there are only 256 (or 65536 for 16 bit images) of them, so it's much cheaper to compute the
+    # power once per sample value than once per pixel, and then just look the pixels up
+    source_max = 2**bitdepth - 1
+    values = np.arange(source_max + 1) * (1.0 / source_max)
+    values = values ** gamma
+    if np.dtype(dtype).kind == 'f':
+        # the same math as doing it per pixel, so we get exactly the same values
+        return values.astype(dtype)
+    return np.rint(values * max_value(dtype)).astype(dtype)
+
+@lru_cache(maxsize=None)
+def encode_table(gamma, dtype):
+    # the gamma encoded 8 bit sample for every possible value of an integer image
+    top = max_value(dtype)
+    return (255*((np.arange(top + 1) / top)**(1/gamma))).astype(np.uint8)
+
+def decode_pixels(pixels, bitdepth, gamma=2.2, dtype=np.float64):
+    # PNG samples (integers between 0 and 2**bitdepth - 1) -> linear image values stored as dtype
+    return decode_table(bitdepth, gamma, np.dtype(dtype))[pixels]
+
+def encode_pixels(array, gamma=2.2):
+    # linear image values -> gamma encoded 8 bit PNG samples
+    dtype = array.dtype
+    if dtype.kind == 'f':
+        # floating point values can be anything, so there's no table to look them up in
+        # (numpy's vectorized power is about as fast as rounding the values to a table index anyway)
+        im = np.clip(array, 0, 1)
+        return (255*(im**(1/gamma))).astype(np.uint8)
+    return encode_table(gamma, dtype)[array]
+
+def png_writer(x_pixels, y_pixels, num_channels, filter_type=0):
+    # a png.Writer for an image with x_pixels rows, y_pixels columns and num_channels channels, which are the same as
+    # what png.Reader.asarray gives: 1 is grey, 2 is grey and alpha, 3 is RGB and 4 is RGB and alpha
+    if num_channels not in (1, 2, 3, 4):
+        raise ValueError('PNG images have 1 to 4 channels, not %d' % num_channels)
+    return png.Writer(y_pixels, x_pixels, greyscale=num_channels < 3, alpha=num_channels in (2, 4),
+                      filter_type=filter_type)
+
+def half_size(array):
+    # shrinks a floating point array to half its height and width: each new pixel is the average of a 2x2 square of
+    # old ones (an odd row or column at the end is averaged with a copy of itself)
+    if array.shape[0] % 2:
+        array = np.concatenate((array, array[-1:]), axis=0)
+    if array.shape[1] % 2:
+        array = np.concatenate((array, array[:, -1:]), axis=1)
+    total = array[0::2, 0::2] + array[1::2, 0::2]
+    total += array[0::2, 1::2]
+    total += array[1::2, 1::2]
+    total *= 0.25
+    return total
+
 class Image:
-    def __init__(self, x_pixels=0, y_pixels=0, num_channels=0, filename=''):
+    # the smaller copies of the image made by level: pyramid[n] is level n, and pyramid_source is the array they were
+    # made from (so that we notice when self.array is replaced)
+    pyramid = None
+    pyramid_source = None
+    # the histogram and other numbers about the pixels (see histogram.py), and the array they were computed from
+    statistics = None
+    statistics_source = None
+
+    def __init__(self, x_pixels=0, y_pixels=0, num_channels=0, filename='', dtype=np.float64):
         # you need to input either filename OR x_pixels, y_pixels, and num_channels
+        # dtype is how the pixel values are stored: float64 (the default) or float32 hold values between
+        # 0 and 1; uint8 or uint16 hold the same values scaled to 0..255 or 0..65535 (see max_value)
         self.input_path = 'input/'
         self.output_path = 'output/'
         if x_pixels and y_pixels and num_channels:
             self.x_pixels = x_pixels
             self.y_pixels = y_pixels
             self.num_channels = num_channels
-            self.array = np.zeros((x_pixels, y_pixels, num_channels))
+            self.array = np.zeros((x_pixels, y_pixels, num_channels), dtype=dtype)
         elif filename:
-            self.array = self.read_image(filename)
+            self.array = self.read_image(filename, dtype=dtype)
             self.x_pixels, self.y_pixels, self.num_channels = self.array.shape
         else:
             raise ValueError("You need to input either a filename OR specify the dimensions of the image")
 
-    def read_image(self, filename, gamma=2.2):
+    def read_image(self, filename, gamma=2.2, dtype=np.float64):
         '''
-        read PNG RGB image, return 3D numpy array organized along Y, X, channel
-        values are float, gamma is decoded
+        read PNG image, return 3D numpy array organized along Y, X, channel
+        the channels are the file's own: 1 for grey, 2 for grey and alpha, 3 for RGB and 4 for RGB and alpha
+        values are stored as dtype (see decode_pixels), gamma is decoded
+        if the result cache is on (see cache.py), files we've decoded before are read from there instead
         '''
-        im = png.Reader(self.input_path + filename).asFloat()
-        resized_image = np.vstack(list(im[2]))
-        resized_image.resize(im[1], im[0], 3)
-        resized_image = resized_image ** gamma
-        return resized_image
+        if cache.active is None:
+            width, height, pixels, meta = png.Reader(self.input_path + filename).asarray()
+            return decode_pixels(pixels, meta['bitdepth'], gamma, dtype)
+        with open(self.input_path + filename, 'rb') as f:
+            data = f.read()
+        key = cache.active.key('read_image', data, gamma, np.dtype(dtype))
+        array = cache.active.get(key)
+        if array is None:
+            width, height, pixels, meta = png.Reader(bytes=data).asarray()
+            array = decode_pixels(pixels, meta['bitdepth'], gamma, dtype)
+            cache.active.put(key, array)
+        return array
 
-    def write_image(self, output_file_name, gamma=2.2):
+    def level(self, n):
+        '''
+        the image shrunk to half its size n times (level 0 is the image itself), as a new Image of the same dtype
+        levels are only made when they're first asked for, each from the one above it, and then kept, so asking again
+        (or for a preview, see write_preview) costs nothing; the transforms work on levels like on any other Image,
+        eg transform.blur(im.level(2), 3) blurs a quarter size copy
+        if you change self.array in place, call pixels_changed so that the levels are made again
+        '''
+        if self.pyramid is None or self.pyramid_source is not self.array:
+            self.pyramid = [self]
+            self.pyramid_source = self.array
+        while len(self.pyramid) <= n:
+            above = self.pyramid[-1].array
+            array = half_size(above.astype(compute_dtype(above.dtype), copy=False))
+            new_im = Image(x_pixels=array.shape[0], y_pixels=array.shape[1], num_channels=array.shape[2], dtype=above.dtype)
+            new_im.array = to_dtype(array, above.dtype)
+            self.pyramid.append(new_im)
+        return self.pyramid[n]
+
+    def pixels_changed(self):
+        # call this after changing self.array in place: forgets everything worked out from the old pixels
+        # (the levels made by level, and the statistics from histogram.py)
+        self.pyramid = None
+        self.pyramid_source = None
+        self.statistics = None
+        self.statistics_source = None
+
+    def write_image(self, output_file_name, gamma=2.2, filter_type=0, level=0):
         '''
         3D numpy array (Y, X, channel) of values between 0 and 1 -> write to png
+        filter_type is passed on to png.Writer: 'adaptive' usually gives smaller files for photos,
+        but 0 (no filtering) is better for images with few colors (like lake.png)
+        level writes that level of the pyramid instead of the full size image (see the level method)
         '''
-        im = np.clip(self.array, 0, 1)
-        y, x = self.array.shape[0], self.array.shape[1]
-        im = im.reshape(y, x*3)
-        writer = png.Writer(x, y)
+        array = self.level(level).array
+        writer = png_writer(*array.shape, filter_type=filter_type)
         with open(self.output_path + output_file_name, 'wb') as f:
-            writer.write(f, 255*(im**(1/gamma)))
+            writer.write_ndarray(f, encode_pixels(array, gamma))
+
+    def write_preview(self, output_file_name, max_size, gamma=2.2, filter_type=0):
+        '''
+        write the biggest level of the pyramid that is at most max_size pixels tall and wide, and return its level
+        once the levels have been made, this only reads and encodes the preview's pixels, so it's as fast for a huge
+        image as for a small one
+        '''
+        x, y = self.array.shape[0], self.array.shape[1]
+        level = 0
+        while max(x, y) > max(max_size, 1):
+            x, y = -(-x // 2), -(-y // 2)
+            level += 1
+        self.write_image(output_file_name, gamma, filter_type, level=level)
+        return level
 
-        self.array.resize(y, x, 3)  # we mutated the method in the first step of the function
-        
 
 if __name__ == '__main__':
     im = Image(filename='lake.png')
@@ -0,0 +1,217 @@
+"""
+Lazy Image Processing
+
+The functions in transform.py each make a whole new Image, so a chain like the edge detector
+(apply_kernel twice, then combine_images) goes over the full image three times and allocates three
+full size arrays. Here the same operations just record what should be done, building a graph of
+nodes, and nothing is computed until the result is asked for with evaluate (or write_image).
+
+Then the graph is evaluated a block of rows at a time, small enough to stay in the CPU cache: every
+node computes its rows of the block (kernels ask their input for a few extra "halo" rows, like in
+stream.py), pointwise operations (brighten, adjust_contrast, combine_images, clip) work in place on
+their input's block whenever nobody else needs it, and a node used twice (like the source image of
+the edge detector) is only computed once per block. The only full size array is the result, and
+write_image doesn't even need that, since it gamma encodes and writes each block as it goes.
+
+All the math is done in floating point, and integer images are only rounded once, at the end.
+"""
+
+import numpy as np
+import transform
+from image import Image, compute_dtype, encode_pixels, max_value, png_writer, to_dtype
+
+
+class Node:
+    # one operation in the graph
+    halo = 0  # how many rows above and below a pixel the operation looks at
+
+    def __init__(self, *inputs):
+        self.inputs = inputs
+        first = inputs[0]
+        self.x_pixels, self.y_pixels, self.num_channels = first.x_pixels, first.y_pixels, first.num_channels
+        # the dtype of the final image, and the floating point dtype the math is done in
+        self.dtype = first.dtype
+        self.compute_dtype = first.compute_dtype
+
+    def rows(self, start, stop, evaluation):
+        # returns rows start to stop of this node's result
+        # evaluation remembers what has been computed in the current block, so that shared nodes only run once
+        key = (id(self), start, stop)
+        if key not in evaluation.results:
+            halo_start = max(0, start - self.halo)
+            halo_stop = min(self.x_pixels, stop + self.halo)
+            arrays = [node.rows(halo_start, halo_stop, evaluation) for node in self.inputs]
+            # we can overwrite an input's rows if we're the only one using that node
+            # (and it isn't the source image itself)
+            writable = [evaluation.consumers[id(node)] == 1 and not isinstance(node, Source) for node in self.inputs]
+            result = self.compute(arrays, writable)
+            evaluation.results[key] = result[start - halo_start:stop - halo_start]
+        return evaluation.results[key]
+
+    def compute(self, arrays, writable):
+        raise NotImplementedError
+
+
+class Source(Node):
+    # an existing Image
+    def __init__(self, image):
+        self.inputs = ()
+        self.image = image
+        self.x_pixels, self.y_pixels, self.num_channels = image.array.shape
+        self.dtype = image.array.dtype
+        self.compute_dtype = compute_dtype(self.dtype)
+
+    def rows(self, start, stop, evaluation):
+        key = (id(self), start, stop)
+        if key not in evaluation.results:
+            # no copy at all for floating point images of the right type
+            evaluation.results[key] = self.image.array[start:stop].astype(self.compute_dtype, copy=False)
+        return evaluation.results[key]
+
+
+class Pointwise(Node):
+    # an operation on each pixel by itself, done in place in its first input's rows when possible
+    def compute(self, arrays, writable):
+        out = arrays[0] if writable[0] else np.empty_like(arrays[0])
+        self.apply(arrays, out)
+        return out
+
+
+class Brighten(Pointwise):
+    def __init__(self, node, factor):
+        super().__init__(node)
+        self.factor = factor
+
+    def apply(self, arrays, out):
+        np.multiply(arrays[0], self.factor, out=out)
+
+
+class AdjustContrast(Pointwise):
+    def __init__(self, node, factor, mid):
+        super().__init__(node)
+        self.factor = factor
+        # mid is between 0 and 1, so for integer images we scale it up like the pixel values
+        self.mid = mid * max_value(self.dtype)
+
+    def apply(self, arrays, out):
+        np.subtract(arrays[0], self.mid, out=out)
+        out *= self.factor
+        out += self.mid
+
+
+class CombineImages(Pointwise):
+    def apply(self, arrays, out):
+        # same math as transform.combine_images
+        squares = arrays[1] * arrays[1]
+        np.multiply(arrays[0], arrays[0], out=out)
+        out += squares
+        np.sqrt(out, out=out)
+
+
+class Clip(Pointwise):
+    def apply(self, arrays, out):
+        # clip to the range an image can show, 0 to 1 (or 0 to max_value for integer images)
+        np.clip(arrays[0], 0, max_value(self.dtype), out=out)
+
+
+class Blur(Node):
+    def __init__(self, node, kernel_size):
+        super().__init__(node)
+        self.kernel_size = kernel_size
+        self.halo = kernel_size // 2
+
+    def compute(self, arrays, writable):
+        # same math as transform.blur
+        totals = transform.box_sums(transform.box_sums(arrays[0], self.halo, axis=0), self.halo, axis=1)
+        totals /= self.kernel_size ** 2
+        return totals.astype(self.compute_dtype, copy=False)
+
+
+class ApplyKernel(Node):
+    def __init__(self, node, kernel, method=None):
+        super().__init__(node)
+        self.kernel = kernel
+        self.method = method
+        self.halo = kernel.shape[0] // 2
+
+    def compute(self, arrays, writable):
+        return transform.correlate(arrays[0], self.kernel, self.method)
+
+
+class Evaluation:
+    # the bookkeeping for evaluating one graph
+    def __init__(self, node):
+        # how many nodes use each node's result
+        self.consumers = {id(node): 1}
+        seen = set()
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            for input_node in node.inputs:
+                self.consumers[id(input_node)] = self.consumers.get(id(input_node), 0) + 1
+                todo.append(input_node)
+        self.results = {}
+
+    def blocks(self, node, block_rows=None):
+        # yields (start, stop, rows) for consecutive blocks of the node's result
+        if block_rows is None:
+            # about 1 MB of floating point values per block
+            block_rows = max(1, 2**17 // (node.y_pixels * node.num_channels))
+        for start in range(0, node.x_pixels, block_rows):
+            stop = min(start + block_rows, node.x_pixels)
+            self.results = {}
+            yield start, stop, node.rows(start, stop, self)
+        self.results = {}
+
+
+def source(image):
+    return Source(image)
+
+def open_image(filename, dtype=np.float64):
+    return Source(Image(filename=filename, dtype=dtype))
+
+def brighten(node, factor):
+    return Brighten(node, factor)
+
+def adjust_contrast(node, factor, mid):
+    return AdjustContrast(node, factor, mid)
+
+def blur(node, kernel_size):
+    return Blur(node, kernel_size)
+
+def apply_kernel(node, kernel, method=None):
+    return ApplyKernel(node, kernel, method)
+
+def combine_images(node1, node2):
+    return CombineImages(node1, node2)
+
+def clip(node):
+    return Clip(node)
+
+
+def evaluate(node, block_rows=None):
+    # compute the graph ending at node, returns an Image (of the same dtype as the source images)
+    new_im = Image(x_pixels=node.x_pixels, y_pixels=node.y_pixels, num_channels=node.num_channels, dtype=node.dtype)
+    for start, stop, rows in Evaluation(node).blocks(node, block_rows):
+        new_im.array[start:stop] = to_dtype(rows, node.dtype)
+    return new_im
+
+def write_image(node, output_file_name, gamma=2.2, block_rows=None, filter_type=0, output_path='output/'):
+    # same as evaluate(node).write_image(...), but each block is gamma encoded and written as soon as it's computed
+    def encoded():
+        for start, stop, rows in Evaluation(node).blocks(node, block_rows):
+            yield encode_pixels(to_dtype(rows, node.dtype), gamma)
+    writer = png_writer(node.x_pixels, node.y_pixels, node.num_channels, filter_type=filter_type)
+    with open(output_path + output_file_name, 'wb') as f:
+        writer.write_strips(f, encoded())
+
+
+if __name__ == '__main__':
+    # the edge detector from transform.py, in one pass over the image
+    city = open_image('city.png')
+    sobel_x = apply_kernel(city, np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]]))
+    sobel_y = apply_kernel(city, np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]]))
+    write_image(combine_images(sobel_x, sobel_y), 'edge_xy.png')
@@ -0,0 +1,174 @@
+"""
+Parallel Image Processing
+
+Runs the transform.py functions on several processes at once. The image is split into tiles
+(horizontal bands of rows), and each worker process runs the function on one tile at a time.
+Like stream.py, operations that look at neighboring pixels (blur, apply_kernel) get a few extra
+rows (a "halo") above and below their tile, so the results are the same as running transform.py on
+the whole image.
+
+The pixels are never sent to the workers: the input and output arrays live in shared memory
+(multiprocessing.shared_memory), which every process can read and write directly, so all that
+is sent for each tile is the names of the shared memory blocks and the rows to work on.
+
+Starting the worker processes takes longer than most transforms, so they're started once, the first
+time they're needed, and kept for every call after that (or pass your own executor to run).
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import cache
+import numpy as np
+import transform
+from image import Image
+
+
+# the worker processes kept between calls, by number of workers
+pools = {}
+
+
+def pool(workers):
+    # the ProcessPoolExecutor with this many workers, started the first time it's asked for
+    if workers not in pools:
+        # the workers never use the result cache: run caches the whole result instead
+        pools[workers] = ProcessPoolExecutor(max_workers=workers, initializer=cache.disable)
+    return pools[workers]
+
+def shutdown():
+    # stop the worker processes (the next call starts new ones)
+    while pools:
+        pools.popitem()[1].shutdown()
+
+
+def share(array):
+    # copy array into a new shared memory block
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block
+
+
+def run_tile(function, inputs, output, start, stop, halo, params):
+    # runs in a worker process: inputs and output are (shared memory name, shape, dtype)
+    # computes rows start to stop of the output, reading the inputs from start - halo to stop + halo
+    # a result for one tile is no use to anyone else, so we call the function without the result cache (transform.cached)
+    function = getattr(function, '__wrapped__', function)
+    blocks = []
+    arrays = result = tiles = new_im = im = None
+    try:
+        arrays = []
+        for name, shape, dtype in inputs + [output]:
+            block = shared_memory.SharedMemory(name=name)
+            blocks.append(block)
+            arrays.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+        result = arrays.pop()
+        x_pixels = result.shape[0]
+        halo_start = max(0, start - halo)
+        halo_stop = min(x_pixels, stop + halo)
+        tiles = []
+        for array in arrays:
+            im = Image(x_pixels=halo_stop - halo_start, y_pixels=array.shape[1], num_channels=array.shape[2], dtype=array.dtype)
+            im.array = array[halo_start:halo_stop]
+            tiles.append(im)
+        new_im = function(*tiles, **params)
+        # throw away the halo rows of the result
+        result[start:stop] = new_im.array[start - halo_start:stop - halo_start]
+    finally:
+        # don't keep views of the shared memory around, or it can't be closed
+        arrays = result = tiles = new_im = im = None
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # if function raised, its traceback still holds views of the tiles; the block is closed when that's
+                # freed, and the error that matters is function's, which is on its way
+                pass
+
+
+def run(function, images, halo=0, workers=None, tile_rows=None, executor=None, **params):
+    # calls function(*images, **params) with the work split across worker processes
+    # halo is how many rows above and below a pixel the function looks at
+    # workers is the number of processes (by default, one per CPU), tile_rows the number of rows in each tile
+    # executor is a ProcessPoolExecutor to run the tiles on, instead of the one kept for this many workers
+    first = images[0].array
+    x_pixels, y_pixels, num_channels = first.shape
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if tile_rows is None:
+        # a few tiles per worker, so that the ones that finish early can pick up more work
+        tile_rows = -(-x_pixels // (4 * workers))
+    tile_rows = max(1, tile_rows)
+    if workers == 1 and executor is None:
+        # not worth starting any processes
+        return function(*images, **params)
+    # like transform.cached, but for the whole result (the workers don't cache their tiles)
+    key = None
+    if cache.active is not None and hasattr(function, '__wrapped__'):
+        key = transform.cache_key(function.__wrapped__, *images, **params)
+        if key is not None:
+            new_im = transform.cached_image(key)
+            if new_im is not None:
+                return new_im
+
+    blocks = []
+    try:
+        inputs = []
+        for im in images:
+            blocks.append(share(im.array))
+            inputs.append((blocks[-1].name, im.array.shape, im.array.dtype))
+        new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=first.dtype)
+        blocks.append(share(new_im.array))
+        output = (blocks[-1].name, new_im.array.shape, new_im.array.dtype)
+        if executor is None:
+            executor = pool(workers)
+        tiles = [executor.submit(run_tile, function, inputs, output, start, min(start + tile_rows, x_pixels), halo, params)
+                 for start in range(0, x_pixels, tile_rows)]
+        try:
+            for tile in tiles:
+                tile.result()  # raises any error from the worker
+        except BrokenProcessPool:
+            # a worker died, so this pool can't be used again; the next call starts a new one
+            if pools.get(workers) is executor:
+                del pools[workers]
+            raise
+        finally:
+            # don't free the shared memory while tiles are still running
+            for tile in tiles:
+                tile.cancel()
+            for tile in tiles:
+                if not tile.cancelled():
+                    tile.exception()
+        new_im.array[...] = np.ndarray(new_im.array.shape, dtype=new_im.array.dtype, buffer=blocks[-1].buf)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    if key is not None:
+        cache.active.put(key, new_im.array)
+    return new_im
+
+
+def brighten(image, factor, workers=None):
+    return run(transform.brighten, [image], workers=workers, factor=factor)
+
+def adjust_contrast(image, factor, mid, workers=None):
+    return run(transform.adjust_contrast, [image], workers=workers, factor=factor, mid=mid)
+
+def blur(image, kernel_size, workers=None):
+    return run(transform.blur, [image], halo=kernel_size // 2, workers=workers, kernel_size=kernel_size)
+
+def apply_kernel(image, kernel, workers=None):
+    return run(transform.apply_kernel, [image], halo=kernel.shape[0] // 2, workers=workers, kernel=kernel)
+
+def combine_images(image1, image2, workers=None):
+    return run(transform.combine_images, [image1, image2], workers=workers)
+
+
+if __name__ == '__main__':
+    # the edge detector from transform.py, on every CPU
+    city = Image(filename='city.png')
+    sobel_x = apply_kernel(city, np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]]))
+    sobel_y = apply_kernel(city, np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]]))
+    combine_images(sobel_x, sobel_y).write_image('edge_xy.png')
@@ -123,7 +123,7 @@ __version__ = "0.0.18"
 
 import itertools
 import math
-import re
+import mmap
 # http://www.python.org/doc/2.4.4/lib/module-operator.html
 import operator
 import struct
@@ -142,11 +142,44 @@ try:
     # filtering functions defined later in this file (see `class
     # pngfilters`).
     import cpngfilters as pngfilters
+    _have_cpngfilters = True
 except ImportError:
-    pass
+    _have_cpngfilters = False
 
+class _LazyNumpy(object):
+    """Stands in for the ``numpy`` module until it is first used, then
+    imports it and replaces itself with it.
+    """
 
-__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array']
+    def __getattr__(self, name):
+        global numpy
+        import numpy
+        return getattr(numpy, name)
+
+# NumPy is optional.  It is only needed by the methods that produce
+# or consume ``ndarray`` objects (for example
+# :meth:`Reader.read_numpy`); everything else works without it.  It
+# also takes many times longer to import than this module, so it is
+# not imported until one of those methods needs it.  Use
+# :func:`_numpy_available` rather than testing ``numpy`` directly.
+numpy = _LazyNumpy()
+
+def _numpy_available():
+    """True if NumPy can be used, importing it if that hasn't been
+    done yet.
+    """
+
+    global numpy
+    if isinstance(numpy, _LazyNumpy):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy is not None
+
+
+__all__ = ['Image', 'Reader', 'MappedReader', 'Writer', 'write_chunks',
+           'from_array']
 
 
 # The PNG signature.
@@ -165,6 +198,27 @@ def group(s, n):
     # See http://www.python.org/doc/2.6/library/functions.html#zip
     return list(zip(*[iter(s)]*n))
 
+# The largest piece of compressed data given to the decompressor at
+# once.  When its output is limited (with ``max_length``), the input
+# that was not used is copied into ``unconsumed_tail`` on every call;
+# slicing huge ``IDAT`` chunks keeps that copy small.
+_idat_slice = 2**16
+
+# Scanlines shorter than this many bytes are filtered (and have their
+# filters undone) a byte at a time in Python even when NumPy is
+# available: for them, calling NumPy costs more than it saves.
+_numpy_filter_min = 64
+
+def _idat_slices(idat):
+    """Iterator that yields the data of each ``IDAT`` chunk in `idat`
+    in slices of at most :data:`_idat_slice` bytes.
+    """
+
+    for data in idat:
+        data = memoryview(data)
+        for i in range(0, len(data), _idat_slice):
+            yield data[i:i+_idat_slice]
+
 def isarray(x):
     return isinstance(x, array)
 
@@ -312,6 +366,8 @@ class Writer:
                  colormap=None,
                  maxval=None,
                  chunk_limit=2**20,
+                 filter_type=0,
+                 workers=None,
                  x_pixels_per_unit = None,
                  y_pixels_per_unit = None,
                  unit_is_meter = False):
@@ -343,6 +399,12 @@ class Writer:
           Create an interlaced image.
         chunk_limit
           Write multiple ``IDAT`` chunks to save memory.
+        filter_type
+          Scanline filter: 0 (none) to 4 (Paeth), or ``'adaptive'``;
+          default: 0.
+        workers
+          Number of threads used to compress the image data;
+          default: 1 or None.
         x_pixels_per_unit
           Number of pixels a unit along the x axis (write a
           `pHYs` chunk).
@@ -428,6 +490,23 @@ class Writer:
         `chunk_limit` is used to limit the amount of memory used whilst
         compressing the image.  In order to avoid using large amounts of
         memory, multiple ``IDAT`` chunks may be created.
+        `filter_type` selects the scanline filter applied before
+        compression (see http://www.w3.org/TR/PNG/#9Filters ): 0
+        (none), 1 (sub), 2 (up), 3 (average), or 4 (Paeth) to use the
+        same filter for every scanline; or ``'adaptive'`` to pick the
+        filter separately for each scanline, using the heuristic
+        recommended by the PNG specification (and used by libpng): the
+        filter that gives the smallest sum of absolute values, when the
+        filtered bytes are regarded as signed.  Filtering generally
+        makes photographic images compress better.
+        When `workers` is more than 1 the image data is split into
+        segments of (at least) `chunk_limit` bytes which are
+        compressed in parallel by a pool of that many threads (``zlib``
+        releases the GIL whilst compressing).  Each segment is
+        compressed as a separate run of deflate blocks ending on a
+        byte boundary, primed with the tail of the previous segment as
+        a preset dictionary so that very little compression is lost;
+        the runs are concatenated into a single valid ``zlib`` stream.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -503,6 +582,10 @@ class Writer:
         if bitdepth > 8 and palette:
             raise ValueError(
                 "bit depth must be 8 or less for images with palette")
+        if filter_type not in (0,1,2,3,4,'adaptive'):
+            raise ValueError(
+                "filter_type (%r) must be 0 to 4, or 'adaptive'" %
+                (filter_type,))
 
         transparent = check_color(transparent, greyscale, 'transparent')
         background = check_color(background, greyscale, 'background')
@@ -521,6 +604,8 @@ class Writer:
         self.bitdepth = int(bitdepth)
         self.compression = compression
         self.chunk_limit = chunk_limit
+        self.filter_type = filter_type
+        self.workers = workers
         self.interlace = bool(interlace)
         self.palette = palette
         self.x_pixels_per_unit = x_pixels_per_unit
@@ -534,6 +619,8 @@ class Writer:
         self.planes = self.color_planes + self.alpha
         # :todo: fix for bitdepth < 8
         self.psize = (self.bitdepth/8) * self.planes
+        # Filter offset, see :func:`filter_scanline`.
+        self.filter_offset = max(1, int(self.psize))
 
     def make_palette(self):
         """Create the byte sequences for a ``PLTE`` and if necessary a
@@ -579,21 +666,10 @@ class Writer:
               "rows supplied (%d) does not match height (%d)" %
               (nrows, self.height))
 
-    def write_passes(self, outfile, rows, packed=False):
+    def write_preamble(self, outfile):
         """
-        Write a PNG image to the output file.
-        Most users are expected to find the :meth:`write` or
-        :meth:`write_array` method more convenient.
-        
-        The rows should be given to this method in the order that
-        they appear in the output file.  For straightlaced images,
-        this is the usual top to bottom ordering, but for interlaced
-        images the rows should have already been interlaced before
-        passing them to this function.
-        `rows` should be an iterable that yields each row.  When
-        `packed` is ``False`` the rows should be in boxed row flat pixel
-        format; when `packed` is ``True`` each row should be a packed
-        sequence of bytes.
+        Write the PNG signature and all the chunks that precede the
+        ``IDAT`` chunks to the output file.
         """
 
         # http://www.w3.org/TR/PNG/#5PNG-file-signature
@@ -653,11 +729,22 @@ class Writer:
             tup = (self.x_pixels_per_unit, self.y_pixels_per_unit, int(self.unit_is_meter))
             write_chunk(outfile, b'pHYs', struct.pack("!LLB",*tup))
 
-        # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
-        else:
-            compressor = zlib.compressobj()
+    def write_passes(self, outfile, rows, packed=False):
+        """
+        Write a PNG image to the output file.
+        Most users are expected to find the :meth:`write` or
+        :meth:`write_array` method more convenient.
+        
+        The rows should be given to this method in the order that
+        they appear in the output file.  For straightlaced images,
+        this is the usual top to bottom ordering, but for interlaced
+        images the rows should have already been interlaced before
+        passing them to this function.
+        `rows` should be an iterable that yields each row.  When
+        `packed` is ``False`` the rows should be in boxed row flat pixel
+        format; when `packed` is ``True`` each row should be a packed
+        sequence of bytes.
+        """
 
         # Choose an extend function based on the bitdepth.  The extend
         # function packs/decomposes the pixel values into bytes and
@@ -694,61 +781,120 @@ class Writer:
             def extend(sl):
                 oldextend([int(round(factor*x)) for x in sl])
 
-        # Build the first row, testing mostly to see if we need to
-        # changed the extend function to cope with NumPy integer types
-        # (they cause our ordinary definition of extend to fail, so we
-        # wrap it).  See
-        # http://code.google.com/p/pypng/issues/detail?id=44
         enumrows = enumerate(rows)
         del rows
 
-        # First row's filter type.
-        data.append(0)
-        # :todo: Certain exceptions in the call to ``.next()`` or the
-        # following try would indicate no row data supplied.
-        # Should catch.
-        i,row = next(enumrows)
-        try:
-            # If this fails...
-            extend(row)
-        except:
-            # ... try a version that converts the values to int first.
-            # Not only does this work for the (slightly broken) NumPy
-            # types, there are probably lots of other, unknown, "nearly"
-            # int types it works for.
-            def wrapmapint(f):
-                return lambda sl: f([int(x) for x in sl])
-            extend = wrapmapint(extend)
-            del wrapmapint
-            extend(row)
-
-        for i,row in enumrows:
-            # Add "None" filter type.  Currently, it's essential that
-            # this filter type be used for every scanline as we do not
-            # mark the first row of a reduced pass image; that means we
-            # could accidentally compute the wrong filtered scanline if
-            # we used "up", "average", or "paeth" on such a line.
+        # The scanline data is generated in pieces of about
+        # `chunk_limit` bytes, which :meth:`write_idat` compresses.
+        # The number of rows is recorded in `nrows` once they have all
+        # been generated.
+        nrows = []
+        def iterdata(extend):
+            # Rows are first added to `data` with the "None" filter type,
+            # and then filtered in place when another filter is in use.
+            # The first row of each pass must be filtered without a
+            # previous scanline.
+            pass_starts = self.pass_starts()
+            previous = [None]
+            def refilter(i, start):
+                line = data[start+1:]
+                if i in pass_starts:
+                    previous[0] = None
+                del data[start:]
+                data.extend(self.filter_scanline(line, previous[0]))
+                previous[0] = line
+
+            # Build the first row, testing mostly to see if we need to
+            # changed the extend function to cope with NumPy integer
+            # types (they cause our ordinary definition of extend to
+            # fail, so we wrap it).  See
+            # http://code.google.com/p/pypng/issues/detail?id=44
+
+            # First row's filter type.
             data.append(0)
-            extend(row)
-            if len(data) > self.chunk_limit:
-                compressed = compressor.compress(tostring(data))
-                if len(compressed):
-                    write_chunk(outfile, b'IDAT', compressed)
-                # Because of our very witty definition of ``extend``,
-                # above, we must re-use the same ``data`` object.  Hence
-                # we use ``del`` to empty this one, rather than create a
-                # fresh one (which would be my natural FP instinct).
-                del data[:]
-        if len(data):
-            compressed = compressor.compress(tostring(data))
-        else:
-            compressed = b''
-        flushed = compressor.flush()
-        if len(compressed) or len(flushed):
-            write_chunk(outfile, b'IDAT', compressed + flushed)
-        # http://www.w3.org/TR/PNG/#11IEND
-        write_chunk(outfile, b'IEND')
-        return i+1
+            # :todo: Certain exceptions in the call to ``.next()`` or
+            # the following try would indicate no row data supplied.
+            # Should catch.
+            i,row = next(enumrows)
+            try:
+                # If this fails...
+                extend(row)
+            except:
+                # ... try a version that converts the values to int
+                # first.  Not only does this work for the (slightly
+                # broken) NumPy types, there are probably lots of other,
+                # unknown, "nearly" int types it works for.
+                def wrapmapint(f):
+                    return lambda sl: f([int(x) for x in sl])
+                extend = wrapmapint(extend)
+                del wrapmapint
+                extend(row)
+            if self.filter_type:
+                refilter(i, 0)
+
+            for i,row in enumrows:
+                # Add "None" filter type.
+                start = len(data)
+                data.append(0)
+                extend(row)
+                if self.filter_type:
+                    refilter(i, start)
+                if len(data) > self.chunk_limit:
+                    yield tostring(data)
+                    # Because of our very witty definition of
+                    # ``extend``, above, we must re-use the same
+                    # ``data`` object.  Hence we use ``del`` to empty
+                    # this one, rather than create a fresh one (which
+                    # would be my natural FP instinct).
+                    del data[:]
+            if len(data):
+                yield tostring(data)
+            nrows.append(i+1)
+
+        self.write_preamble(outfile)
+        self.write_idat(outfile, iterdata(extend))
+        return nrows[0]
+
+    def pass_starts(self):
+        """Return the set of (0-based) scanline numbers at which a
+        new pass begins: just the first scanline for a straightlaced
+        image, or the first scanline of each non-empty reduced image
+        for an interlaced one.
+        """
+
+        if not self.interlace:
+            return set([0])
+        starts = set()
+        n = 0
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width:
+                continue
+            starts.add(n)
+            n += len(range(ystart, self.height, ystep))
+        return starts
+
+    def filter_scanline(self, line, previous):
+        """Filter one scanline with this writer's `filter_type`.
+        `line` and `previous` are as for the module level
+        :func:`filter_scanline` function.  Returns the filter type byte
+        followed by the filtered bytes.
+        """
+
+        # Short rows are quicker in pure Python than through NumPy,
+        # as in the module level :func:`filter_scanline`.
+        if len(line) >= _numpy_filter_min and _numpy_available():
+            if previous is not None:
+                previous = numpy.frombuffer(previous, dtype=numpy.uint8)
+            lines = numpy.frombuffer(line, dtype=numpy.uint8)[None]
+            return tostring(filter_rows_numpy(lines, previous,
+                self.filter_offset, self.filter_type))
+        if self.filter_type == 'adaptive':
+            candidates = [filter_scanline(type, line, self.filter_offset,
+                                          previous)
+                          for type in range(5)]
+            return tostring(min(candidates, key=_filter_cost))
+        return tostring(filter_scanline(self.filter_type, line,
+                                        self.filter_offset, previous))
 
     def write_array(self, outfile, pixels):
         """
@@ -779,6 +925,248 @@ class Writer:
               self.rescale[0])
         return self.write_passes(outfile, rows, packed=True)
 
+    def write_ndarray(self, outfile, pixels):
+        """
+        Write a NumPy array as a PNG file on the output file.
+        `pixels` should be an integer array of shape
+        ``(height, width, planes)`` or ``(height, width*planes)``
+        holding values between 0 and ``2**bitdepth-1``.  Arrays of
+        ``uint8`` (bit depth 8 or less) or ``uint16`` (bit depth 16)
+        are used as they are; other integer types are converted.
+        The scanlines are built with whole-array operations, a block
+        of rows at a time (see `chunk_limit`), and handed to ``zlib``
+        straight from the block buffer, so no Python object is ever
+        created per pixel.  Interlaced images are supported too.
+        Requires NumPy.
+        """
+
+        _require_numpy()
+        pixels = self.ndarray_samples(pixels)
+        if len(pixels) != self.height:
+            raise ValueError(
+              "pixels array of shape %r does not match image size %dx%dx%d"
+              % (pixels.shape, self.width, self.height, self.planes))
+
+        if self.interlace:
+            # http://www.w3.org/TR/PNG/#8InterlaceMethods
+            passes = [pixels[ystart::ystep, xstart::xstep]
+                      for xstart, ystart, xstep, ystep in _adam7]
+        else:
+            passes = [pixels]
+
+        def blocks():
+            for reduced in passes:
+                if reduced.size:
+                    for block in self.iter_filtered_numpy([reduced]):
+                        yield block
+
+        self.write_preamble(outfile)
+        self.write_idat(outfile, blocks())
+
+    def write_strips(self, outfile, strips):
+        """
+        Write a PNG image to the output file from NumPy arrays that
+        each hold some of its rows.  `strips` should be an iterable
+        that yields arrays of consecutive rows, top to bottom, in any
+        of the forms accepted by :meth:`write_ndarray`; the strips can
+        have any number of rows.  Each strip is filtered and compressed
+        as soon as it arrives, so the whole image never needs to be in
+        memory.  Interlaced images cannot be written this way.
+        Requires NumPy.
+        """
+
+        _require_numpy()
+        if self.interlace:
+            raise Error("write_strips cannot write an interlaced image")
+        nrows = []
+        def samples():
+            n = 0
+            for strip in strips:
+                strip = self.ndarray_samples(strip)
+                n += len(strip)
+                yield strip
+            nrows.append(n)
+
+        self.write_preamble(outfile)
+        self.write_idat(outfile, self.iter_filtered_numpy(samples()))
+        if nrows[0] != self.height:
+            raise ValueError(
+              "rows supplied (%d) does not match height (%d)" %
+              (nrows[0], self.height))
+
+    def ndarray_samples(self, pixels):
+        """Check that `pixels` is an integer array of (some) rows of
+        this image and return it as a ``(rows, width, planes)`` array
+        with the type used for this bit depth, rescaled when the
+        `bitdepth` isn't one that PNG supports directly.
+        """
+
+        pixels = numpy.asarray(pixels)
+        if pixels.dtype.kind not in 'ui':
+            raise ValueError("pixels must be an array of integers, not %s"
+                             % pixels.dtype)
+        vpr = self.width * self.planes
+        if pixels.size % vpr:
+            raise ValueError(
+              "pixels array of shape %r does not match image size %dx%dx%d"
+              % (pixels.shape, self.width, self.height, self.planes))
+        if self.rescale:
+            factor = \
+              float(2**self.rescale[1]-1) / float(2**self.rescale[0]-1)
+            pixels = numpy.round(factor * pixels)
+        pixels = pixels.astype('BH'[self.bitdepth > 8], copy=False)
+        return pixels.reshape(-1, self.width, self.planes)
+
+    def iter_filtered_numpy(self, strips):
+        """Iterator that yields blocks of filtered scanlines, with
+        their filter type bytes, ready for :meth:`write_idat`.
+        `strips` should yield ``(rows, width, planes)`` arrays of
+        consecutive rows of one image (or of one reduced image of an
+        interlaced image).  The yielded blocks are about `chunk_limit`
+        bytes and share one buffer, so they must be consumed before
+        the next one is requested.
+        """
+
+        # Filtering only looks at unfiltered bytes, so each block just
+        # needs the row before it.
+        previous = None
+        buf = None
+        for strip in strips:
+            height = len(strip)
+            lines = pack_numpy(strip.reshape(height, -1), self.bitdepth)
+            step = max(1, self.chunk_limit // (lines.shape[1] + 1))
+            if buf is None or len(buf) < min(step, height):
+                buf = numpy.empty((min(step, height), lines.shape[1] + 1),
+                                  dtype=numpy.uint8)
+            for start in range(0, height, step):
+                if start:
+                    previous = lines[start-1]
+                yield filter_rows_numpy(lines[start:start+step],
+                    previous, self.filter_offset, self.filter_type,
+                    out=buf)
+            if height:
+                # A copy, in case the caller reuses the strip's memory.
+                previous = lines[-1].copy()
+
+    def write_idat(self, outfile, blocks):
+        """
+        Compress the filtered scanline data and write it to the output
+        file as ``IDAT`` chunks, followed by the ``IEND`` chunk.
+        `blocks` should be an iterable that yields the data in pieces
+        of any size, as objects supporting the buffer protocol (for
+        example ``bytes`` or a contiguous ``ndarray``).  Each piece is
+        compressed as soon as it arrives, so it may be overwritten
+        afterwards.
+        """
+
+        # http://www.w3.org/TR/PNG/#11IDAT
+        if self.workers and self.workers > 1:
+            compressed = self.iter_compress_parallel(blocks)
+        else:
+            compressed = self.iter_compress(blocks)
+        pending = []
+        size = 0
+        for piece in compressed:
+            if len(piece):
+                pending.append(piece)
+                size += len(piece)
+            if size > self.chunk_limit:
+                write_chunk(outfile, b'IDAT', b''.join(pending))
+                pending = []
+                size = 0
+        write_chunk(outfile, b'IDAT', b''.join(pending))
+        # http://www.w3.org/TR/PNG/#11IEND
+        write_chunk(outfile, b'IEND')
+
+    def iter_compress(self, blocks):
+        """Compress the data in `blocks` (see :meth:`write_idat`) as
+        one ``zlib`` stream.  Yields the compressed data in pieces.
+        """
+
+        if self.compression is not None:
+            compressor = zlib.compressobj(self.compression)
+        else:
+            compressor = zlib.compressobj()
+        for block in blocks:
+            yield compressor.compress(block)
+        yield compressor.flush()
+
+    def iter_compress_parallel(self, blocks):
+        """Like :meth:`iter_compress`, but the data is compressed in
+        segments using a pool of `workers` threads.  The output is a
+        single ``zlib`` stream: the standard two byte header, the raw
+        deflate data of each segment (each but the last one ending
+        with a ``Z_SYNC_FLUSH`` so that they can simply be
+        concatenated), and the Adler-32 checksum of all the data,
+        combined from the checksums of the segments.
+        """
+
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self.compression is not None:
+            level = self.compression
+        else:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        # Deflate can refer back up to 32 KiB, which is also the largest
+        # useful preset dictionary.
+        window = 2**15
+        segment_size = max(self.chunk_limit, window)
+
+        def compress(segment, zdict, last):
+            if zdict:
+                compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                              -15, zdict=zdict)
+            else:
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            flush = (zlib.Z_SYNC_FLUSH, zlib.Z_FINISH)[last]
+            compressed = compressor.compress(segment)
+            compressed += compressor.flush(flush)
+            return compressed, zlib.adler32(segment), len(segment)
+
+        def segments():
+            # Yields (segment, last) pairs.  The blocks may be buffers
+            # that are overwritten once consumed, so they are copied.
+            segment = bytearray()
+            for block in blocks:
+                segment.extend(block)
+                if len(segment) >= segment_size:
+                    ready, segment = segment, bytearray()
+                    # Don't know yet whether it is the last one.
+                    yield ready, False
+            yield segment, True
+
+        # The zlib header only depends on the compression level.
+        yield zlib.compress(b'', level)[:2]
+        checksum = 1
+        pool = ThreadPoolExecutor(self.workers)
+        try:
+            # Futures in the order the segments appear in the stream.
+            # At most 2 per worker are in flight, bounding the memory
+            # used.
+            inflight = deque()
+            zdict = None
+            held = None
+            for segment, last in segments():
+                if held is not None:
+                    # `held` wasn't the last segment after all.
+                    inflight.append(pool.submit(compress, held, zdict,
+                                                False))
+                    zdict = bytes(held[-window:])
+                held = segment
+                while len(inflight) > 2 * self.workers:
+                    compressed, adler, length = inflight.popleft().result()
+                    checksum = _adler32_combine(checksum, adler, length)
+                    yield compressed
+            inflight.append(pool.submit(compress, held, zdict, True))
+            while inflight:
+                compressed, adler, length = inflight.popleft().result()
+                checksum = _adler32_combine(checksum, adler, length)
+                yield compressed
+        finally:
+            pool.shutdown()
+        yield struct.pack("!I", checksum)
+
     def convert_pnm(self, infile, outfile):
         """
         Convert a PNM file containing raw pixel data into a PNG file
@@ -926,6 +1314,15 @@ def filter_scanline(type, line, fo, prev=None):
 
     assert 0 <= type < 5
 
+    if len(line) >= _numpy_filter_min and _numpy_available():
+        # The same filters, a whole scanline at a time.
+        if not prev:
+            prev = None
+        else:
+            prev = numpy.asarray(prev, dtype=numpy.uint8)
+        lines = numpy.asarray(line, dtype=numpy.uint8)[None]
+        return array('B', tostring(filter_rows_numpy(lines, prev, fo, type)))
+
     # The output array.  Which, pathetically, we extend one-byte at a
     # time (fortunately this is linear).
     out = array('B', [type])
@@ -1001,8 +1398,32 @@ def filter_scanline(type, line, fo, prev=None):
     return out
 
 
-# Regex for decoding mode string
-RegexModeDecode = re.compile("(LA?|RGBA?);?([0-9]*)", flags=re.IGNORECASE)
+def _adler32_combine(adler1, adler2, length2):
+    """Return the Adler-32 checksum of the concatenation of two
+    pieces of data, given the checksum of each and the length of the
+    second one (like ``adler32_combine`` in the ``zlib`` C library).
+    """
+
+    # http://www.ietf.org/rfc/rfc1950.txt , section 8.2
+    base = 65521
+    a1, b1 = adler1 & 0xffff, adler1 >> 16
+    a2, b2 = adler2 & 0xffff, adler2 >> 16
+    a = (a1 + a2 - 1) % base
+    b = (b1 + b2 + length2 * (a1 - 1)) % base
+    return (b << 16) | a
+
+def _filter_cost(filtered):
+    """Cost of a filtered scanline (with its filter type byte) for
+    the adaptive filter heuristic: the sum of the absolute values of
+    the bytes regarded as signed.
+    """
+
+    return sum(min(x, 256-x) for x in filtered[1:])
+
+# Regex for decoding mode string.  It is compiled when first used
+# (:mod:`re` caches it), so that importing this module doesn't have
+# to import :mod:`re`.
+_mode_pattern = "(LA?|RGBA?);?([0-9]*)"
 
 def from_array(a, mode=None, info={}):
     """Create a PNG :class:`Image` object from a 2- or 3-dimensional
@@ -1077,7 +1498,8 @@ def from_array(a, mode=None, info={}):
     info = dict(info)
 
     # Syntax check mode string.
-    match = RegexModeDecode.match(mode)
+    import re
+    match = re.match(_mode_pattern, mode, flags=re.IGNORECASE)
     if not match:
         raise Error("mode string should be 'RGB' or 'L;16' or similar.")
 
@@ -1460,11 +1882,20 @@ class Reader:
 
         # Call appropriate filter algorithm.  Note that 0 has already
         # been dealt with.
-        (None,
-         pngfilters.undo_filter_sub,
-         pngfilters.undo_filter_up,
-         pngfilters.undo_filter_average,
-         pngfilters.undo_filter_paeth)[filter_type](fu, scanline, previous, result)
+        undo = (None,
+                pngfilters.undo_filter_sub,
+                pngfilters.undo_filter_up,
+                pngfilters.undo_filter_average,
+                pngfilters.undo_filter_paeth)[filter_type]
+        # "sub" and "up" are whole-scanline operations in NumPy.
+        # "average" and "paeth" depend on the byte one pixel to the
+        # left, so within a single scanline they stay sequential (see
+        # :func:`undo_filters_numpy` for how a block of them is done).
+        if (filter_type in (1, 2) and not _have_cpngfilters and
+                len(scanline) >= _numpy_filter_min and _numpy_available()):
+            undo = (None, undo_filter_sub_numpy,
+                    undo_filter_up_numpy)[filter_type]
+        undo(fu, scanline, previous, result)
         return result
 
     def deinterlace(self, raw):
@@ -1515,6 +1946,53 @@ class Reader:
                             flat[i::self.planes]
         return a
 
+    def adam7_passes(self):
+        """Iterator that yields the layout of each non-empty pass of
+        an interlaced image: (`xstart`, `ystart`, `xstep`, `ystep`,
+        `ppr`, `rows`, `row_size`), where `ppr` is the number of
+        pixels per row of the pass, `rows` the number of rows and
+        `row_size` the number of bytes per row (not counting the
+        filter type byte).
+        """
+
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width or ystart >= self.height:
+                continue
+            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
+            rows = int(math.ceil((self.height-ystart)/float(ystep)))
+            row_size = int(math.ceil(self.psize * ppr))
+            yield xstart, ystart, xstep, ystep, ppr, rows, row_size
+
+    def deinterlace_numpy(self, raw):
+        """
+        The NumPy counterpart of :meth:`deinterlace`: read raw pixel
+        data, undo filters and deinterlace.  Each pass is unfiltered
+        and unpacked as a block (see :func:`undo_filters_numpy`), then
+        scattered into its place in the image with a single strided
+        assignment.
+        Returns a ``(height, width, planes)`` array as per
+        :meth:`read_numpy`.
+        """
+
+        _require_numpy()
+        out = numpy.empty((self.height, self.width, self.planes),
+                          dtype='BH'[self.bitdepth > 8])
+        fu = max(1, self.psize)
+        raw = memoryview(raw)
+        source_offset = 0
+        for xstart, ystart, xstep, ystep, ppr, rows, row_size in \
+          self.adam7_passes():
+            size = rows * (row_size + 1)
+            if len(raw) < source_offset + size:
+                raise FormatError(
+                  'Wrong size for decompressed IDAT chunk.')
+            lines = undo_filters_numpy(
+              raw[source_offset:source_offset+size], rows, row_size, fu)
+            source_offset += size
+            out[ystart::ystep, xstart::xstep] = unpack_numpy(
+              lines, ppr, self.planes, self.bitdepth)
+        return out
+
     def iterboxed(self, rows):
         """Iterator that yields each scanline in boxed row flat pixel
         format.  `rows` should be an iterator that yields the bytes of
@@ -1587,7 +2065,9 @@ class Reader:
         # line of image.
         recon = None
         for some in raw:
-            a.extend(some)
+            # frombytes copies buffers (like the pieces yielded by
+            # iterdecomp) in one go, where extend goes byte by byte.
+            a.frombytes(some)
             while len(a) >= rb + 1:
                 filter_type = a[0]
                 scanline = a[1:rb+1]
@@ -1793,53 +2273,114 @@ class Reader:
         checksum failures will raise warnings rather than exceptions.
         """
 
-        def iteridat():
-            """Iterator that yields all the ``IDAT`` chunks as strings."""
-            while True:
-                try:
-                    type, data = self.chunk(lenient=lenient)
-                except ValueError as e:
-                    raise ChunkError(e.args[0])
-                if type == b'IEND':
-                    # http://www.w3.org/TR/PNG/#11IEND
-                    break
-                if type != b'IDAT':
-                    continue
-                # type == b'IDAT'
-                # http://www.w3.org/TR/PNG/#11IDAT
-                if self.colormap and not self.plte:
-                    warnings.warn("PLTE chunk is required before IDAT chunk")
-                yield data
-
-        def iterdecomp(idat):
-            """Iterator that yields decompressed strings.  `idat` should
-            be an iterator that yields the ``IDAT`` chunk data.
+        def iterdecomp(idat, size):
+            """Iterator that yields the decompressed data in pieces of
+            exactly `size` bytes (only the last one may be shorter).
+            `idat` should be an iterator that yields the ``IDAT``
+            chunk data.
+            The pieces are decompressed straight into a ring of two
+            preallocated buffers, which are yielded in turn, so a
+            piece is only valid until the next but one is yielded;
+            consumers must copy what they want to keep.  However big
+            the ``IDAT`` chunks are, no more than `size` bytes of
+            output (and :data:`_idat_slice` bytes of input) are
+            held at once.
             """
 
-            # Currently, with no max_length parameter to decompress,
-            # this routine will do one yield per IDAT chunk: Not very
-            # incremental.
             d = zlib.decompressobj()
-            # Each IDAT chunk is passed to the decompressor, then any
-            # remaining state is decompressed out.
-            for data in idat:
-                # :todo: add a max_length argument here to limit output
-                # size.
-                yield array('B', d.decompress(data))
-            yield array('B', d.flush())
+            ring = [bytearray(size), bytearray(size)]
+            slot = 0
+            fill = 0
+            for data in _idat_slices(idat):
+                while data:
+                    # Never ask for more than fills the current buffer.
+                    out = d.decompress(data, size - fill)
+                    data = d.unconsumed_tail
+                    ring[slot][fill:fill+len(out)] = out
+                    fill += len(out)
+                    if fill == size:
+                        yield ring[slot]
+                        slot ^= 1
+                        fill = 0
+            # Any remaining state is decompressed out.
+            out = memoryview(d.flush())
+            while out:
+                n = min(len(out), size - fill)
+                ring[slot][fill:fill+n] = out[:n]
+                out = out[n:]
+                fill += n
+                if fill == size:
+                    yield ring[slot]
+                    slot ^= 1
+                    fill = 0
+            if fill:
+                yield ring[slot][:fill]
 
         self.preamble(lenient=lenient)
-        raw = iterdecomp(iteridat())
+        idat = self.iteridat(lenient=lenient)
 
+        arraycode = 'BH'[self.bitdepth>8]
         if self.interlace:
-            raw = array('B', itertools.chain(*raw))
-            arraycode = 'BH'[self.bitdepth>8]
-            # Like :meth:`group` but producing an array.array object for
-            # each row.
-            pixels = map(lambda *row: array(arraycode, row),
+            raw = array('B')
+            for some in iterdecomp(idat, 2**16):
+                raw.frombytes(some)
+            if _numpy_available():
+                # An array.array object for each row, straight from the
+                # (native byte order) bytes of the NumPy rows.
+                pixels = self.deinterlace_numpy(raw)
+                pixels = map(lambda row: array(arraycode, row.tobytes()),
+                             pixels.reshape(self.height, -1))
+            else:
+                # Like :meth:`group` but producing an array.array
+                # object for each row.
+                pixels = map(lambda *row: array(arraycode, row),
                        *[iter(self.deinterlace(raw))]*self.width*self.planes)
+        elif _numpy_available():
+            # Undo the filters a block of scanlines at a time, which
+            # for "average" and "paeth" is many times quicker than a
+            # byte at a time (see :func:`undo_filters_numpy`).  Blocks
+            # are about 1 MiB of scanlines, and no taller than the
+            # image is wide.
+            block_rows = max(1, min(self.width, 2**20 // (self.row_bytes+1)))
+            def iterrows():
+                for y, lines in self._iter_lines_numpy(block_rows, lenient):
+                    samples = unpack_numpy(lines, self.width, self.planes,
+                                           self.bitdepth)
+                    for row in samples.reshape(len(lines), -1):
+                        yield array(arraycode, row.tobytes())
+            pixels = iterrows()
         else:
+            # One scanline (with its filter type byte) at a time.
+            raw = iterdecomp(idat, self.row_bytes + 1)
             pixels = self.iterboxed(self.iterstraight(raw))
+        return self.width, self.height, pixels, self._metadata()
+
+    def iteridat(self, lenient=False):
+        """Iterator that yields all the ``IDAT`` chunks as strings.
+        The :meth:`preamble` must already have been read.
+        """
+
+        while True:
+            try:
+                type, data = self.chunk(lenient=lenient)
+            except ValueError as e:
+                raise ChunkError(e.args[0])
+            if type == b'IEND':
+                # http://www.w3.org/TR/PNG/#11IEND
+                break
+            if type != b'IDAT':
+                continue
+            # type == b'IDAT'
+            # http://www.w3.org/TR/PNG/#11IDAT
+            if self.colormap and not self.plte:
+                warnings.warn("PLTE chunk is required before IDAT chunk")
+            yield data
+
+    def _metadata(self):
+        """The *metadata* dictionary returned by :meth:`read` and
+        :meth:`read_numpy`.
+        """
+
         meta = dict()
         for attr in 'greyscale alpha planes bitdepth interlace'.split():
             meta[attr] = getattr(self, attr)
@@ -1850,8 +2391,145 @@ class Reader:
                 meta[attr] = a
         if self.plte:
             meta['palette'] = self.palette()
-        return self.width, self.height, pixels, meta
+        return meta
+
+    def read_numpy(self, lenient=False):
+        """
+        Read the PNG file and decode it into a NumPy array.  Returns
+        (`width`, `height`, `pixels`, `metadata`) just like
+        :meth:`read`, except that `pixels` is a single
+        ``(height, width, planes)`` array with ``uint8`` values (bit
+        depth 8 or less) or ``uint16`` values (bit depth 16).
+        All of the ``IDAT`` data is decompressed in one go and the
+        scanline filters are undone with whole-array operations, so
+        no pixel value is ever boxed into a Python object.
+        Requires NumPy.
+        """
+
+        _require_numpy()
+        self.preamble(lenient=lenient)
+        data = b''.join(self.iteridat(lenient=lenient))
+
+        if self.interlace:
+            size = sum(rows * (row_size + 1) for xstart, ystart, xstep,
+                       ystep, ppr, rows, row_size in self.adam7_passes())
+            raw = zlib.decompress(data, 15, max(1, size))
+            if len(raw) != size:
+                raise FormatError(
+                  'Wrong size for decompressed IDAT chunk.')
+            pixels = self.deinterlace_numpy(raw)
+        else:
+            raw = zlib.decompress(data, 15, self.height*(self.row_bytes+1))
+            if len(raw) != self.height*(self.row_bytes+1):
+                raise FormatError(
+                  'Wrong size for decompressed IDAT chunk.')
+            lines = undo_filters_numpy(raw, self.height, self.row_bytes,
+                                       max(1, self.psize))
+            pixels = unpack_numpy(lines, self.width, self.planes,
+                                  self.bitdepth)
+        return self.width, self.height, pixels, self._metadata()
+
+
+    def iter_numpy(self, block_rows=None, lenient=False):
+        """
+        Iterator that decodes the image a block of rows at a time.
+        Yields ``(rows, width, planes)`` arrays of (at most)
+        `block_rows` consecutive rows, as per :meth:`read_numpy`.  The
+        default block size is between 1 MiB and 16 MiB of scanline
+        data.  Only a block's worth of decompressed data is held at any
+        time.
+        Interlaced images must be decoded whole, so for them this
+        decodes the entire image first.
+        Requires NumPy.
+        """
+
+        for y, lines in self._iter_lines_numpy(block_rows, lenient):
+            yield unpack_numpy(lines, self.width, self.planes,
+                               self.bitdepth)
+
+    def read_rows(self, start, stop, lenient=False):
+        """
+        Decode rows `start` (inclusive) to `stop` (exclusive) of the
+        image, returned as a ``(stop-start, width, planes)`` array as
+        per :meth:`read_numpy`.  The scanline filters make each row
+        depend on the ones above it, so all the rows before `start`
+        are decompressed and reconstructed too, but only a block at a
+        time and without being unpacked into samples.  Decoding stops
+        as soon as row `stop` has been reached.
+        Requires NumPy.
+        """
+
+        self.preamble(lenient=lenient)
+        start = max(0, start)
+        stop = min(stop, self.height)
+        out = numpy.empty((max(0, stop-start), self.width, self.planes),
+                          dtype='BH'[self.bitdepth > 8])
+        for y, lines in self._iter_lines_numpy(None, lenient, stop=stop):
+            first = max(y, start)
+            if first >= y + len(lines):
+                continue
+            out[first-start:y+len(lines)-start] = unpack_numpy(
+                lines[first-y:], self.width, self.planes, self.bitdepth)
+        return out
+
+    def _iter_lines_numpy(self, block_rows=None, lenient=False, stop=None):
+        """Iterator that yields (*y*, *lines*) pairs, where *lines* is
+        a ``(rows, row_bytes)`` array of reconstructed scanlines that
+        starts with row *y*.  Stops after row `stop` when given.
+        """
 
+        _require_numpy()
+        self.preamble(lenient=lenient)
+        if stop is None:
+            stop = self.height
+        if self.interlace:
+            x, y, pixels, meta = self.read_numpy(lenient=lenient)
+            lines = pixels.reshape(self.height, -1)
+            if self.bitdepth > 8:
+                lines = lines.astype('>u2').view(numpy.uint8)
+            elif self.bitdepth < 8:
+                lines = pack_numpy(lines, self.bitdepth)
+            yield 0, lines[:stop]
+            return
+
+        rb = self.row_bytes
+        fu = max(1, self.psize)
+        if block_rows is None:
+            # About 1 MiB of scanlines.  But undoing the "average" and
+            # "paeth" filters costs (rows + width) steps per block (see
+            # :func:`undo_filters_numpy`), so blocks at least as tall as
+            # the image is wide are preferred, up to 16 MiB.
+            block_rows = max(1, 2**20 // (rb+1),
+                             min(self.width, 2**24 // (rb+1)))
+        d = zlib.decompressobj()
+        pending = bytearray()
+        previous = None
+        y = 0
+        for data in _idat_slices(self.iteridat(lenient=lenient)):
+            while data:
+                # Limit the output of each call, so that a highly
+                # compressed chunk doesn't expand all at once.
+                pending.extend(d.decompress(data, block_rows*(rb+1)))
+                data = d.unconsumed_tail
+                while y < stop:
+                    n = min(block_rows, stop - y)
+                    if len(pending) < n*(rb+1):
+                        break
+                    lines = undo_filters_numpy(pending, n, rb, fu, previous)
+                    del pending[:n*(rb+1)]
+                    yield y, lines
+                    previous = lines[-1]
+                    y += n
+                if y >= stop:
+                    return
+        pending.extend(d.flush())
+        if len(pending) != (self.height - y)*(rb+1):
+            # :file:format We get here with a file format error:
+            # when the available bytes (after decompressing) do not
+            # pack into exact rows.
+            raise FormatError('Wrong size for decompressed IDAT chunk.')
+        if y < stop:
+            yield y, undo_filters_numpy(pending, stop - y, rb, fu, previous)
 
     def read_flat(self):
         """
@@ -1989,6 +2667,71 @@ class Reader:
             pixels = itershift(pixels)
         return x,y,pixels,meta
 
+    def asarray(self):
+        """Return the image data as per :meth:`asDirect`, but with
+        *pixels* as a ``(height, width, planes)`` NumPy array (see
+        :meth:`read_numpy`).  Palette lookup, synthesis of the alpha
+        channel from a ``tRNS`` chunk, and ``sBIT`` rescaling are done
+        with whole-array operations.
+        Requires NumPy.
+        """
+
+        x,y,pixels,meta = self.read_numpy()
+        pixels = self._direct_numpy(pixels, meta)
+        return x,y,pixels,meta
+
+    def iter_asarray(self, block_rows=None):
+        """Return the image data as per :meth:`asarray`, but with
+        *pixels* as an iterator that yields the image a block of rows
+        at a time (see :meth:`iter_numpy`).
+        Requires NumPy.
+        """
+
+        self.preamble()
+        meta = self._metadata()
+        # The metadata of the converted pixels.
+        self._direct_numpy(
+            numpy.zeros((0, self.width, self.planes),
+                        dtype='BH'[self.bitdepth > 8]), meta)
+        def iterdirect():
+            for block in self.iter_numpy(block_rows):
+                yield self._direct_numpy(block, self._metadata())
+        return self.width, self.height, iterdirect(), meta
+
+    def _direct_numpy(self, pixels, meta):
+        """Helper used by :meth:`asarray` and :meth:`iter_asarray`.
+        Convert `pixels` as read by :meth:`read_numpy` to the direct
+        representation, and update `meta` to match.
+        """
+
+        if self.colormap:
+            meta['colormap'] = False
+            meta['alpha'] = bool(self.trns)
+            meta['bitdepth'] = 8
+            meta['planes'] = 3 + bool(self.trns)
+            plte = numpy.array(self.palette(), dtype=numpy.uint8)
+            pixels = plte[pixels[..., 0]]
+        elif self.trns:
+            maxval = 2**meta['bitdepth']-1
+            meta['alpha'] = True
+            meta['planes'] += 1
+            opaque = (pixels != numpy.array(self.transparent)).any(axis=2)
+            alpha = opaque.astype(pixels.dtype) * pixels.dtype.type(maxval)
+            pixels = numpy.concatenate((pixels, alpha[..., None]), axis=2)
+        if self.sbit:
+            sbit = struct.unpack('%dB' % len(self.sbit), self.sbit)
+            targetbitdepth = max(sbit)
+            if targetbitdepth > meta['bitdepth']:
+                raise Error('sBIT chunk %r exceeds bitdepth %d' %
+                    (sbit,self.bitdepth))
+            if min(sbit) <= 0:
+                raise Error('sBIT chunk %r has a 0-entry' % sbit)
+            if targetbitdepth != meta['bitdepth']:
+                shift = meta['bitdepth'] - targetbitdepth
+                meta['bitdepth'] = targetbitdepth
+                pixels = pixels >> shift
+        return pixels
+
     def asFloat(self, maxval=1.0):
         """Return image pixels as per :meth:`asDirect` method, but scale
         all pixel values to be floating point values between 0.0 and
@@ -2126,6 +2869,82 @@ class Reader:
         meta['greyscale'] = False
         return width,height,convert(),meta
 
+class MappedReader(Reader):
+    """
+    PNG decoder for files that are mapped into memory, rather than
+    read.  The file's chunks are indexed once, when the reader is
+    created; the ``IDAT`` data is then passed to the decompressor as
+    ``memoryview`` slices of the mapping, without being copied.
+    This is most useful with :meth:`Reader.read_rows` and
+    :meth:`Reader.iter_numpy`, for working on parts of huge images.
+    """
+
+    def __init__(self, filename):
+        """
+        Create a decoder for the PNG file called `filename`.
+        """
+
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        Reader.__init__(self, bytes=self.map)
+        self.index = self.index_chunks()
+
+    def index_chunks(self):
+        """Return a list of (*type*, *offset*, *length*) triples, one
+        for each chunk in the file, where *offset* is the position of
+        the chunk's data in the file.  Checksums are not verified.
+        """
+
+        if self.map[:8] != _signature:
+            raise FormatError("PNG file has invalid signature.")
+        index = []
+        offset = 8
+        while offset < len(self.map):
+            if offset + 8 > len(self.map):
+                raise FormatError(
+                  'End of file whilst reading chunk length and type.')
+            length, type = struct.unpack_from('!I4s', self.map, offset)
+            offset += 8
+            if length > 2**31-1:
+                raise FormatError('Chunk %s is too large: %d.' % (type,length))
+            if offset + length + 4 > len(self.map):
+                raise ChunkError('Chunk %s too short for required %i octets.'
+                  % (type, length))
+            index.append((type, offset, length))
+            offset += length + 4
+            if type == b'IEND':
+                break
+        return index
+
+    def iteridat(self, lenient=False):
+        """Iterator that yields the data of all the ``IDAT`` chunks as
+        ``memoryview`` objects referring to the mapped file.
+        """
+
+        view = memoryview(self.map)
+        for type, offset, length in self.index:
+            if type != b'IDAT':
+                continue
+            if self.colormap and not self.plte:
+                warnings.warn("PLTE chunk is required before IDAT chunk")
+            data = view[offset:offset+length]
+            verify = zlib.crc32(type)
+            verify = zlib.crc32(data, verify) & (2**32 - 1)
+            (checksum, ) = struct.unpack_from('!I', self.map, offset+length)
+            if checksum != verify:
+                message = "Checksum error in %s chunk: 0x%08X != 0x%08X." % (
+                  type, checksum, verify)
+                if lenient:
+                    warnings.warn(message, RuntimeWarning)
+                else:
+                    raise ChunkError(message)
+            yield data
+
+    def close(self):
+        """Unmap the file."""
+
+        self.map.close()
+
 def check_bitdepth_colortype(bitdepth, colortype):
     """Check that `bitdepth` and `colortype` are both valid,
     and specified in a valid combination. Returns if valid,
@@ -2253,304 +3072,249 @@ except NameError:
         convert_rgb_to_rgba = staticmethod(convert_rgb_to_rgba)
 
 
-# === Command Line Support ===
+# === NumPy support ===
+
+def _require_numpy():
+    if not _numpy_available():
+        raise Error("this method requires NumPy")
+
+def undo_filter_sub_numpy(filter_unit, scanline, previous, result):
+    """Undo sub filter; the same as
+    :meth:`pngfilters.undo_filter_sub` but with NumPy.  Each byte of
+    the pixel is a running sum, modulo 256, of its column of bytes.
+    """
+
+    scanline = numpy.frombuffer(scanline, dtype=numpy.uint8)
+    result = numpy.frombuffer(result, dtype=numpy.uint8)
+    # uint8 arithmetic does the ``& 0xff`` for us.
+    numpy.cumsum(scanline.reshape(-1, filter_unit), axis=0,
+                 dtype=numpy.uint8, out=result.reshape(-1, filter_unit))
 
-def read_pam_header(infile):
+def undo_filter_up_numpy(filter_unit, scanline, previous, result):
+    """Undo up filter; the same as :meth:`pngfilters.undo_filter_up`
+    but with NumPy.
     """
-    Read (the rest of a) PAM header.  `infile` should be positioned
-    immediately after the initial 'P7' line (at the beginning of the
-    second line).  Returns are as for `read_pnm_header`.
+
+    scanline = numpy.frombuffer(scanline, dtype=numpy.uint8)
+    previous = numpy.frombuffer(previous, dtype=numpy.uint8)
+    result = numpy.frombuffer(result, dtype=numpy.uint8)
+    numpy.add(scanline, previous, out=result)
+
+def undo_filters_numpy(raw, height, row_bytes, fu, previous=None):
+    """Undo the filters of `height` consecutive scanlines.  `raw` is
+    a buffer holding the scanlines as they are stored in the
+    (decompressed) ``IDAT`` data: each one is a filter type byte
+    followed by `row_bytes` bytes.  `fu` is the filter unit (see
+    :meth:`Reader.undo_filter`).  `previous` is the reconstructed
+    scanline that precedes the first one, or ``None`` at the start of
+    an image (or a pass).
+    Returns the reconstructed scanlines as a ``(height, row_bytes)``
+    ``uint8`` array.
     """
-    
-    # Unlike PBM, PGM, and PPM, we can read the header a line at a time.
-    header = dict()
-    while True:
-        l = infile.readline().strip()
-        if l == b'ENDHDR':
-            break
-        if not l:
-            raise EOFError('PAM ended prematurely')
-        if l[0] == b'#':
-            continue
-        l = l.split(None, 1)
-        if l[0] not in header:
-            header[l[0]] = l[1]
+
+    lines = numpy.frombuffer(raw, dtype=numpy.uint8,
+                             count=height*(row_bytes+1))
+    lines = lines.reshape(height, row_bytes+1)
+    filter_types = lines[:, 0]
+    scanlines = lines[:, 1:]
+    if height and filter_types.max() > 4:
+        raise FormatError('Invalid PNG Filter Type.'
+          '  See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .')
+    if previous is None:
+        previous = numpy.zeros(row_bytes, dtype=numpy.uint8)
+    result = numpy.empty((height, row_bytes), dtype=numpy.uint8)
+
+    if (filter_types >= 3).any():
+        _undo_filters_wavefront(filter_types, scanlines, previous, fu,
+                                result)
+        return result
+
+    # Only "none", "sub" and "up": each of these is a whole-row
+    # operation once the previous row is known.
+    for y in range(height):
+        filter_type = filter_types[y]
+        out = result[y]
+        if filter_type == 0:
+            out[:] = scanlines[y]
+        elif filter_type == 1:
+            # Running sum of each byte of the pixel; uint8
+            # arithmetic does the ``& 0xff`` for us.
+            numpy.cumsum(scanlines[y].reshape(-1, fu), axis=0,
+                         dtype=numpy.uint8, out=out.reshape(-1, fu))
         else:
-            header[l[0]] += b' ' + l[1]
-
-    required = [b'WIDTH', b'HEIGHT', b'DEPTH', b'MAXVAL']
-    WIDTH,HEIGHT,DEPTH,MAXVAL = required
-    present = [x for x in required if x in header]
-    if len(present) != len(required):
-        raise Error('PAM file must specify WIDTH, HEIGHT, DEPTH, and MAXVAL')
-    width = int(header[WIDTH])
-    height = int(header[HEIGHT])
-    depth = int(header[DEPTH])
-    maxval = int(header[MAXVAL])
-    if (width <= 0 or
-        height <= 0 or
-        depth <= 0 or
-        maxval <= 0):
-        raise Error(
-          'WIDTH, HEIGHT, DEPTH, MAXVAL must all be positive integers')
-    return 'P7', width, height, depth, maxval
-
-def read_pnm_header(infile, supported=(b'P5', b'P6')):
-    """
-    Read a PNM header, returning (format,width,height,depth,maxval).
-    `width` and `height` are in pixels.  `depth` is the number of
-    channels in the image; for PBM and PGM it is synthesized as 1, for
-    PPM as 3; for PAM images it is read from the header.  `maxval` is
-    synthesized (as 1) for PBM images.
+            numpy.add(scanlines[y], previous, out=out)
+        previous = out
+    return result
+
+def _undo_filters_wavefront(filter_types, scanlines, previous, fu, result):
+    """Undo the filters of a block of scanlines that includes
+    "average" or "paeth" rows.  Those filters predict each byte from
+    its left (a), upper (b) and upper left (c) neighbours, which
+    makes them sequential along a row.  All the pixels on an
+    anti-diagonal of the image are independent of each other though,
+    so the image is swept one anti-diagonal at a time, computing the
+    predictor of every row's filter type with array operations.
     """
 
-    # Generally, see http://netpbm.sourceforge.net/doc/ppm.html
-    # and http://netpbm.sourceforge.net/doc/pam.html
-
-    # Technically 'P7' must be followed by a newline, so by using
-    # rstrip() we are being liberal in what we accept.  I think this
-    # is acceptable.
-    type = infile.read(3).rstrip()
-    if type not in supported:
-        raise NotImplementedError('file format %s not supported' % type)
-    if type == b'P7':
-        # PAM header parsing is completely different.
-        return read_pam_header(infile)
-    # Expected number of tokens in header (3 for P4, 4 for P6)
-    expected = 4
-    pbm = (b'P1', b'P4')
-    if type in pbm:
-        expected = 3
-    header = [type]
-
-    # We have to read the rest of the header byte by byte because the
-    # final whitespace character (immediately following the MAXVAL in
-    # the case of P6) may not be a newline.  Of course all PNM files in
-    # the wild use a newline at this point, so it's tempting to use
-    # readline; but it would be wrong.
-    def getc():
-        c = infile.read(1)
-        if not c:
-            raise Error('premature EOF reading PNM header')
-        return c
+    height, row_bytes = scanlines.shape
+    width = row_bytes // fu
+    # Reconstructed bytes with one row of padding on top (holding
+    # `previous`) and one column of zeros on the left, so that a, b
+    # and c never fall off the edge of the array.
+    recon = numpy.zeros((height+1, width+1, fu), dtype=numpy.int16)
+    recon[0, 1:] = previous.reshape(width, fu)
+    source = scanlines.reshape(height, width, fu)
+    filter_types = filter_types.astype(numpy.intp)[:, None]
+
+    for k in range(height + width - 1):
+        y = numpy.arange(max(0, k-width+1), min(height, k+1))
+        x = k - y
+        a = recon[y+1, x]
+        b = recon[y, x+1]
+        c = recon[y, x]
+        # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+        pa = numpy.abs(b - c)
+        pb = numpy.abs(a - c)
+        pc = numpy.abs(a + b - 2*c)
+        paeth = numpy.where((pa <= pb) & (pa <= pc), a,
+                            numpy.where(pb <= pc, b, c))
+        predictor = numpy.choose(filter_types[y],
+                                 (0, a, b, (a + b) >> 1, paeth))
+        recon[y+1, x+1] = (source[y, x] + predictor) & 0xff
+    result[:] = recon[1:, 1:].reshape(height, row_bytes)
+
+def unpack_numpy(lines, width, planes, bitdepth):
+    """Convert reconstructed scanlines, a ``(height, row_bytes)``
+    ``uint8`` array, into a ``(height, width, planes)`` array of
+    samples.  16-bit samples are decoded from big-endian byte pairs;
+    samples smaller than a byte are unpacked.
+    """
 
-    c = getc()
-    while True:
-        # Skip whitespace that precedes a token.
-        while c.isspace():
-            c = getc()
-        # Skip comments.
-        while c == '#':
-            while c not in b'\n\r':
-                c = getc()
-        if not c.isdigit():
-            raise Error('unexpected character %s found in header' % c)
-        # According to the specification it is legal to have comments
-        # that appear in the middle of a token.
-        # This is bonkers; I've never seen it; and it's a bit awkward to
-        # code good lexers in Python (no goto).  So we break on such
-        # cases.
-        token = b''
-        while c.isdigit():
-            token += c
-            c = getc()
-        # Slight hack.  All "tokens" are decimal integers, so convert
-        # them here.
-        header.append(int(token))
-        if len(header) == expected:
-            break
-    # Skip comments (again)
-    while c == '#':
-        while c not in '\n\r':
-            c = getc()
-    if not c.isspace():
-        raise Error('expected header to end with whitespace, not %s' % c)
-
-    if type in pbm:
-        # synthesize a MAXVAL
-        header.append(1)
-    depth = (1,3)[type == b'P6']
-    return header[0], header[1], header[2], depth, header[3]
-
-def write_pnm(file, width, height, pixels, meta):
-    """Write a Netpbm PNM/PAM file.
+    height = lines.shape[0]
+    if bitdepth == 8:
+        return lines.reshape(height, width, planes)
+    if bitdepth == 16:
+        samples = lines.view('>u2').astype(numpy.uint16)
+        return samples.reshape(height, width, planes)
+    assert bitdepth < 8
+    # Shift every byte right by each sample's offset, most significant
+    # sample first.
+    shifts = numpy.arange(8-bitdepth, -1, -bitdepth, dtype=numpy.uint8)
+    samples = (lines[:, :, None] >> shifts) & (2**bitdepth - 1)
+    samples = samples.reshape(height, -1)[:, :width*planes]
+    return samples.reshape(height, width, planes)
+
+def filter_rows_numpy(lines, previous, fo, filter_type, out=None):
+    """Apply scanline filters to a block of scanlines; the array
+    counterpart of :func:`filter_scanline`.  `lines` is a ``(height,
+    row_bytes)`` ``uint8`` array of unfiltered scanlines; `previous` is
+    the unfiltered scanline that precedes the first one, or ``None``
+    at the start of an image (or a pass).  `fo` is the filter offset.
+    `filter_type` is 0 to 4, or ``'adaptive'`` to choose the filter
+    with the smallest sum of absolute (signed) values separately for
+    each scanline, as libpng does.
+    Returns a ``(height, row_bytes+1)`` ``uint8`` array: each row is
+    a filter type byte followed by the filtered scanline.  When `out`
+    is given (an array with at least `height` rows of the right
+    width) the result is written into it.
     """
 
-    bitdepth = meta['bitdepth']
-    maxval = 2**bitdepth - 1
-    # Rudely, the number of image planes can be used to determine
-    # whether we are L (PGM), LA (PAM), RGB (PPM), or RGBA (PAM).
-    planes = meta['planes']
-    # Can be an assert as long as we assume that pixels and meta came
-    # from a PNG file.
-    assert planes in (1,2,3,4)
-    if planes in (1,3):
-        if 1 == planes:
-            # PGM
-            # Could generate PBM if maxval is 1, but we don't (for one
-            # thing, we'd have to convert the data, not just blat it
-            # out).
-            fmt = 'P5'
-        else:
-            # PPM
-            fmt = 'P6'
-        header = '%s %d %d %d\n' % (fmt, width, height, maxval)
-    if planes in (2,4):
-        # PAM
-        # See http://netpbm.sourceforge.net/doc/pam.html
-        if 2 == planes:
-            tupltype = 'GRAYSCALE_ALPHA'
+    height, row_bytes = lines.shape
+    if out is None:
+        out = numpy.empty((height, row_bytes+1), dtype=numpy.uint8)
+    out = out[:height]
+    if filter_type == 0:
+        out[:, 0] = 0
+        out[:, 1:] = lines
+        return out
+
+    # The bytes to the left (a), above (b), and above left (c) of
+    # each byte; zero when off the edge of the image.
+    x = lines.astype(numpy.int16)
+    b = numpy.empty_like(x)
+    b[1:] = x[:-1]
+    b[0] = 0 if previous is None else previous
+    a = numpy.zeros_like(x)
+    a[:, fo:] = x[:, :-fo]
+    c = numpy.zeros_like(x)
+    c[:, fo:] = b[:, :-fo]
+
+    def filtered(type):
+        if type == 0:
+            predictor = 0
+        elif type == 1:
+            predictor = a
+        elif type == 2:
+            predictor = b
+        elif type == 3:
+            predictor = (a + b) >> 1
         else:
-            tupltype = 'RGB_ALPHA'
-        header = ('P7\nWIDTH %d\nHEIGHT %d\nDEPTH %d\nMAXVAL %d\n'
-                  'TUPLTYPE %s\nENDHDR\n' %
-                  (width, height, planes, maxval, tupltype))
-    file.write(header.encode('ascii'))
-    # Values per row
-    vpr = planes * width
-    # struct format
-    fmt = '>%d' % vpr
-    if maxval > 0xff:
-        fmt = fmt + 'H'
-    else:
-        fmt = fmt + 'B'
-    for row in pixels:
-        file.write(struct.pack(fmt, *row))
-    file.flush()
+            # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+            pa = numpy.abs(b - c)
+            pb = numpy.abs(a - c)
+            pc = numpy.abs(a + b - 2*c)
+            predictor = numpy.where((pa <= pb) & (pa <= pc), a,
+                                    numpy.where(pb <= pc, b, c))
+        return ((x - predictor) & 0xff).astype(numpy.uint8)
+
+    if filter_type != 'adaptive':
+        out[:, 0] = filter_type
+        out[:, 1:] = filtered(filter_type)
+        return out
 
-def color_triple(color):
-    """
-    Convert a command line colour value to a RGB triple of integers.
-    FIXME: Somewhere we need support for greyscale backgrounds etc.
-    """
-    if color.startswith('#') and len(color) == 4:
-        return (int(color[1], 16),
-                int(color[2], 16),
-                int(color[3], 16))
-    if color.startswith('#') and len(color) == 7:
-        return (int(color[1:3], 16),
-                int(color[3:5], 16),
-                int(color[5:7], 16))
-    elif color.startswith('#') and len(color) == 13:
-        return (int(color[1:5], 16),
-                int(color[5:9], 16),
-                int(color[9:13], 16))
-
-def _add_common_options(parser):
-    """Call *parser.add_option* for each of the options that are
-    common between this PNG--PNM conversion tool and the gen
-    tool.
-    """
-    parser.add_option("-i", "--interlace",
-                      default=False, action="store_true",
-                      help="create an interlaced PNG file (Adam7)")
-    parser.add_option("-t", "--transparent",
-                      action="store", type="string", metavar="#RRGGBB",
-                      help="mark the specified colour as transparent")
-    parser.add_option("-b", "--background",
-                      action="store", type="string", metavar="#RRGGBB",
-                      help="save the specified background colour")
-    parser.add_option("-g", "--gamma",
-                      action="store", type="float", metavar="value",
-                      help="save the specified gamma value")
-    parser.add_option("-c", "--compression",
-                      action="store", type="int", metavar="level",
-                      help="zlib compression level (0-9)")
-    return parser
-
-def _main(argv):
-    """
-    Run the PNG encoder with options from the command line.
+    candidates = numpy.stack([filtered(type) for type in range(5)])
+    cost = numpy.abs(candidates.view(numpy.int8).astype(numpy.int16))
+    best = cost.sum(axis=2).argmin(axis=0)
+    out[:, 0] = best
+    out[:, 1:] = candidates[best, numpy.arange(height)]
+    return out
+
+def pack_numpy(samples, bitdepth):
+    """The inverse of :func:`unpack_numpy`.  Convert a
+    ``(height, values)`` array of samples into a ``(height,
+    row_bytes)`` ``uint8`` array of scanline bytes (without the
+    filter type byte).
     """
 
-    # Parse command line arguments
-    from optparse import OptionParser
-    version = '%prog ' + __version__
-    parser = OptionParser(version=version)
-    parser.set_usage("%prog [options] [imagefile]")
-    parser.add_option('-r', '--read-png', default=False,
-                      action='store_true',
-                      help='Read PNG, write PNM')
-    parser.add_option("-a", "--alpha",
-                      action="store", type="string", metavar="pgmfile",
-                      help="alpha channel transparency (RGBA)")
-    _add_common_options(parser)
-
-    (options, args) = parser.parse_args(args=argv[1:])
-
-    # Convert options
-    if options.transparent is not None:
-        options.transparent = color_triple(options.transparent)
-    if options.background is not None:
-        options.background = color_triple(options.background)
-
-    # Prepare input and output files
-    if len(args) == 0:
-        infilename = '-'
-        infile = sys.stdin
-    elif len(args) == 1:
-        infilename = args[0]
-        infile = open(infilename, 'rb')
-    else:
-        parser.error("more than one input file")
-    outfile = sys.stdout
-    if sys.platform == "win32":
-        import msvcrt, os
-        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
-
-    if options.read_png:
-        # Encode PNG to PPM
-        png = Reader(file=infile)
-        width,height,pixels,meta = png.asDirect()
-        write_pnm(outfile, width, height, pixels, meta) 
-    else:
-        # Encode PNM to PNG
-        format, width, height, depth, maxval = \
-          read_pnm_header(infile, (b'P5',b'P6',b'P7'))
-        # When it comes to the variety of input formats, we do something
-        # rather rude.  Observe that L, LA, RGB, RGBA are the 4 colour
-        # types supported by PNG and that they correspond to 1, 2, 3, 4
-        # channels respectively.  So we use the number of channels in
-        # the source image to determine which one we have.  We do not
-        # care about TUPLTYPE.
-        greyscale = depth <= 2
-        pamalpha = depth in (2,4)
-        supported = [2**x-1 for x in range(1,17)]
-        try:
-            mi = supported.index(maxval)
-        except ValueError:
-            raise NotImplementedError(
-              'your maxval (%s) not in supported list %s' %
-              (maxval, str(supported)))
-        bitdepth = mi+1
-        writer = Writer(width, height,
-                        greyscale=greyscale,
-                        bitdepth=bitdepth,
-                        interlace=options.interlace,
-                        transparent=options.transparent,
-                        background=options.background,
-                        alpha=bool(pamalpha or options.alpha),
-                        gamma=options.gamma,
-                        compression=options.compression)
-        if options.alpha:
-            pgmfile = open(options.alpha, 'rb')
-            format, awidth, aheight, adepth, amaxval = \
-              read_pnm_header(pgmfile, 'P5')
-            if amaxval != '255':
-                raise NotImplementedError(
-                  'maxval %s not supported for alpha channel' % amaxval)
-            if (awidth, aheight) != (width, height):
-                raise ValueError("alpha channel image size mismatch"
-                                 " (%s has %sx%s but %s has %sx%s)"
-                                 % (infilename, width, height,
-                                    options.alpha, awidth, aheight))
-            writer.convert_ppm_and_pgm(infile, pgmfile, outfile)
-        else:
-            writer.convert_pnm(infile, outfile)
+    if bitdepth == 8:
+        return samples.astype(numpy.uint8, copy=False)
+    if bitdepth == 16:
+        return samples.astype('>u2').view(numpy.uint8)
+    assert bitdepth < 8
+    height, values = samples.shape
+    # Samples per byte
+    spb = 8 // bitdepth
+    padded = numpy.zeros((height, -(-values // spb) * spb), dtype=numpy.uint8)
+    padded[:, :values] = samples
+    shifts = numpy.arange(8-bitdepth, -1, -bitdepth, dtype=numpy.uint8)
+    padded = padded.reshape(height, -1, spb) << shifts
+    return numpy.bitwise_or.reduce(padded, axis=2)
+
+
+# === Command Line Support ===
+
+# The PNM/PAM conversion functions and the command line tool live in
+# the :mod:`pngcli` module, which is only imported when one of them is
+# used, so that programs that just read and write PNG files don't pay
+# for loading them.
+_cli_names = ('read_pam_header', 'read_pnm_header', 'write_pnm',
+              'color_triple', '_add_common_options', '_main')
+
+def __getattr__(name):
+    if name in _cli_names:
+        import pngcli
+        return getattr(pngcli, name)
+    if name == 'RegexModeDecode':
+        import re
+        return re.compile(_mode_pattern, flags=re.IGNORECASE)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 if __name__ == '__main__':
+    # pngcli imports this file again as the ``png`` module, so its
+    # errors are instances of that module's Error class.
+    import pngcli
     try:
-        _main(sys.argv)
-    except Error as e:
+        pngcli._main(sys.argv)
+    except pngcli.Error as e:
         print(e, file=sys.stderr)
@@ -0,0 +1,143 @@
+"""
+Resizing
+
+Makes bigger or smaller copies of an Image, with one of four filters:
+
+    nearest     each new pixel is the old pixel under its center (fastest, but blocky and jagged)
+    bilinear    a weighted average of the nearest old pixels (smooth)
+    area        the average of the old pixels the new pixel covers (best for shrinking, like Image.level)
+    lanczos     a windowed sinc over 3 pixels on each side (sharpest, for shrinking and enlarging)
+
+When shrinking, bilinear and lanczos widen to cover all the old pixels under each new one, so that small
+details average out instead of turning into jaggies.
+
+Resizing is done one axis at a time: each new row is a weighted sum of a few old rows, and then each
+new column is a weighted sum of a few of those columns. Which old rows and how much of each only depend
+on the old size, the new size and the filter, so we work them out once as two small tables (the indices
+of the old rows, and their weights, for every new row) and keep them, so resizing thousands of images of
+the same size only computes them once. Applying a table is one gather (np.take) of the old rows and one
+multiply-add per table column, into buffers allocated once.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from image import Image, compute_dtype, to_dtype
+from transform import cached
+
+filters = ('nearest', 'bilinear', 'area', 'lanczos')
+
+
+def lanczos(x, a=3):
+    # the lanczos kernel: sinc(x) * sinc(x / a) for |x| < a, 0 outside
+    return np.where(np.abs(x) < a, np.sinc(x) * np.sinc(x / a), 0.0)
+
+
+def triangle(x):
+    return np.maximum(0.0, 1 - np.abs(x))
+
+
+@lru_cache(maxsize=None)
+def weights(source_size, size, filter):
+    # returns (indices, weights), each (size, taps): new pixel i is the sum over t of weights[i, t] times old
+    # pixel indices[i, t]
+    # pixel j covers [j, j + 1) in old pixel coordinates, so new pixel i covers [i * scale, (i + 1) * scale)
+    if filter not in filters:
+        raise ValueError('unknown filter %r (known filters: %s)' % (filter, ', '.join(filters)))
+    scale = source_size / size
+    centers = (np.arange(size) + 0.5) * scale
+    if filter == 'nearest':
+        indices = np.minimum(np.floor(centers).astype(np.intp), source_size - 1)[:, None]
+        return indices, np.ones((size, 1))
+    if filter == 'area':
+        # how much of each old pixel the new one covers
+        start = np.arange(size) * scale
+        first = np.floor(start)
+        indices = first[:, None] + np.arange(int(np.ceil(scale)) + 1)
+        overlap = np.minimum(start[:, None] + scale, indices + 1) - np.maximum(start[:, None], indices)
+        table = np.maximum(overlap, 0)
+    else:
+        kernel, radius = (triangle, 1) if filter == 'bilinear' else (lanczos, 3)
+        stretch = max(scale, 1.0)  # when shrinking, the kernel covers all the old pixels under the new one
+        support = radius * stretch
+        first = np.floor(centers - support)
+        indices = first[:, None] + np.arange(int(np.ceil(2 * support)) + 1)
+        table = kernel((indices + 0.5 - centers[:, None]) / stretch)
+    # past the edges we repeat the edge pixels, and the weights always add up to 1 (so flat images stay flat)
+    indices = np.clip(indices, 0, source_size - 1).astype(np.intp)
+    table = table / table.sum(axis=1, keepdims=True)
+    # drop the taps that are 0 for every new pixel (the kernels are 0 at their ends, which often lands on a pixel)
+    used = (table != 0).any(axis=0)
+    return indices[:, used], table[:, used]
+
+
+def resize_axis(array, size, filter, axis):
+    # resizes a floating point array along one axis (0 or 1) to size pixels
+    indices, table = weights(array.shape[axis], size, filter)
+    table = table.astype(array.dtype)
+    if axis == 0:
+        table = table[:, None, None, :]
+    else:
+        # one weight per value in a row, so that multiplying a row by them goes straight along it
+        table = np.repeat(table[None, :, None, :], array.shape[2], axis=2)
+    shape = list(array.shape)
+    shape[axis] = size
+    result = np.empty(shape, dtype=array.dtype)
+    # we go a block of new rows at a time (about 1 MB), so that term stays in the CPU cache
+    block_rows = max(1, 2**17 // (shape[1] * shape[2]))
+    term = np.empty([block_rows] + shape[1:], dtype=array.dtype)
+    for start in range(0, shape[0], block_rows):
+        out = result[start:start + block_rows]
+        part = term[:len(out)]
+        if axis == 0:
+            source, taps, tap_weights = array, indices[start:start + block_rows], table[start:start + block_rows]
+        else:
+            source, taps, tap_weights = array[start:start + block_rows], indices, table
+        for t in range(taps.shape[1]):
+            # the old rows (or columns) for this tap of every new one at once, times their weights
+            # (the indices are all in range already, and mode='clip' lets np.take write straight into part)
+            np.take(source, taps[:, t], axis=axis, out=part if t else out, mode='clip')
+            if t:
+                part *= tap_weights[..., t]
+                out += part
+            else:
+                out *= tap_weights[..., t]
+    return result
+
+
+@cached
+def resize(image, x_pixels, y_pixels, filter='bilinear'):
+    # returns a new image x_pixels tall and y_pixels wide (like the Image constructor), with the same dtype
+    old_x, old_y, num_channels = image.array.shape
+    if x_pixels < 1 or y_pixels < 1:
+        raise ValueError('the new size should be at least 1x1, not %rx%r' % (x_pixels, y_pixels))
+    array = image.array.astype(compute_dtype(image.array.dtype), copy=False)
+    # do the axis first that makes the in-between image smaller, if that's less work
+    # (work = pixels computed times taps per pixel)
+    taps_x = weights(old_x, x_pixels, filter)[0].shape[1]
+    taps_y = weights(old_y, y_pixels, filter)[0].shape[1]
+    x_first = x_pixels * old_y * taps_x + x_pixels * y_pixels * taps_y
+    y_first = old_x * y_pixels * taps_y + x_pixels * y_pixels * taps_x
+    if x_first <= y_first:
+        array = resize_axis(resize_axis(array, x_pixels, filter, axis=0), y_pixels, filter, axis=1)
+    else:
+        array = resize_axis(resize_axis(array, y_pixels, filter, axis=1), x_pixels, filter, axis=0)
+    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=image.array.dtype)
+    new_im.array = to_dtype(array, image.array.dtype)
+    return new_im
+
+
+def thumbnail(image, max_size, filter='area'):
+    # shrinks the image (keeping its shape) so that it's at most max_size pixels tall and wide
+    x_pixels, y_pixels = image.array.shape[0], image.array.shape[1]
+    factor = min(1.0, max_size / max(x_pixels, y_pixels))
+    return resize(image, max(1, round(x_pixels * factor)), max(1, round(y_pixels * factor)), filter)
+
+
+if __name__ == '__main__':
+    lake = Image(filename='lake.png')
+    for filter in filters:
+        # a quarter size copy, and one twice as big
+        resize(lake, lake.x_pixels // 4, lake.y_pixels // 4, filter).write_image('lake_small_%s.png' % filter)
+        resize(lake, lake.x_pixels * 2, lake.y_pixels * 2, filter).write_image('lake_big_%s.png' % filter)
+    thumbnail(lake, 128).write_image('lake_thumbnail.png')
@@ -0,0 +1,181 @@
+"""
+Streaming Image Processing
+
+An ImageStream is an image that never holds all of its pixels at once: it can produce any
+horizontal strip of its rows when asked for them. Streams are built from a PNG file (open_image)
+and from each other with the same operations as transform.py, and only do any work when the
+result is written out with write_image, one strip at a time. Operations that look at neighboring
+pixels (blur, apply_kernel) ask their input for a few extra rows (a "halo") above and below each
+strip, so the results are exactly the same as running transform.py on the whole image, but the
+peak memory use depends on the strip size instead of the image size.
+"""
+
+import time
+
+import histogram
+import numpy as np
+import png
+import transform
+from image import Image, decode_pixels, encode_pixels, png_writer
+
+
+class ImageStream:
+    def __init__(self, x_pixels, y_pixels, num_channels, dtype=np.float64):
+        # like Image, x_pixels is the number of rows and y_pixels the number of columns
+        self.x_pixels = x_pixels
+        self.y_pixels = y_pixels
+        self.num_channels = num_channels
+        self.dtype = np.dtype(dtype)
+        # rows that have been produced but may still be asked for again
+        self.buffer = np.zeros((0, y_pixels, num_channels), dtype=dtype)
+        self.buffer_start = 0
+        # for each consumer of this stream, the first row it may still ask for
+        self.marks = []
+        # how long this stream has spent computing its rows (not counting its inputs)
+        self.seconds = 0.0
+
+    def add_consumer(self):
+        # every stream (or writer) reading from this one registers itself, so that we know
+        # which rows we can forget about
+        self.marks.append(0)
+        return len(self.marks) - 1
+
+    def release(self, consumer, row):
+        # the consumer promises never to ask for rows before `row` again
+        self.marks[consumer] = row
+
+    def read_rows(self, start, stop):
+        # returns rows start to stop (not included) as a (rows, y_pixels, num_channels) array
+        # rows must be asked for in order, ie start should never go back past a released row
+        stop = min(stop, self.x_pixels)
+        if start < self.buffer_start:
+            raise ValueError('rows before %d have already been dropped' % self.buffer_start)
+        buffer_stop = self.buffer_start + len(self.buffer)
+        if stop > buffer_stop:
+            new_rows = self.compute_rows(buffer_stop, stop)
+            # forget the rows nobody needs anymore before adding the new ones
+            keep = max(0, min(self.marks + [start]) - self.buffer_start)
+            self.buffer = np.concatenate((self.buffer[keep:], new_rows))
+            self.buffer_start += keep
+        return self.buffer[start - self.buffer_start:stop - self.buffer_start]
+
+    def compute_rows(self, start, stop):
+        # produce rows start to stop; streams only ever compute each row once, top to bottom
+        raise NotImplementedError
+
+    def strips(self, strip_size):
+        # yields the whole image as consecutive arrays of (at most) strip_size rows
+        consumer = self.add_consumer()
+        for start in range(0, self.x_pixels, strip_size):
+            strip = self.read_rows(start, start + strip_size)
+            self.release(consumer, start + strip_size)
+            yield strip
+
+    def to_image(self, strip_size=64):
+        # materialize the whole stream as a regular Image
+        im = Image(x_pixels=self.x_pixels, y_pixels=self.y_pixels, num_channels=self.num_channels, dtype=self.dtype)
+        im.array = np.concatenate(list(self.strips(strip_size)))
+        return im
+
+    def write_image(self, output_file_name, gamma=2.2, strip_size=64, filter_type=0, output_path='output/'):
+        # same as Image.write_image, but the image is computed and written strip_size rows at a time
+        def encoded():
+            for strip in self.strips(strip_size):
+                yield encode_pixels(strip, gamma)
+        writer = png_writer(self.x_pixels, self.y_pixels, self.num_channels, filter_type=filter_type)
+        with open(output_path + output_file_name, 'wb') as f:
+            writer.write_strips(f, encoded())
+
+
+class FileStream(ImageStream):
+    # a PNG file, decoded lazily (a block of rows at a time) as the rows are asked for
+    def __init__(self, filename, gamma=2.2, input_path='input/', dtype=np.float64):
+        width, height, blocks, meta = png.Reader(input_path + filename).iter_asarray()
+        super().__init__(height, width, meta['planes'], dtype)
+        self.blocks = blocks
+        self.bitdepth = meta['bitdepth']
+        self.gamma = gamma
+        self.decoded = np.zeros((0, width, meta['planes']), dtype=np.uint8)
+
+    def compute_rows(self, start, stop):
+        # decode blocks until we have enough rows, keeping the rest for next time
+        started = time.perf_counter()
+        while len(self.decoded) < stop - start:
+            self.decoded = np.concatenate((self.decoded, next(self.blocks)))
+        pixels, self.decoded = self.decoded[:stop - start], self.decoded[stop - start:]
+        # same conversion as Image.read_image
+        rows = decode_pixels(pixels, self.bitdepth, self.gamma, self.dtype)
+        self.seconds += time.perf_counter() - started
+        return rows
+
+
+class TransformStream(ImageStream):
+    # the result of calling one of the transform.py functions on some input streams
+    def __init__(self, function, inputs, halo=0, output_dtype=None, **params):
+        # halo is how many rows above and below a pixel the function looks at
+        # output_dtype is the dtype of the function's results, if it isn't the same as the first input's
+        first = inputs[0]
+        super().__init__(first.x_pixels, first.y_pixels, first.num_channels,
+                         first.dtype if output_dtype is None else output_dtype)
+        # each strip is called on the undecorated function, so strips aren't saved in the result cache (see transform.cached)
+        self.function = getattr(function, '__wrapped__', function)
+        self.inputs = [(stream, stream.add_consumer()) for stream in inputs]
+        self.halo = halo
+        self.params = params
+
+    def compute_rows(self, start, stop):
+        # ask the inputs for the rows we need, including the halo (unless we're at the edge
+        # of the image, in which case the function sees the edge just like on the whole image)
+        halo_start = max(0, start - self.halo)
+        halo_stop = min(self.x_pixels, stop + self.halo)
+        strips = []
+        for stream, consumer in self.inputs:
+            im = Image(x_pixels=halo_stop - halo_start, y_pixels=self.y_pixels, num_channels=stream.num_channels, dtype=stream.dtype)
+            im.array = stream.read_rows(halo_start, halo_stop)
+            strips.append(im)
+            # next time we'll start at stop, so we'll never need anything before stop - halo
+            stream.release(consumer, stop - self.halo)
+        started = time.perf_counter()
+        result = self.function(*strips, **self.params)
+        self.seconds += time.perf_counter() - started
+        # throw away the halo rows of the result
+        return result.array[start - halo_start:stop - halo_start]
+
+
+def open_image(filename, gamma=2.2, input_path='input/', dtype=np.float64):
+    return FileStream(filename, gamma=gamma, input_path=input_path, dtype=dtype)
+
+def brighten(stream, factor):
+    return TransformStream(transform.brighten, [stream], factor=factor)
+
+def adjust_contrast(stream, factor, mid):
+    return TransformStream(transform.adjust_contrast, [stream], factor=factor, mid=mid)
+
+def blur(stream, kernel_size):
+    return TransformStream(transform.blur, [stream], halo=kernel_size // 2, kernel_size=kernel_size)
+
+def apply_kernel(stream, kernel, dtype=None):
+    return TransformStream(transform.apply_kernel, [stream], halo=kernel.shape[0] // 2, output_dtype=dtype, kernel=kernel,
+                           dtype=dtype)
+
+def combine_images(stream1, stream2):
+    return TransformStream(transform.combine_images, [stream1, stream2])
+
+def sobel_magnitude(stream, dtype=None):
+    return TransformStream(transform.sobel_magnitude, [stream], halo=1, output_dtype=dtype, dtype=dtype)
+
+def auto_contrast(stream, statistics, cutoff=0.5, per_channel=False):
+    # statistics are for the whole image (see histogram.stream_statistics), since each strip only sees its own rows
+    return TransformStream(histogram.auto_contrast, [stream], cutoff=cutoff, per_channel=per_channel,
+                           statistics=statistics)
+
+def equalize(stream, statistics):
+    return TransformStream(histogram.equalize, [stream], statistics=statistics)
+
+
+if __name__ == '__main__':
+    # the edge detector from transform.py, 32 rows at a time
+    city = open_image('city.png')
+    sobel_x = apply_kernel(city, np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]]))
+    sobel_y = apply_kernel(city, np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]]))
+    combine_images(sobel_x, sobel_y).write_image('edge_xy.png', strip_size=32)
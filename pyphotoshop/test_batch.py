@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import batch
+import png
+import pytest
+import stream
+
+
+def write_test_pngs(path):
+    np.random.seed(0)
+    for name in ('a.png', 'b.png', 'c.png'):
+        pixels = np.random.randint(0, 256, (21, 8, 3)).astype(np.uint8)
+        with open(str(path / name), 'wb') as f:
+            png.Writer(8, 21).write_ndarray(f, pixels)
+
+
+def test_parse_pipeline():
+    assert batch.parse_pipeline('blur:15,sobel,combine') == [('blur', [15.0]), ('sobel', []), ('combine', [])]
+    assert batch.parse_pipeline('blur:3,edges') == [('blur', [3.0]), ('edges', [])]
+    assert batch.parse_pipeline('contrast:2:0.4, brighten:1.5') == [('contrast', [2.0, 0.4]), ('brighten', [1.5])]
+    for spec in ('sharpen', 'blur', 'blur:2.5', 'brighten:x', 'combine', 'sobel', 'sobel,combine,combine'):
+        with pytest.raises(ValueError):
+            batch.parse_pipeline(spec)
+
+
+def test_batch_matches_stream(tmp_path):
+    write_test_pngs(tmp_path)
+    output_dir = str(tmp_path / 'out')
+    lines = []
+    pipeline = batch.parse_pipeline('blur:3,sobel,combine,brighten:1.5')
+    totals, failed = batch.run(batch.find_files(str(tmp_path)), output_dir, pipeline, workers=2, max_in_flight=1,
+                               strip_size=5, report=lines.append)
+    assert failed == []
+    assert sorted(totals) == ['blur', 'brighten', 'combine', 'decode', 'encode', 'sobel']
+    assert len(lines) == 3 + 1 + len(totals)
+    for name in ('a.png', 'b.png', 'c.png'):
+        source = stream.open_image(name, input_path=str(tmp_path) + '/')
+        edges = stream.apply_kernel(stream.blur(source, 3), batch.sobel_x), stream.apply_kernel(stream.blur(source, 3), batch.sobel_y)
+        stream.brighten(stream.combine_images(*edges), 1.5).write_image(name, strip_size=5, output_path=str(tmp_path) + '/')
+        expected = png.Reader(str(tmp_path / name)).read_numpy()[2]
+        assert (png.Reader(os.path.join(output_dir, name)).read_numpy()[2] == expected).all()
+
+
+def test_batch_keeps_going(tmp_path):
+    # a corrupt file is reported and skipped, and files with the same name in different directories both get written
+    for directory in ('one', 'two'):
+        os.makedirs(str(tmp_path / directory))
+        write_test_pngs(tmp_path / directory)
+    with open(str(tmp_path / 'one' / 'bad.png'), 'wb') as f:
+        f.write(b'not a png')
+    files = batch.find_files(str(tmp_path / '*' / '*.png'))
+    names = ['one/a.png', 'one/b.png', 'one/bad.png', 'one/c.png', 'two/a.png', 'two/b.png', 'two/c.png']
+    assert batch.output_names(files) == [os.path.join(*name.split('/')) for name in names]
+    output_dir = str(tmp_path / 'out')
+    lines = []
+    totals, failed = batch.run(files, output_dir, batch.parse_pipeline('edges'), workers=2, report=lines.append)
+    assert [input_file for input_file, error in failed] == [str(tmp_path / 'one' / 'bad.png')]
+    assert '1 images failed' in lines
+    assert sorted(os.listdir(os.path.join(output_dir, 'one'))) == ['a.png', 'b.png', 'c.png']
+    assert sorted(os.listdir(os.path.join(output_dir, 'two'))) == ['a.png', 'b.png', 'c.png']
+    assert batch.main([str(tmp_path / '*' / '*.png'), '--pipeline', 'edges', '--output', output_dir, '--workers', '1']) == 1
+    assert batch.main([str(tmp_path / 'two'), '--pipeline', 'edges', '--output', output_dir, '--workers', '1']) == 0
@@ -0,0 +1,30 @@
+import json
+
+import benchmark
+import png
+
+
+def test_synthetic_pngs_round_trip():
+    for bitdepth, planes in ((8, 3), (16, 4)):
+        pixels = benchmark.synthetic_pixels(17, 11, planes, bitdepth)
+        for interlace in (False, True):
+            data = benchmark.encode(pixels, bitdepth, interlace=interlace)
+            assert (png.Reader(bytes=data).asarray()[2] == pixels).all()
+
+
+def test_results_and_compare(tmp_path):
+    output = str(tmp_path / 'results.json')
+    assert benchmark.main(['--quick', '--select', 'brighten/64', '--repeat', '1', '--output', output]) == 0
+    with open(output) as f:
+        results = json.load(f)
+    assert list(results['results']) == ['transform/brighten/64']
+    slower = dict(results, results={'transform/brighten/64': dict(results['results']['transform/brighten/64'], best=1e-12)})
+    assert benchmark.compare(results, results, report=lambda line: None) == []
+    assert benchmark.compare(slower, results, report=lambda line: None) == ['transform/brighten/64']
+
+
+def test_import_time():
+    results = benchmark.run(select='import/png', repeat=1, report=lambda line: None)
+    assert list(results['results']) == ['import/png']
+    # the numbers themselves are for --compare to judge (test_png.test_import_is_lazy checks what png imports)
+    assert results['results']['import/png']['best'] > 0
@@ -0,0 +1,126 @@
+import os
+import time
+
+import numpy as np
+import cache
+import parallel
+import png
+import pytest
+import stream
+import transform
+from image import Image
+
+
+@pytest.fixture
+def result_cache(tmp_path):
+    yield cache.enable(str(tmp_path / 'cache'), max_bytes=10**6)
+    cache.disable()
+
+
+def random_image(seed):
+    np.random.seed(seed)
+    im = Image(x_pixels=20, y_pixels=15, num_channels=3)
+    im.array = np.random.rand(20, 15, 3)
+    return im
+
+
+def test_keys():
+    store = cache.Cache.__new__(cache.Cache)
+    a = np.arange(6)
+    assert store.key('blur', a, 3) == store.key('blur', a.copy(), 3)
+    assert store.key('blur', a, 3) != store.key('blur', a, 5)
+    assert store.key('blur', a, 3) != store.key('blur', a.astype(np.int32), 3)
+    assert store.key('blur', a, 3) != store.key('blur', a.reshape(2, 3), 3)
+    assert store.key('ab', 'c') != store.key('a', 'bc')
+
+
+def test_transform_results_are_cached(result_cache, monkeypatch):
+    im = random_image(0)
+    sobel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+    expected = transform.apply_kernel(im, sobel).array
+    # the second time, the result comes from the cache, without running the kernel
+    monkeypatch.setattr(transform, 'correlate', None)
+    result = transform.apply_kernel(im, kernel=sobel)
+    assert (result.array == expected).all()
+    # a different kernel or image isn't a hit
+    with pytest.raises(TypeError):
+        transform.apply_kernel(im, sobel.T)
+    with pytest.raises(TypeError):
+        transform.apply_kernel(random_image(1), sobel)
+    # changing the cached result doesn't change the cache
+    result.array[...] = 0
+    assert (transform.apply_kernel(im, sobel).array == expected).all()
+
+
+def test_in_place_results_are_not_cached(result_cache):
+    im = random_image(0)
+    expected = transform.adjust_contrast(im, 2, 0.5).array
+    transform.adjust_contrast_in_place(im, 2, 0.5)
+    assert (im.array == expected).all()
+    assert len(result_cache.entries()) == 1
+
+
+def test_read_image_is_cached(result_cache, tmp_path):
+    np.random.seed(0)
+    pixels = np.random.randint(0, 256, (9, 7, 3)).astype(np.uint8)
+    with open(str(tmp_path / 'small.png'), 'wb') as f:
+        png.Writer(7, 9).write_ndarray(f, pixels)
+    im = Image.__new__(Image)
+    im.input_path = str(tmp_path) + '/'
+    first = im.read_image('small.png')
+    second = im.read_image('small.png')
+    assert (first == second).all()
+    assert [os.path.basename(path) for used, size, path in result_cache.entries()] == [
+        result_cache.key('read_image', open(str(tmp_path / 'small.png'), 'rb').read(), 2.2, np.dtype(np.float64)) + '.npy']
+
+
+def test_strips_and_tiles_are_not_cached(result_cache, tmp_path):
+    np.random.seed(1)
+    pixels = np.random.randint(0, 256, (40, 7, 3)).astype(np.uint8)
+    with open(str(tmp_path / 'small.png'), 'wb') as f:
+        png.Writer(7, 40).write_ndarray(f, pixels)
+    # a stream computes its strips with the undecorated transforms, so nothing is saved
+    source = stream.open_image('small.png', input_path=str(tmp_path) + '/')
+    stream.blur(stream.brighten(source, 1.5), 3).to_image(strip_size=4)
+    assert result_cache.entries() == []
+    # parallel.run saves the whole result once, not a result for each tile
+    im = random_image(2)
+    parallel.shutdown()
+    result = parallel.blur(im, 3, workers=2)
+    assert len(result_cache.entries()) == 1
+    assert (parallel.blur(im, 3, workers=2).array == result.array).all()
+    # which is the same entry transform.blur uses
+    assert (transform.blur(im, 3).array == result.array).all()
+    assert len(result_cache.entries()) == 1
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    store = cache.Cache(str(tmp_path), max_bytes=3500)
+    arrays = [np.full(100, i, dtype=np.float64) for i in range(4)]  # about 1 kB each on disk
+    for i in range(3):
+        store.put(str(i), arrays[i])
+        time.sleep(0.01)
+    # using 0 makes 1 the least recently used
+    assert (store.get('0') == arrays[0]).all()
+    time.sleep(0.01)
+    store.put('3', arrays[3])
+    assert store.get('1') is None
+    for i in (0, 2, 3):
+        assert (store.get(str(i)) == arrays[i]).all()
+    assert store.size() <= 3500
+
+
+def test_size_is_kept_without_scanning(tmp_path, monkeypatch):
+    store = cache.Cache(str(tmp_path), max_bytes=10**6)
+    store.put('a', np.zeros(100))
+    store.put('b', np.zeros(200))
+    # replacing a result doesn't count it twice
+    store.put('a', np.zeros(50))
+    assert store.total == store.size()
+    # and while the cache fits in max_bytes, put doesn't look at the directory
+    monkeypatch.setattr(store, 'entries', None)
+    store.put('c', np.zeros(10))
+    monkeypatch.undo()
+    assert store.total == store.size()
+    # a new Cache on the same directory starts from what's there
+    assert cache.Cache(str(tmp_path)).total == store.total
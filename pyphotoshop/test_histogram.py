@@ -0,0 +1,143 @@
+import numpy as np
+import histogram
+import png
+import stream
+import transform
+from image import Image
+
+
+def random_image(dtype, shape=(21, 13, 3)):
+    im = Image(x_pixels=shape[0], y_pixels=shape[1], num_channels=shape[2], dtype=dtype)
+    if np.dtype(dtype).kind == 'f':
+        im.array = np.random.beta(2, 5, shape).astype(dtype)
+    else:
+        top = np.iinfo(dtype).max
+        im.array = (np.random.beta(2, 5, shape) * top).astype(dtype)
+    return im
+
+
+def test_statistics_match_numpy():
+    np.random.seed(0)
+    for dtype in (np.uint8, np.uint16):
+        im = random_image(dtype)
+        statistics = histogram.compute(im)
+        values = im.array.reshape(-1, 3)
+        for c in range(3):
+            assert (statistics.histogram[c] == np.bincount(values[:, c], minlength=statistics.bins)).all()
+        assert (statistics.minimum == values.min(axis=0)).all()
+        assert (statistics.maximum == values.max(axis=0)).all()
+        assert np.allclose(statistics.mean(), values.mean(axis=0))
+        for q in (0, 1, 25, 50, 99.5, 100):
+            # integer images have a bin per value, so the percentiles are exact
+            assert (statistics.percentile(q) == np.percentile(values, q, axis=0, method='inverted_cdf')).all()
+        assert statistics.percentile(50, channels='all') == np.percentile(values, 50, method='inverted_cdf')
+    im = random_image(np.float64)
+    statistics = histogram.compute(im)
+    for q in (0, 10, 50, 90, 100):
+        # floating point images are binned, so we get the middle of the right bin
+        difference = statistics.percentile(q) - np.percentile(im.array.reshape(-1, 3), q, axis=0, method='inverted_cdf')
+        assert np.abs(difference).max() <= 0.5 / histogram.float_bins
+
+
+def test_statistics_in_strips():
+    np.random.seed(1)
+    im = random_image(np.float32)
+    whole = histogram.Statistics(3, np.float32).add(im.array)
+    strips = histogram.Statistics(3, np.float32)
+    for start in range(0, 21, 4):
+        strips.add(im.array[start:start + 4])
+    assert (strips.histogram == whole.histogram).all()
+    assert (strips.minimum == whole.minimum).all() and (strips.maximum == whole.maximum).all()
+    assert np.allclose(strips.mean(), whole.mean())
+
+
+def test_statistics_leave_out_nan_and_infinity():
+    np.random.seed(6)
+    im = random_image(np.float64)
+    finite = im.array.copy()
+    im.array[0, 0, 0] = np.nan
+    im.array[1, 2, 0] = np.inf
+    im.array[3, 4, 2] = -np.inf
+    statistics = histogram.compute(im)
+    assert list(statistics.count) == [21 * 13 - 2, 21 * 13, 21 * 13 - 1]
+    assert (statistics.histogram.sum(axis=1) == statistics.count).all()
+    for c in range(3):
+        values = im.array[:, :, c][np.isfinite(im.array[:, :, c])]
+        assert (statistics.histogram[c] == histogram.Statistics(1, np.float64).add(values[:, None, None]).histogram[0]).all()
+        assert statistics.minimum[c] == values.min() and statistics.maximum[c] == values.max()
+        assert np.isclose(statistics.mean()[c], values.mean())
+    assert (histogram.Statistics(3, np.float64).add(finite).histogram[1] == statistics.histogram[1]).all()
+
+
+def test_statistics_are_kept_until_the_pixels_change():
+    np.random.seed(2)
+    im = random_image(np.uint8)
+    statistics = histogram.compute(im)
+    assert histogram.compute(im) is statistics
+    transform.adjust_contrast_in_place(im, 0.5, 0.5)
+    assert histogram.compute(im) is not statistics
+    assert histogram.compute(im).maximum.max() == im.array.max()
+    im.array = im.array // 2
+    assert histogram.compute(im).maximum.max() == im.array.max()
+
+
+def test_auto_contrast():
+    np.random.seed(3)
+    for dtype in (np.uint8, np.uint16, np.float32, np.float64):
+        im = random_image(dtype)
+        top = 1.0 if np.dtype(dtype).kind == 'f' else np.iinfo(dtype).max
+        for per_channel in (False, True):
+            statistics = histogram.compute(im)
+            channels = 'each' if per_channel else 'all'
+            low, high = statistics.percentile(1, channels), statistics.percentile(99, channels)
+            result = histogram.auto_contrast(im, cutoff=1, per_channel=per_channel)
+            assert result.array.dtype == dtype
+            expected = (im.array.astype(np.float64) - low) * (top / (high - low))
+            if np.dtype(dtype).kind == 'f':
+                assert np.allclose(result.array, expected, rtol=1e-5, atol=1e-5)
+            else:
+                assert (result.array == np.clip(np.rint(expected), 0, top)).all()
+            # the 1% at each end is clipped (for integer images), and the range in between stretched to fill everything
+            stretched = histogram.Statistics(3, dtype).add(result.array)
+            assert np.all(stretched.percentile(1, channels) <= 0.01 * top)
+            assert np.all(stretched.percentile(99, channels) >= 0.99 * top)
+    flat = Image(x_pixels=4, y_pixels=4, num_channels=1, dtype=np.uint8)
+    flat.array[...] = 7
+    assert (histogram.auto_contrast(flat).array == 0).all()
+
+
+def test_equalize():
+    np.random.seed(4)
+    for dtype in (np.uint8, np.float64):
+        im = random_image(dtype, shape=(200, 150, 3))
+        result = histogram.equalize(im)
+        assert result.array.dtype == dtype
+        top = 1.0 if dtype == np.float64 else 255
+        for c in range(3):
+            before, after = im.array[:, :, c].ravel(), result.array[:, :, c].ravel()
+            # the mapping keeps the order of the values, and stretches them from 0 to top
+            order = np.argsort(before, kind='stable')
+            assert (np.diff(after[order].astype(np.float64)) >= 0).all()
+            assert after.min() == 0 and after.max() >= top * (1 - 1 / histogram.float_bins)
+            # and afterwards the values are about evenly spread out
+            for q in (25, 50, 75):
+                assert abs(np.percentile(after, q) - q / 100 * top) <= 0.02 * top
+
+
+def test_streamed_auto_contrast(tmp_path):
+    np.random.seed(5)
+    pixels = (np.random.beta(2, 5, (30, 11, 3)) * 255).astype(np.uint8)
+    with open(str(tmp_path / 'small.png'), 'wb') as f:
+        png.Writer(11, 30).write_ndarray(f, pixels)
+    input_path = str(tmp_path) + '/'
+    for dtype in (np.uint8, np.float64):
+        whole = stream.open_image('small.png', input_path=input_path, dtype=dtype).to_image()
+        statistics = histogram.stream_statistics(stream.open_image('small.png', input_path=input_path, dtype=dtype),
+                                                 strip_size=7)
+        assert (statistics.histogram == histogram.compute(whole).histogram).all()
+        source = stream.open_image('small.png', input_path=input_path, dtype=dtype)
+        result = stream.auto_contrast(source, statistics, cutoff=2).to_image(strip_size=4)
+        assert (result.array == histogram.auto_contrast(whole, cutoff=2).array).all()
+        source = stream.open_image('small.png', input_path=input_path, dtype=dtype)
+        result = stream.equalize(source, statistics).to_image(strip_size=5)
+        assert (result.array == histogram.equalize(whole).array).all()
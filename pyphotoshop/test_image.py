@@ -0,0 +1,134 @@
+import lazy
+import numpy as np
+import png
+import stream
+import transform
+from image import Image, decode_pixels, decode_table, half_size, max_value
+
+sobel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+
+
+def write_test_png(path):
+    np.random.seed(0)
+    pixels = np.random.randint(0, 256, (12, 10, 3)).astype(np.uint8)
+    with open(str(path / 'small.png'), 'wb') as f:
+        png.Writer(10, 12).write_ndarray(f, pixels)
+    return str(path) + '/'
+
+
+def read(input_path, dtype=np.float64):
+    im = Image.__new__(Image)
+    im.input_path = input_path
+    im.array = im.read_image('small.png', dtype=dtype)
+    return im
+
+
+def test_dtypes(tmp_path):
+    input_path = write_test_png(tmp_path)
+    reference = read(input_path)
+    for dtype in (np.float32, np.uint8, np.uint16):
+        im = read(input_path, dtype)
+        assert im.array.dtype == dtype
+        # integer images hold the same linear values, rounded to steps of 1 / max_value
+        tolerance = 1e-6 if dtype == np.float32 else 0.5 / max_value(dtype) + 1e-9
+        assert np.abs(im.array / max_value(dtype) - reference.array).max() <= tolerance
+        results = [
+            (transform.brighten(im, 1.5), transform.brighten(reference, 1.5)),
+            (transform.adjust_contrast(im, 2, 0.5), transform.adjust_contrast(reference, 2, 0.5)),
+            (transform.blur(im, 3), transform.blur(reference, 3)),
+            (transform.apply_kernel(im, sobel), transform.apply_kernel(reference, sobel)),
+            (transform.combine_images(im, im), transform.combine_images(reference, reference)),
+        ]
+        for result, expected in results:
+            assert result.array.dtype == dtype
+            expected = expected.array
+            if dtype != np.float32:
+                # integer images can only hold values between 0 and max_value
+                expected = np.clip(expected, 0, 1)
+            # the sobel kernel adds up the rounding errors of 8 input pixels, plus one more rounding
+            assert np.abs(result.array / max_value(dtype) - expected).max() <= 9 * tolerance + 1e-5
+
+
+def test_write_dtypes(tmp_path):
+    input_path = write_test_png(tmp_path)
+    for dtype in (np.float64, np.float32, np.uint8, np.uint16):
+        im = read(input_path, dtype)
+        im.output_path = input_path
+        im.write_image('out.png')
+        width, height, pixels, meta = png.Reader(input_path + 'out.png').read_numpy()
+        original = png.Reader(input_path + 'small.png').read_numpy()[2]
+        # uint8 steps are coarse for dark linear values (the first step up from 0 encodes as 20)
+        assert np.abs(pixels.astype(int) - original).max() <= (21 if dtype == np.uint8 else 1)
+
+
+def test_write_keeps_channels(tmp_path):
+    # grey, grey and alpha, and RGB and alpha files come back with the same channels from every writer
+    np.random.seed(1)
+    input_path = str(tmp_path) + '/'
+    for planes in (1, 2, 3, 4):
+        pixels = np.random.randint(0, 256, (6, 9, planes)).astype(np.uint8)
+        with open(input_path + 'small.png', 'wb') as f:
+            png.Writer(9, 6, greyscale=planes < 3, alpha=planes in (2, 4)).write_ndarray(f, pixels)
+        im = read(input_path)
+        assert im.array.shape == (6, 9, planes)
+        im.output_path = input_path
+        im.write_image('image.png')
+        stream.open_image('small.png', input_path=input_path).write_image('stream.png', strip_size=4,
+                                                                           output_path=input_path)
+        lazy.write_image(lazy.source(im), 'lazy.png', block_rows=4, output_path=input_path)
+        for name in ('image.png', 'stream.png', 'lazy.png'):
+            width, height, written, meta = png.Reader(input_path + name).asarray()
+            assert written.shape == (6, 9, planes)
+            assert meta['greyscale'] == (planes < 3) and meta['alpha'] == (planes in (2, 4))
+            assert np.abs(written.astype(int) - pixels).max() <= 1
+
+
+def test_decode_table_matches_power():
+    np.random.seed(1)
+    for bitdepth in (1, 8, 16):
+        pixels = np.random.randint(0, 2**bitdepth, (5, 7, 3))
+        for gamma in (2.2, 1.0, 1.8):
+            expected = (pixels * (1.0 / (2**bitdepth - 1))) ** gamma
+            assert (decode_pixels(pixels, bitdepth, gamma) == expected).all()
+            assert (decode_pixels(pixels, bitdepth, gamma, np.float32) == expected.astype(np.float32)).all()
+    # the tables are only computed once per gamma
+    assert decode_table(8, 2.2, np.dtype(np.float64)) is decode_table(8, 2.2, np.dtype(np.float64))
+
+
+def test_levels():
+    np.random.seed(2)
+    im = Image(x_pixels=13, y_pixels=8, num_channels=3)
+    im.array = np.random.rand(13, 8, 3)
+    assert im.level(0) is im
+    assert [im.level(n).array.shape for n in range(5)] == [(13, 8, 3), (7, 4, 3), (4, 2, 3), (2, 1, 3), (1, 1, 3)]
+    # each pixel is the average of a 2x2 square, with the odd last row averaged with itself
+    padded = np.concatenate((im.array, im.array[-1:]))
+    expected = padded.reshape(7, 2, 4, 2, 3).mean(axis=(1, 3))
+    assert np.allclose(im.level(1).array, expected, rtol=1e-12, atol=1e-12)
+    assert np.allclose(half_size(expected), im.level(2).array, rtol=1e-12, atol=1e-12)
+    # levels are kept until the pixels change
+    assert im.level(2) is im.level(2)
+    small = im.level(1)
+    im.array = im.array * 0.5
+    assert im.level(1) is not small
+    assert np.allclose(im.level(1).array, small.array * 0.5)
+    small = im.level(1)
+    transform.adjust_contrast_in_place(im, 2, 0.5)
+    assert im.level(1) is not small
+    # integer images stay integer images
+    im8 = Image(x_pixels=6, y_pixels=6, num_channels=1, dtype=np.uint8)
+    im8.array[...] = 255
+    im8.array[0, 0] = 0
+    assert im8.level(1).array.dtype == np.uint8
+    assert im8.level(1).array[0, 0, 0] == 191
+
+
+def test_write_preview(tmp_path):
+    input_path = write_test_png(tmp_path)
+    im = read(input_path)
+    im.output_path = input_path
+    assert im.write_preview('preview.png', 5) == 2
+    assert png.Reader(input_path + 'preview.png').read_numpy()[:2] == (3, 3)
+    im.write_image('level1.png', level=1)
+    assert png.Reader(input_path + 'level1.png').read_numpy()[:2] == (5, 6)
+    assert im.write_preview('full.png', 100) == 0
@@ -0,0 +1,75 @@
+import numpy as np
+import lazy
+import png
+import transform
+from image import Image
+
+sobel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+
+
+def random_image(dtype=np.float64):
+    im = Image(x_pixels=31, y_pixels=13, num_channels=3, dtype=dtype)
+    im.array = np.random.rand(31, 13, 3).astype(dtype)
+    return im
+
+
+def clipped(im):
+    im.array = np.clip(im.array, 0, 1)
+    return im
+
+
+def test_lazy_matches_transform():
+    np.random.seed(0)
+    im = random_image()
+    original = im.array.copy()
+    cases = [
+        (lambda s: lazy.combine_images(lazy.apply_kernel(s, sobel), lazy.apply_kernel(s, sobel.T)),
+         lambda im: transform.combine_images(transform.apply_kernel(im, sobel), transform.apply_kernel(im, sobel.T))),
+        (lambda s: lazy.adjust_contrast(lazy.brighten(s, 1.5), 2, 0.5),
+         lambda im: transform.adjust_contrast(transform.brighten(im, 1.5), 2, 0.5)),
+        (lambda s: lazy.combine_images(s, lazy.brighten(s, 0.5)),
+         lambda im: transform.combine_images(im, transform.brighten(im, 0.5))),
+        (lambda s: lazy.clip(lazy.apply_kernel(lazy.brighten(s, 2), sobel)),
+         lambda im: clipped(transform.apply_kernel(transform.brighten(im, 2), sobel))),
+    ]
+    for build, expected in cases:
+        expected = expected(im).array
+        for block_rows in (None, 1, 4, 7):
+            result = lazy.evaluate(build(lazy.source(im)), block_rows=block_rows)
+            # the same operations in the same order, so exactly the same results
+            assert (result.array == expected).all()
+            assert (im.array == original).all()
+
+
+def test_lazy_blur():
+    np.random.seed(1)
+    im = random_image()
+    expected = transform.blur(transform.brighten(transform.blur(im, 3), 1.2), 5).array
+    for block_rows in (None, 2, 5):
+        node = lazy.blur(lazy.brighten(lazy.blur(lazy.source(im), 3), 1.2), 5)
+        result = lazy.evaluate(node, block_rows=block_rows)
+        # blur keeps running totals, which round a little differently depending on where the block starts
+        assert np.allclose(result.array, expected, rtol=0, atol=1e-12)
+
+
+def test_lazy_integer_images():
+    np.random.seed(2)
+    im = Image(x_pixels=31, y_pixels=13, num_channels=3, dtype=np.uint8)
+    im.array = np.random.randint(0, 256, (31, 13, 3)).astype(np.uint8)
+    result = lazy.evaluate(lazy.adjust_contrast(lazy.brighten(lazy.source(im), 1.3), 1.5, 0.5))
+    assert result.array.dtype == np.uint8
+    # rounded once at the end instead of after every step
+    expected = np.clip(np.rint((im.array * np.float32(1.3) - 127.5) * 1.5 + 127.5), 0, 255)
+    assert np.abs(result.array.astype(int) - expected).max() <= 1
+
+
+def test_lazy_write_image(tmp_path):
+    np.random.seed(3)
+    im = random_image()
+    node = lazy.combine_images(lazy.apply_kernel(lazy.source(im), sobel), lazy.apply_kernel(lazy.source(im), sobel.T))
+    lazy.write_image(node, 'lazy.png', block_rows=5, output_path=str(tmp_path) + '/')
+    expected = lazy.evaluate(node)
+    expected.output_path = str(tmp_path) + '/'
+    expected.write_image('expected.png')
+    pixels = png.Reader(str(tmp_path / 'lazy.png')).read_numpy()[2]
+    assert (pixels == png.Reader(str(tmp_path / 'expected.png')).read_numpy()[2]).all()
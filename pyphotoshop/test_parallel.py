@@ -0,0 +1,72 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import parallel
+import pytest
+import transform
+from image import Image
+
+sobel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+
+
+def random_image(dtype=np.float64):
+    im = Image(x_pixels=29, y_pixels=11, num_channels=3, dtype=dtype)
+    im.array = (np.random.rand(29, 11, 3) * np.iinfo(dtype).max if np.dtype(dtype).kind == 'u'
+                else np.random.rand(29, 11, 3)).astype(dtype)
+    return im
+
+
+def test_parallel_matches_transform():
+    np.random.seed(0)
+    for dtype in (np.float64, np.uint8):
+        im, other = random_image(dtype), random_image(dtype)
+        cases = [
+            (lambda **kw: parallel.brighten(im, 1.5, **kw), transform.brighten(im, 1.5)),
+            (lambda **kw: parallel.adjust_contrast(im, 2, 0.5, **kw), transform.adjust_contrast(im, 2, 0.5)),
+            (lambda **kw: parallel.blur(im, 5, **kw), transform.blur(im, 5)),
+            (lambda **kw: parallel.apply_kernel(im, sobel, **kw), transform.apply_kernel(im, sobel)),
+            (lambda **kw: parallel.combine_images(im, other, **kw), transform.combine_images(im, other)),
+        ]
+        for parallel_result, expected in cases:
+            result = parallel_result(workers=2)
+            assert result.array.dtype == dtype
+            # blur keeps running totals, which round a little differently depending on where the tile starts
+            assert np.allclose(result.array, expected.array, rtol=0, atol=1e-12)
+
+
+def test_tile_sizes():
+    np.random.seed(1)
+    im = random_image()
+    expected = transform.blur(im, 7)
+    for tile_rows in (1, 2, 5, 100):
+        result = parallel.run(transform.blur, [im], halo=3, workers=2, tile_rows=tile_rows, kernel_size=7)
+        assert np.allclose(result.array, expected.array, rtol=0, atol=1e-12)
+
+
+def fail(image):
+    raise ValueError('bad tile')
+
+
+def test_pool_is_kept():
+    np.random.seed(2)
+    im = random_image()
+    parallel.brighten(im, 1.5, workers=2)
+    pool = parallel.pools[2]
+    result = parallel.brighten(im, 1.5, workers=2)
+    assert parallel.pools[2] is pool
+    assert np.allclose(result.array, transform.brighten(im, 1.5).array, rtol=0, atol=1e-12)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        result = parallel.run(transform.brighten, [im], executor=executor, factor=1.5)
+    assert np.allclose(result.array, transform.brighten(im, 1.5).array, rtol=0, atol=1e-12)
+    parallel.shutdown()
+    assert parallel.pools == {}
+
+
+def test_worker_errors_come_through():
+    im = random_image()
+    # the function's own error, not a BufferError from closing the shared memory it was looking at
+    with pytest.raises(ValueError, match='bad tile'):
+        parallel.run(fail, [im], workers=2)
+    # and the workers are still there for the next call
+    result = parallel.brighten(im, 1.5, workers=2)
+    assert np.allclose(result.array, transform.brighten(im, 1.5).array, rtol=0, atol=1e-12)
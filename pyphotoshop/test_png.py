@@ -0,0 +1,347 @@
+import array
+import io
+import os
+import random
+import struct
+import subprocess
+import sys
+import zlib
+
+import numpy as np
+import png
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_png(pixels, bitdepth, color_type, filter_types, extra_chunks=()):
+    # build a PNG by hand so the scanlines can use any filter type
+    # (png.Writer only ever uses filter type 0)
+    height, width, planes = pixels.shape
+    if bitdepth == 16:
+        lines = pixels.astype('>u2').view(np.uint8).reshape(height, -1)
+    elif bitdepth == 8:
+        lines = pixels.reshape(height, -1)
+    else:
+        spb = 8 // bitdepth
+        samples = pixels.reshape(height, -1)
+        padded = np.zeros((height, -(-width // spb) * spb), np.uint8)
+        padded[:, :width] = samples
+        shifts = np.arange(8 - bitdepth, -1, -bitdepth)
+        lines = (padded.reshape(height, -1, spb) << shifts).sum(axis=2).astype(np.uint8)
+    fo = max(1, bitdepth * planes // 8)
+    raw = bytearray()
+    prev = None
+    for line, filter_type in zip(lines, filter_types):
+        line = [int(v) for v in line]
+        raw.extend(png.filter_scanline(filter_type, line, fo, prev))
+        prev = line
+    ihdr = struct.pack('!2I5B', width, height, bitdepth, color_type, 0, 0, 0)
+    out = io.BytesIO()
+    png.write_chunks(out, [(b'IHDR', ihdr)] + list(extra_chunks) +
+                     [(b'IDAT', zlib.compress(bytes(raw))), (b'IEND', b'')])
+    return out.getvalue()
+
+
+def reference(data, method='read'):
+    width, height, rows, meta = getattr(png.Reader(bytes=data), method)()
+    return np.array([list(row) for row in rows]), meta
+
+
+def random_image(height, width, planes, bitdepth):
+    return np.random.randint(0, 2**bitdepth, (height, width, planes)).astype(
+        'uint16' if bitdepth > 8 else 'uint8')
+
+
+def test_read_numpy_matches_read():
+    random.seed(0)
+    np.random.seed(0)
+    cases = [(1, 0), (2, 0), (4, 0), (8, 0), (16, 0), (8, 2), (16, 2), (8, 4), (8, 6), (16, 6)]
+    for bitdepth, color_type in cases:
+        planes = {0: 1, 2: 3, 4: 2, 6: 4}[color_type]
+        pixels = random_image(7, 13, planes, bitdepth)
+        for filters in ([0] * 7, [1, 2, 1, 2, 0, 1, 2], [random.randint(0, 4) for _ in range(7)]):
+            data = make_png(pixels, bitdepth, color_type, filters)
+            ref, ref_meta = reference(data)
+            width, height, array, meta = png.Reader(bytes=data).read_numpy()
+            assert array.shape == (7, 13, planes)
+            assert (array == pixels).all()
+            assert (array.reshape(7, -1) == ref).all()
+            assert meta == ref_meta
+
+
+def test_read_numpy_interlaced():
+    pixels = random_image(11, 9, 3, 8)
+    out = io.BytesIO()
+    png.Writer(9, 11, interlace=True).write(out, pixels.reshape(11, -1))
+    width, height, array, meta = png.Reader(bytes=out.getvalue()).read_numpy()
+    assert (array == pixels).all()
+
+
+def test_asarray_matches_asdirect():
+    np.random.seed(1)
+    pixels = random_image(5, 6, 1, 2)
+    palette = (b'PLTE', bytes(range(12)))
+    trns = (b'tRNS', bytes([0, 255]))
+    grey_trns = (b'tRNS', struct.pack('!H', 3))
+    for data in (make_png(pixels, 2, 3, [4] * 5, [palette]),
+                 make_png(pixels, 2, 3, [4] * 5, [palette, trns]),
+                 make_png(pixels, 2, 0, [3] * 5, [grey_trns]),
+                 make_png(pixels * 60, 8, 0, [1] * 5, [(b'sBIT', b'\x06')])):
+        ref, ref_meta = reference(data, 'asDirect')
+        width, height, array, meta = png.Reader(bytes=data).asarray()
+        assert (array.reshape(5, -1) == ref).all()
+        assert meta == ref_meta
+
+
+def test_read_numpy_paeth_file():
+    # city.png is stored with the paeth filter on every row
+    reader = png.Reader(os.path.join(here, 'input', 'city.png'))
+    width, height, array, meta = reader.read_numpy()
+    ref = np.array([list(row) for row in png.Reader(os.path.join(here, 'input', 'city.png')).read()[2]])
+    assert (array.reshape(height, -1) == ref).all()
+
+
+def test_write_ndarray_matches_write():
+    np.random.seed(2)
+    cases = [(1, dict(greyscale=True)), (4, dict(greyscale=True)), (3, dict(greyscale=True)),
+             (8, {}), (5, {}), (16, dict(alpha=True)), (8, dict(greyscale=True, alpha=True))]
+    for bitdepth, options in cases:
+        planes = (3, 1)[options.get('greyscale', False)] + options.get('alpha', False)
+        pixels = np.random.randint(0, 2**bitdepth, (9, 14, planes))
+        for interlace in (False, True):
+            writer = png.Writer(14, 9, bitdepth=bitdepth, interlace=interlace, chunk_limit=37, **options)
+            expected = io.BytesIO()
+            writer.write(expected, pixels.reshape(9, -1).tolist())
+            out = io.BytesIO()
+            writer.write_ndarray(out, pixels)
+            array, meta = reference(out.getvalue())
+            expected_array, expected_meta = reference(expected.getvalue())
+            assert (array == expected_array).all()
+            assert meta == expected_meta
+
+
+def test_filter_types_round_trip():
+    np.random.seed(3)
+    pixels = np.random.randint(0, 256, (10, 11, 3))
+    # smooth gradient, so that the adaptive filter has something to work with
+    pixels[:5] = np.arange(11)[None, :, None] * 20
+    for filter_type in (1, 2, 3, 4, 'adaptive'):
+        for interlace in (False, True):
+            writer = png.Writer(11, 10, interlace=interlace, filter_type=filter_type, chunk_limit=40)
+            outputs = [io.BytesIO(), io.BytesIO()]
+            writer.write(outputs[0], pixels.reshape(10, -1).tolist())
+            writer.write_ndarray(outputs[1], pixels)
+            for out in outputs:
+                width, height, array, meta = png.Reader(bytes=out.getvalue()).read_numpy()
+                assert (array == pixels).all()
+
+
+def test_adaptive_filter_matches_pure_python():
+    np.random.seed(4)
+    lines = np.random.randint(0, 256, (6, 12)).astype(np.uint8)
+    lines[3:] = lines[2]
+    previous = None
+    filtered = png.filter_rows_numpy(lines, None, 3, 'adaptive')
+    for line, out in zip(lines, filtered):
+        line = [int(v) for v in line]
+        candidates = [png.filter_scanline(t, line, 3, previous) for t in range(5)]
+        best = min(candidates, key=png._filter_cost)
+        assert out[0] == best[0]
+        assert list(out[1:]) == list(best[1:])
+        previous = line
+
+
+def test_writer_filters_short_rows_without_numpy(monkeypatch):
+    np.random.seed(23)
+    pixels = np.random.randint(0, 256, (6, 5, 3))
+    expected = {}
+    for filter_type in (0, 3, 'adaptive'):
+        out = io.BytesIO()
+        png.Writer(5, 6, filter_type=filter_type).write(out, pixels.reshape(6, -1).tolist())
+        expected[filter_type] = out.getvalue()
+
+    def no_numpy(*args, **kwargs):
+        raise AssertionError('rows shorter than _numpy_filter_min should be filtered in pure Python')
+    monkeypatch.setattr(png, 'filter_rows_numpy', no_numpy)
+    for filter_type in (0, 3, 'adaptive'):
+        out = io.BytesIO()
+        png.Writer(5, 6, filter_type=filter_type).write(out, pixels.reshape(6, -1).tolist())
+        assert out.getvalue() == expected[filter_type]
+    # and the pure Python filters pick the same bytes as the NumPy ones
+    monkeypatch.undo()
+    monkeypatch.setattr(png, '_numpy_filter_min', 0)
+    for filter_type in (0, 3, 'adaptive'):
+        out = io.BytesIO()
+        png.Writer(5, 6, filter_type=filter_type).write(out, pixels.reshape(6, -1).tolist())
+        assert out.getvalue() == expected[filter_type]
+
+
+def test_parallel_compression():
+    np.random.seed(5)
+    pixels = np.random.randint(0, 64, (120, 200, 3)).astype(np.uint8)
+    for filter_type in (0, 'adaptive'):
+        writer = png.Writer(200, 120, workers=3, chunk_limit=2**15, filter_type=filter_type)
+        outputs = [io.BytesIO(), io.BytesIO()]
+        writer.write_ndarray(outputs[0], pixels)
+        writer.write(outputs[1], pixels.reshape(120, -1))
+        for out in outputs:
+            # zlib verifies the combined Adler-32 checksum
+            width, height, array, meta = png.Reader(bytes=out.getvalue()).read_numpy()
+            assert (array == pixels).all()
+
+
+def test_adler32_combine():
+    first, second = os.urandom(1000), os.urandom(70000)
+    combined = png._adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+    assert combined == zlib.adler32(first + second)
+
+
+def test_read_rows():
+    filename = os.path.join(here, 'input', 'city.png')
+    width, height, full, meta = png.Reader(filename).read_numpy()
+    for start, stop in [(0, 308), (100, 105), (300, 400), (0, 1)]:
+        assert (png.Reader(filename).read_rows(start, stop) == full[start:stop]).all()
+        reader = png.MappedReader(filename)
+        assert (reader.read_rows(start, stop) == full[start:stop]).all()
+        reader.close()
+    blocks = list(png.Reader(filename).iter_numpy(block_rows=50))
+    assert [len(block) for block in blocks] == [50] * 6 + [8]
+    assert (np.concatenate(blocks) == full).all()
+
+
+def test_mapped_reader_chunks():
+    reader = png.MappedReader(os.path.join(here, 'input', 'lake.png'))
+    types = [type for type, offset, length in reader.index]
+    assert types[0] == b'IHDR' and types[-1] == b'IEND'
+    reader.preamble()
+    assert all(isinstance(data, memoryview) for data in reader.iteridat())
+    width, height, pixels, meta = reader.asarray()
+    assert (pixels == png.Reader(os.path.join(here, 'input', 'lake.png')).asarray()[2]).all()
+
+
+def test_deinterlace_numpy_matches_deinterlace():
+    np.random.seed(6)
+    cases = [(1, dict(greyscale=True)), (2, dict(greyscale=True)), (4, dict(greyscale=True)),
+             (8, {}), (16, dict(alpha=True)), (8, dict(greyscale=True, alpha=True))]
+    for bitdepth, options in cases:
+        planes = (3, 1)[options.get('greyscale', False)] + options.get('alpha', False)
+        # including images smaller than the 8x8 Adam7 tile, which have empty passes
+        for height, width in ((1, 1), (2, 3), (5, 1), (9, 14), (17, 6)):
+            pixels = np.random.randint(0, 2**bitdepth, (height, width, planes))
+            for filter_type in (0, 4, 'adaptive'):
+                writer = png.Writer(width, height, bitdepth=bitdepth, interlace=True, filter_type=filter_type, **options)
+                out = io.BytesIO()
+                writer.write_ndarray(out, pixels)
+                reader = png.Reader(bytes=out.getvalue())
+                reader.preamble()
+                raw = array.array('B', zlib.decompress(b''.join(reader.iteridat())))
+                expected = np.array(reader.deinterlace(raw)).reshape(height, width, planes)
+                assert (reader.deinterlace_numpy(raw) == expected).all()
+                assert (expected == pixels).all()
+                assert (png.Reader(bytes=out.getvalue()).read_numpy()[2] == expected).all()
+                rows = png.Reader(bytes=out.getvalue()).read()[2]
+                assert [list(row) for row in rows] == expected.reshape(height, -1).tolist()
+
+
+def test_read_incremental_decompression(monkeypatch):
+    # small slices of compressed data, so that scanlines straddle them and the IDAT chunks
+    monkeypatch.setattr(png, '_idat_slice', 7)
+    np.random.seed(7)
+    for bitdepth, options in ((8, {}), (16, dict(alpha=True)), (2, dict(greyscale=True))):
+        planes = (3, 1)[options.get('greyscale', False)] + options.get('alpha', False)
+        pixels = np.random.randint(0, 2**bitdepth, (23, 19, planes))
+        for interlace in (False, True):
+            for chunk_limit in (2**20, 50):
+                writer = png.Writer(19, 23, bitdepth=bitdepth, interlace=interlace, chunk_limit=chunk_limit,
+                                    filter_type='adaptive', **options)
+                out = io.BytesIO()
+                writer.write_ndarray(out, pixels)
+                rows = png.Reader(bytes=out.getvalue()).read()[2]
+                assert [list(row) for row in rows] == pixels.reshape(23, -1).tolist()
+                assert (png.Reader(bytes=out.getvalue()).read_numpy()[2] == pixels).all()
+                assert (np.concatenate(list(png.Reader(bytes=out.getvalue()).iter_numpy(block_rows=3))) == pixels).all()
+
+
+def test_read_wrong_size():
+    # one byte short of the last scanline
+    pixels = np.zeros((4, 5, 1), dtype=np.uint8)
+    data = make_png(pixels, 8, 0, [0] * 4)
+    reader = png.Reader(bytes=data)
+    reader.preamble()
+    raw = zlib.decompress(b''.join(reader.iteridat()))
+    out = io.BytesIO()
+    png.write_chunks(out, [(b'IHDR', struct.pack('!2I5B', 5, 4, 8, 0, 0, 0, 0)),
+                           (b'IDAT', zlib.compress(raw[:-1])), (b'IEND', b'')])
+    try:
+        list(png.Reader(bytes=out.getvalue()).read()[2])
+    except png.FormatError:
+        pass
+    else:
+        assert False, 'expected FormatError'
+
+
+def test_import_is_lazy():
+    # importing png shouldn't import numpy or the command line code until they're used
+    code = ('import sys, png; print(sorted(name for name in ("numpy", "pngcli") if name in sys.modules)); '
+            'print(png.color_triple("#ff0000")); png.Reader(bytes=open(sys.argv[1], "rb").read()).read_numpy(); '
+            'print("numpy" in sys.modules)')
+    output = subprocess.check_output([sys.executable, '-c', code, os.path.join(here, 'input', 'city.png')], cwd=here)
+    assert output.decode().split('\n')[:3] == ['[]', '(255, 0, 0)', 'True']
+
+
+def test_undo_filter_numpy_matches_reference():
+    random.seed(20)
+    for _ in range(200):
+        fu = random.randint(1, 8)
+        length = fu * random.randint(1, 40)
+        scanline = array.array('B', [random.randrange(256) for _ in range(length)])
+        previous = array.array('B', [random.randrange(256) for _ in range(length)])
+        for reference, numpy_version in ((png.pngfilters.undo_filter_sub, png.undo_filter_sub_numpy),
+                                         (png.pngfilters.undo_filter_up, png.undo_filter_up_numpy)):
+            expected = array.array('B', scanline)
+            reference(fu, scanline, previous, expected)
+            # in place, the way Reader.undo_filter calls them
+            result = array.array('B', scanline)
+            numpy_version(fu, result, previous, result)
+            assert result == expected
+
+
+def test_filter_scanline_numpy_matches_reference(monkeypatch):
+    random.seed(21)
+    cases = []
+    for _ in range(100):
+        fo = random.randint(1, 8)
+        length = fo * random.randint(1, 40)
+        line = array.array('B', [random.randrange(256) for _ in range(length)])
+        prev = random.choice([None, array.array('B', [random.randrange(256) for _ in range(length)])])
+        cases.append((line, fo, prev))
+    monkeypatch.setattr(png, '_numpy_filter_min', 0)
+    filtered = [[png.filter_scanline(type, line, fo, prev) for type in range(5)] for line, fo, prev in cases]
+    monkeypatch.setattr(png, '_numpy_filter_min', 2**30)
+    expected = [[png.filter_scanline(type, line, fo, prev) for type in range(5)] for line, fo, prev in cases]
+    assert filtered == expected
+    # and undoing them gives the line back, with and without NumPy
+    reader = png.Reader(bytes=b'')
+    for (line, fo, prev), lines in zip(cases, filtered):
+        reader.psize = fo
+        for minimum in (0, 2**30):
+            monkeypatch.setattr(png, '_numpy_filter_min', minimum)
+            for type, out in enumerate(lines):
+                assert out[0] == type
+                assert reader.undo_filter(type, out[1:], prev) == line
+
+
+def test_read_every_filter_type_matches_without_numpy(monkeypatch):
+    np.random.seed(22)
+    for bitdepth, options in ((8, {}), (16, dict(alpha=True)), (4, dict(greyscale=True))):
+        planes = (3, 1)[options.get('greyscale', False)] + options.get('alpha', False)
+        pixels = np.random.randint(0, 2**bitdepth, (13, 70, planes))
+        for filter_type in (0, 1, 2, 3, 4, 'adaptive'):
+            writer = png.Writer(70, 13, bitdepth=bitdepth, filter_type=filter_type, **options)
+            out = io.BytesIO()
+            writer.write_ndarray(out, pixels)
+            rows = [list(row) for row in png.Reader(bytes=out.getvalue()).read()[2]]
+            assert rows == pixels.reshape(13, -1).tolist()
+            with monkeypatch.context() as patch:
+                patch.setattr(png, 'numpy', None)
+                assert [list(row) for row in png.Reader(bytes=out.getvalue()).read()[2]] == rows
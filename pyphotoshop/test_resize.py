@@ -0,0 +1,71 @@
+import numpy as np
+import resize
+from image import Image, half_size, max_value
+
+dtypes = (np.float64, np.float32, np.uint8, np.uint16)
+
+
+def random_image(dtype, shape):
+    im = Image(x_pixels=shape[0], y_pixels=shape[1], num_channels=shape[2], dtype=dtype)
+    im.array = (np.random.rand(*shape) * max_value(dtype)).astype(dtype)
+    return im
+
+
+def resize_loop(image, x_pixels, y_pixels, filter):
+    # every new pixel as the double sum over both weight tables
+    array = image.array.astype(np.float64)
+    indices_x, weights_x = resize.weights(array.shape[0], x_pixels, filter)
+    indices_y, weights_y = resize.weights(array.shape[1], y_pixels, filter)
+    result = np.zeros((x_pixels, y_pixels, array.shape[2]))
+    for x in range(x_pixels):
+        for y in range(y_pixels):
+            for a in range(indices_x.shape[1]):
+                for b in range(indices_y.shape[1]):
+                    result[x, y] += weights_x[x, a] * weights_y[y, b] * array[indices_x[x, a], indices_y[y, b]]
+    return result
+
+
+def test_resize_matches_loop():
+    np.random.seed(0)
+    im = random_image(np.float64, shape=(11, 7, 3))
+    # shrinking and enlarging, one axis at a time and both (so both axis orders get used)
+    for x_pixels, y_pixels in ((4, 7), (11, 3), (5, 16), (23, 2), (3, 3), (1, 1)):
+        for filter in resize.filters:
+            result = resize.resize(im, x_pixels, y_pixels, filter)
+            assert result.array.shape == (x_pixels, y_pixels, 3)
+            assert np.allclose(result.array, resize_loop(im, x_pixels, y_pixels, filter), rtol=1e-12, atol=1e-12)
+
+
+def test_resize_simple_cases():
+    np.random.seed(1)
+    for dtype in dtypes:
+        im = random_image(dtype, shape=(12, 10, 3))
+        for filter in resize.filters:
+            result = resize.resize(im, 12, 10, filter)
+            assert result.array.dtype == dtype
+            # the same size is the same image
+            assert np.allclose(result.array, im.array, atol=1e-5 * max_value(dtype))
+        # area shrinking by 2 averages 2x2 squares, like Image.level
+        expected = half_size(im.array.astype(np.float64))
+        assert np.abs(resize.resize(im, 6, 5, 'area').array - expected).max() <= (1e-5 if np.dtype(dtype).kind == 'f' else 0.5)
+        # nearest enlarging by 2 repeats every pixel
+        assert (resize.resize(im, 24, 20, 'nearest').array == im.array.repeat(2, axis=0).repeat(2, axis=1)).all()
+    flat = Image(x_pixels=9, y_pixels=13, num_channels=3)
+    flat.array[...] = 0.3
+    for filter in resize.filters:
+        for size in ((4, 5), (9, 13), (20, 31)):
+            assert np.allclose(resize.resize(flat, *size, filter=filter).array, 0.3)
+    # the tables are computed once per sizes and filter
+    assert resize.weights(100, 37, 'lanczos') is resize.weights(100, 37, 'lanczos')
+
+
+def test_thumbnail():
+    im = Image(x_pixels=300, y_pixels=120, num_channels=3)
+    assert resize.thumbnail(im, 100).array.shape == (100, 40, 3)
+    assert resize.thumbnail(im, 1000).array.shape == (300, 120, 3)
+    try:
+        resize.resize(im, 10, 10, 'cubic')
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
@@ -0,0 +1,261 @@
+import numpy as np
+import transform
+from image import Image, compute_dtype, max_value, to_dtype
+
+dtypes = (np.float64, np.float32, np.uint8, np.uint16)
+
+
+def random_image(dtype, shape=(13, 17, 3)):
+    im = Image(x_pixels=shape[0], y_pixels=shape[1], num_channels=shape[2], dtype=dtype)
+    if np.dtype(dtype).kind == 'f':
+        # include values outside 0..1 and negative ones, like the results of apply_kernel
+        im.array = (np.random.rand(*shape) * 1.4 - 0.2).astype(dtype)
+    else:
+        im.array = np.random.randint(0, max_value(dtype) + 1, shape).astype(dtype)
+    return im
+
+
+def adjust_contrast_loop(image, factor, mid):
+    # the element by element version, one pixel at a time
+    array = image.array.astype(compute_dtype(image.array.dtype))
+    mid = mid * max_value(image.array.dtype)
+    result = np.zeros_like(array)
+    for x in range(array.shape[0]):
+        for y in range(array.shape[1]):
+            for c in range(array.shape[2]):
+                result[x, y, c] = (array[x, y, c] - mid) * factor + mid
+    return to_dtype(result, image.array.dtype)
+
+
+def combine_images_loop(image1, image2):
+    array1 = image1.array.astype(compute_dtype(image1.array.dtype))
+    array2 = image2.array.astype(compute_dtype(image1.array.dtype))
+    result = np.zeros_like(array1)
+    for x in range(array1.shape[0]):
+        for y in range(array1.shape[1]):
+            for c in range(array1.shape[2]):
+                result[x, y, c] = np.sqrt(array1[x, y, c] * array1[x, y, c] + array2[x, y, c] * array2[x, y, c])
+    return to_dtype(result, image1.array.dtype)
+
+
+def test_adjust_contrast_matches_loop():
+    np.random.seed(0)
+    for dtype in dtypes:
+        im = random_image(dtype)
+        for factor, mid in ((2, 0.5), (0.5, 0.5), (1.7, 0.3)):
+            expected = adjust_contrast_loop(im, factor, mid)
+            result = transform.adjust_contrast(im, factor, mid)
+            assert result.array.dtype == dtype
+            assert (result.array == expected).all()
+            out = Image(x_pixels=13, y_pixels=17, num_channels=3, dtype=dtype)
+            assert transform.adjust_contrast(im, factor, mid, out=out) is out
+            assert (out.array == expected).all()
+            copy = Image(x_pixels=13, y_pixels=17, num_channels=3, dtype=dtype)
+            copy.array = im.array.copy()
+            transform.adjust_contrast_in_place(copy, factor, mid)
+            assert (copy.array == expected).all()
+
+
+def test_combine_images_matches_loop():
+    np.random.seed(1)
+    for dtype in dtypes:
+        im1, im2 = random_image(dtype), random_image(dtype)
+        expected = combine_images_loop(im1, im2)
+        result = transform.combine_images(im1, im2)
+        assert result.array.dtype == dtype
+        assert (result.array == expected).all()
+        out = Image(x_pixels=13, y_pixels=17, num_channels=3, dtype=dtype)
+        transform.combine_images(im1, im2, out=out)
+        assert (out.array == expected).all()
+        transform.combine_images_in_place(im1, im2)
+        assert (im1.array == expected).all()
+        # combining an image with itself in place
+        im2_expected = combine_images_loop(im2, im2)
+        transform.combine_images_in_place(im2, im2)
+        assert (im2.array == im2_expected).all()
+
+
+def blur_loop(image, kernel_size):
+    array = image.array.astype(np.float64)
+    result = np.zeros_like(array)
+    neighbor_range = kernel_size // 2
+    x_pixels, y_pixels, num_channels = array.shape
+    for x in range(x_pixels):
+        for y in range(y_pixels):
+            for c in range(num_channels):
+                total = 0
+                for x_i in range(max(0, x - neighbor_range), min(x_pixels - 1, x + neighbor_range) + 1):
+                    for y_i in range(max(0, y - neighbor_range), min(y_pixels - 1, y + neighbor_range) + 1):
+                        total += array[x_i, y_i, c]
+                result[x, y, c] = total / (kernel_size ** 2)
+    return result
+
+
+def test_blur_matches_loop():
+    np.random.seed(2)
+    for dtype in dtypes:
+        im = random_image(dtype)
+        # including kernels bigger than the whole image
+        for kernel_size in (1, 3, 5, 15, 41):
+            expected = blur_loop(im, kernel_size)
+            result = transform.blur(im, kernel_size)
+            assert result.array.dtype == dtype
+            if np.dtype(dtype).kind == 'f':
+                assert np.allclose(result.array, expected, rtol=1e-6, atol=1e-6)
+            else:
+                # sums of integers are exact, so we round to exactly the same values
+                assert (result.array == to_dtype(expected, dtype)).all()
+
+
+def apply_kernel_loop(image, kernel):
+    array = image.array.astype(np.float64)
+    result = np.zeros_like(array)
+    neighbor_range = kernel.shape[0] // 2
+    x_pixels, y_pixels, num_channels = array.shape
+    for x in range(x_pixels):
+        for y in range(y_pixels):
+            for c in range(num_channels):
+                total = 0
+                for x_i in range(max(0, x - neighbor_range), min(x_pixels - 1, x + neighbor_range) + 1):
+                    for y_i in range(max(0, y - neighbor_range), min(y_pixels - 1, y + neighbor_range) + 1):
+                        total += array[x_i, y_i, c] * kernel[x_i + neighbor_range - x, y_i + neighbor_range - y]
+                result[x, y, c] = total
+    return result
+
+
+def test_apply_kernel_methods_match_loop():
+    np.random.seed(3)
+    sobel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+    gaussian = np.exp(-np.linspace(-2, 2, 9) ** 2)
+    kernels = [sobel, sobel.T, np.outer(gaussian, gaussian), np.random.rand(5, 5) - 0.5,
+               np.random.randint(-3, 4, (3, 3)), np.random.rand(21, 21)]
+    for dtype in dtypes:
+        im = random_image(dtype)
+        for kernel in kernels:
+            expected = apply_kernel_loop(im, kernel)
+            methods = [None, 'direct', 'fft']
+            if transform.separate_kernel(kernel) is not None:
+                methods.append('separable')
+            for method in methods:
+                result = transform.apply_kernel(im, kernel, method=method)
+                assert result.array.dtype == dtype
+                if dtype == np.float64 and method == 'direct':
+                    # the same multiply-adds in the same order
+                    assert (result.array == expected).all()
+                elif np.dtype(dtype).kind == 'f':
+                    assert np.allclose(result.array, expected, rtol=1e-5, atol=1e-5)
+                else:
+                    difference = result.array.astype(int) - to_dtype(expected, dtype)
+                    assert np.abs(difference).max() <= 1
+
+
+def test_apply_kernel_dtype():
+    np.random.seed(7)
+    sobel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+    for dtype in (np.uint8, np.uint16):
+        im = random_image(dtype)
+        # floating point results keep the negative edges, in 0..1 units like any floating point image
+        expected = apply_kernel_loop(im, sobel) / max_value(dtype)
+        edges_x = transform.apply_kernel(im, sobel, dtype=np.float32)
+        assert edges_x.array.dtype == np.float32
+        assert edges_x.array.min() < 0
+        assert np.allclose(edges_x.array, expected, rtol=1e-5, atol=1e-5)
+        edges_y = transform.apply_kernel(im, sobel.T, dtype=np.float32)
+        # so combining them gives the same edges as sobel
+        combined = transform.combine_images(edges_x, edges_y)
+        assert np.allclose(combined.array, transform.sobel_magnitude(im, dtype=np.float32).array, rtol=1e-5, atol=1e-5)
+
+
+def test_separate_kernel():
+    sobel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+    column, row = transform.separate_kernel(sobel)
+    assert np.allclose(np.outer(column, row), sobel)
+    assert transform.separate_kernel(np.eye(3)) is None
+    assert transform.separate_kernel(np.zeros((3, 3))) is None
+
+
+def gaussian_blur_direct(image, sigma):
+    # the explicit way: a sampled gaussian kernel, on the image with its edge pixels repeated
+    radius = int(np.ceil(5 * sigma))
+    gaussian = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * sigma ** 2))
+    kernel = np.outer(gaussian, gaussian) / gaussian.sum() ** 2
+    array = image.array.astype(np.float64)
+    padded = Image(x_pixels=array.shape[0] + 2 * radius, y_pixels=array.shape[1] + 2 * radius, num_channels=array.shape[2])
+    padded.array = np.pad(array, ((radius, radius), (radius, radius), (0, 0)), mode='edge')
+    return transform.apply_kernel(padded, kernel).array[radius:-radius, radius:-radius]
+
+
+def test_gaussian_blur_matches_kernel():
+    np.random.seed(4)
+    for dtype in dtypes:
+        im = random_image(dtype, shape=(40, 33, 3))
+        for sigma in (0.5, 1, 3, 8, 30):
+            expected = gaussian_blur_direct(im, sigma)
+            result = transform.gaussian_blur(im, sigma)
+            assert result.array.dtype == dtype
+            # the recursive filter is only very nearly a gaussian
+            difference = np.abs(result.array.astype(np.float64) - expected) / max_value(dtype)
+            assert difference.max() < 0.015
+
+
+def test_gaussian_blur_keeps_flat_images_flat():
+    for dtype in dtypes:
+        im = Image(x_pixels=9, y_pixels=2, num_channels=3, dtype=dtype)
+        im.array[...] = max_value(dtype) // 3 if np.dtype(dtype).kind == 'u' else 0.3
+        for sigma in (0.5, 2, 100):
+            assert np.allclose(transform.gaussian_blur(im, sigma).array, im.array, rtol=1e-5)
+    try:
+        transform.gaussian_blur(im, 0.2)
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+
+
+def test_gaussian_pyramid():
+    np.random.seed(5)
+    im = random_image(np.float64, shape=(37, 20, 3))
+    pyramid = transform.gaussian_pyramid(im, 10, sigma=1.5)
+    assert pyramid[0] is im
+    # it stops once a level is a single pixel tall or wide
+    assert [level.array.shape for level in pyramid] == [(37, 20, 3), (19, 10, 3), (10, 5, 3), (5, 3, 3), (3, 2, 3), (2, 1, 3)]
+    expected = im
+    for level in pyramid[1:]:
+        expected_array = transform.gaussian_blur(expected, 1.5).array[::2, ::2]
+        assert np.allclose(level.array, expected_array, rtol=1e-12, atol=1e-12)
+        expected = level
+    small = transform.gaussian_pyramid(random_image(np.uint8), 3)
+    assert [level.array.dtype for level in small] == [np.uint8] * 3
+
+
+def test_sobel_matches_three_passes():
+    np.random.seed(6)
+    sobel_x = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+    sobel_y = sobel_x.T
+    # wide enough to be done in several blocks of rows
+    for shape in ((13, 17, 3), (30, 3000, 3), (1, 1, 1)):
+        for dtype in dtypes:
+            im = random_image(dtype, shape)
+            # the edges in between, before any rounding and clipping
+            array = Image(x_pixels=shape[0], y_pixels=shape[1], num_channels=shape[2])
+            array.array = im.array.astype(np.float64)
+            edges_x = apply_kernel_loop(array, sobel_x) if shape[1] < 100 else transform.apply_kernel(array, sobel_x).array
+            edges_y = apply_kernel_loop(array, sobel_y) if shape[1] < 100 else transform.apply_kernel(array, sobel_y).array
+            expected = np.sqrt(edges_x * edges_x + edges_y * edges_y)
+            magnitude, angle = transform.sobel(im, orientation=True)
+            assert magnitude.array.dtype == dtype
+            assert (transform.sobel_magnitude(im).array == magnitude.array).all()
+            assert np.allclose(angle.array, np.arctan2(edges_y, edges_x), rtol=1e-5, atol=1e-5)
+            if np.dtype(dtype).kind == 'f':
+                assert np.allclose(magnitude.array, expected, rtol=1e-5, atol=1e-5)
+                if dtype == np.float64:
+                    combined = transform.combine_images(transform.apply_kernel(im, sobel_x), transform.apply_kernel(im, sobel_y))
+                    assert np.allclose(magnitude.array, combined.array, rtol=1e-12, atol=1e-12)
+            else:
+                difference = magnitude.array.astype(int) - to_dtype(expected, dtype)
+                assert np.abs(difference).max() <= 1
+            # uint8 edges, ready for png.Writer
+            small = transform.sobel_magnitude(im, dtype=np.uint8)
+            assert small.array.dtype == np.uint8
+            scaled = to_dtype(expected * (255 / max_value(dtype)), np.uint8)
+            assert np.abs(small.array.astype(int) - scaled).max() <= 1
@@ -10,14 +10,58 @@ Github: https://www.github.com/kying18
 Programmer Beast Mode Spotify playlist: https://open.spotify.com/playlist/4Akns5EUb3gzmlXIdsJkPs?si=qGc4ubKRRYmPHAJAIrCxVQ 
 """
 
-from image import Image
+from functools import lru_cache, wraps
+from inspect import signature
+
+from image import Image, compute_dtype, max_value, to_dtype
+import cache
 import numpy as np
 
+def cache_key(function, *args, **kwargs):
+    # the key (see cache.py) for the result of function(*args, **kwargs), or None if it isn't cached
+    # the same call gives the same key whether the parameters are passed by position, by name or left out
+    bound = signature(function).bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = bound.arguments
+    if arguments.get('out') is not None:
+        # results written into an existing image aren't cached
+        return None
+    return cache.active.key(function.__name__, dict(arguments))
+
+def cached_image(key):
+    # the cached result for key as an Image, or None if there isn't one
+    array = cache.active.get(key)
+    if array is None:
+        return None
+    x_pixels, y_pixels, num_channels = array.shape
+    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=array.dtype)
+    new_im.array = array
+    return new_im
+
+def cached(function):
+    # if the result cache is on (see cache.py), look the result up there before computing it
+    # the undecorated function is function.__wrapped__, which stream.py and parallel.py call on each strip or tile
+    # (a result for part of an image is no use to anyone else, so it isn't worth hashing and saving)
+    @wraps(function)
+    def cached_function(*args, **kwargs):
+        if cache.active is None:
+            return function(*args, **kwargs)
+        key = cache_key(function, *args, **kwargs)
+        if key is None:
+            return function(*args, **kwargs)
+        new_im = cached_image(key)
+        if new_im is None:
+            new_im = function(*args, **kwargs)
+            cache.active.put(key, new_im.array)
+        return new_im
+    return cached_function
+
+@cached
 def brighten(image, factor):
     # when we brighten, we just want to make each channel higher by some amount 
     # factor is a value > 0, how much you want to brighten the image by (< 1 = darken, > 1 = brighten)
     x_pixels, y_pixels, num_channels = image.array.shape  # represents x, y pixels of image, # channels (R, G, B)
-    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels)  # making a new array to copy values to!
+    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=image.array.dtype)  # making a new array to copy values to!
 
     # # this is the non vectorized version
     # for x in range(x_pixels):
@@ -26,74 +70,428 @@ def brighten(image, factor):
     #             new_im.array[x, y, c] = image.array[x, y, c] * factor
 
     # faster version that leverages numpy
-    new_im.array = image.array * factor
+    new_im.array = to_dtype(image.array * factor, image.array.dtype)
 
     return new_im
 
-def adjust_contrast(image, factor, mid):
+@cached
+def adjust_contrast(image, factor, mid, out=None):
     # adjust the contrast by increasing the difference from the user-defined midpoint by factor amount
+    # out is an optional Image (the same size and dtype as image) to write the result into, instead of making a new one
     x_pixels, y_pixels, num_channels = image.array.shape  # represents x, y pixels of image, # channels (R, G, B)
-    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels)  # making a new array to copy values to!
-    for x in range(x_pixels):
-        for y in range(y_pixels):
-            for c in range(num_channels):
-                new_im.array[x, y, c] = (image.array[x, y, c] - mid) * factor + mid
+    dtype = image.array.dtype
+    if out is None:
+        out = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=dtype)  # making a new array to copy values to!
+    # mid is between 0 and 1, so for integer images we scale it up like the pixel values
+    mid = mid * max_value(dtype)
 
-    return new_im
+    # # this is the non vectorized version
+    # for x in range(x_pixels):
+    #     for y in range(y_pixels):
+    #         for c in range(num_channels):
+    #             new_im.array[x, y, c] = (image.array[x, y, c] - mid) * factor + mid
+
+    # faster version that leverages numpy
+    if dtype.kind == 'f':
+        # we can do the math right in the output array, without making any temporary arrays
+        np.subtract(image.array, mid, out=out.array)
+        out.array *= factor
+        out.array += mid
+    else:
+        # we do the math in floating point (integer images could go negative or overflow), then convert back
+        result = image.array.astype(compute_dtype(dtype))
+        result -= mid
+        result *= factor
+        result += mid
+        out.array[...] = to_dtype(result, dtype)
+    out.pixels_changed()  # so that out's levels and statistics are worked out again
+    return out
 
+def adjust_contrast_in_place(image, factor, mid):
+    # same as adjust_contrast, but changes image instead of making a new one
+    return adjust_contrast(image, factor, mid, out=image)
+
+def box_sums(array, neighbor_range, axis):
+    # for every pixel, the sum of the pixels from neighbor_range before it to neighbor_range after it along axis
+    # (only the ones inside the image, just like the blur loop)
+    # we use a running total: total[i] is the sum of the first i pixels, so the sum of pixels lo to hi-1 is
+    # total[hi] - total[lo], no matter how big the window is
+    n = array.shape[axis]
+    total = np.cumsum(array, axis=axis, dtype=np.float64)  # float64 so the running total doesn't lose precision
+    total = np.concatenate((np.zeros_like(total.take([0], axis=axis)), total), axis=axis)
+    positions = np.arange(n)
+    hi = np.minimum(positions + neighbor_range + 1, n)
+    lo = np.maximum(positions - neighbor_range, 0)
+    return total.take(hi, axis=axis) - total.take(lo, axis=axis)
+
+@cached
 def blur(image, kernel_size):
     # kernel size is the number of pixels to take into account when applying the blur
     # (ie kernel_size = 3 would be neighbors to the left/right, top/bottom, and diagonals)
     # kernel size should always be an *odd* number
     x_pixels, y_pixels, num_channels = image.array.shape  # represents x, y pixels of image, # channels (R, G, B)
-    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels)  # making a new array to copy values to!
+    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=image.array.dtype)  # making a new array to copy values to!
     neighbor_range = kernel_size // 2  # this is a variable that tells us how many neighbors we actually look at (ie for a kernel of 3, this value should be 1)
-    for x in range(x_pixels):
-        for y in range(y_pixels):
-            for c in range(num_channels):
-                # we are going to use a naive implementation of iterating through each neighbor and summing
-                # there are faster implementations where you can use memoization, but this is the most straightforward for a beginner to understand
-                total = 0
-                for x_i in range(max(0,x-neighbor_range), min(new_im.x_pixels-1, x+neighbor_range)+1):
-                    for y_i in range(max(0,y-neighbor_range), min(new_im.y_pixels-1, y+neighbor_range)+1):
-                        total += image.array[x_i, y_i, c]
-                new_im.array[x, y, c] = total / (kernel_size ** 2)
+
+    # # this is the naive implementation, iterating through each neighbor and summing
+    # # it's the most straightforward for a beginner to understand, but it does kernel_size**2 additions per pixel
+    # for x in range(x_pixels):
+    #     for y in range(y_pixels):
+    #         for c in range(num_channels):
+    #             total = 0
+    #             for x_i in range(max(0,x-neighbor_range), min(new_im.x_pixels-1, x+neighbor_range)+1):
+    #                 for y_i in range(max(0,y-neighbor_range), min(new_im.y_pixels-1, y+neighbor_range)+1):
+    #                     total += image.array[x_i, y_i, c]
+    #             new_im.array[x, y, c] = total / (kernel_size ** 2)
+
+    # faster version: the sum over a square is the sum (along y) of the sums along x, and box_sums
+    # gets each of those with a running total, so the blur takes the same time for any kernel size
+    # (near the edges we still divide by kernel_size ** 2, like the naive version)
+    totals = box_sums(box_sums(image.array, neighbor_range, axis=0), neighbor_range, axis=1)
+    totals /= kernel_size ** 2
+    new_im.array = to_dtype(totals, image.array.dtype)
+    return new_im
+
+@lru_cache(maxsize=None)
+def young_van_vliet(sigma):
+    # the recursive gaussian filter from Young & van Vliet, "Recursive implementation of the Gaussian filter" (1995)
+    # going along a row, each output is B times the input plus a1, a2 and a3 times the last three outputs; doing that
+    # forwards and then backwards is very nearly a gaussian blur (within a few % of its peak), with 7 multiply-adds per
+    # pixel however wide it is
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * (1 - 0.26891 * sigma) ** 0.5
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q**2 + 0.422205 * q**3
+    a1 = (2.44413 * q + 2.85619 * q**2 + 1.26661 * q**3) / b0
+    a2 = -(1.4281 * q**2 + 1.26661 * q**3) / b0
+    a3 = 0.422205 * q**3 / b0
+    return 1 - (a1 + a2 + a3), a1, a2, a3
+
+@lru_cache(maxsize=None)
+def edge_matrix(sigma):
+    # gaussian_blur repeats the edge pixels forever past the end of each row (instead of treating them as 0 like blur,
+    # which darkens the edges), so the backward pass can't just start from 0: its first three "last outputs" depend
+    # on the forward pass carrying on past the end (Triggs & Sdika, "Boundary conditions for Young-van Vliet
+    # recursive filtering", 2006)
+    # it's all linear, so we work it out once per sigma, as the 3x3 matrix that turns how far the forward pass's last
+    # three outputs are from the edge pixel into how far the backward pass's first three are from it
+    b, a1, a2, a3 = young_van_vliet(sigma)
+    # run the forward pass on past the end (with the input staying at the edge pixel, which is 0 away from it) until
+    # it has died down to nothing
+    decay = max(abs(np.roots([1, -a1, -a2, -a3])))
+    tail = int(np.ceil(np.log(1e-15) / np.log(decay))) + 3
+    matrix = np.zeros((3, 3))
+    for k in range(3):
+        forward = [0.0, 0.0, 0.0]
+        forward[2 - k] = 1.0  # oldest first, so forward[-1] is the last output in the row
+        for i in range(tail):
+            forward.append(a1 * forward[-1] + a2 * forward[-2] + a3 * forward[-3])
+        backward = [0.0, 0.0, 0.0]
+        for value in reversed(forward[3:]):
+            backward.append(b * value + a1 * backward[-1] + a2 * backward[-2] + a3 * backward[-3])
+        # the backward outputs just past the end of the row, nearest first
+        matrix[:, k] = backward[:-4:-1]
+    return matrix
+
+def recursive_gaussian(array, sigma, axis):
+    # blurs a floating point array along one axis with the young_van_vliet filter, going forwards and then backwards
+    # each step works on a whole row (or column) of the image at once, so the python loop is only as long as the image
+    b, a1, a2, a3 = young_van_vliet(sigma)
+    # the filter feeds each output back into the next ones, so rounding errors build up; like box_sums, we work in
+    # float64 so they stay tiny
+    result = np.array(np.moveaxis(array, axis, 0), dtype=np.float64, order='C')  # a copy, with the axis we go along first
+    n = len(result)
+    first, last = result[0].copy(), result[-1].copy()
+    step = np.empty_like(first)
+    # forwards: before the start, the outputs are just the first pixel (the filter doesn't change a flat row)
+    for i in range(n):
+        row = result[i]
+        row *= b
+        for coefficient, back in ((a1, 1), (a2, 2), (a3, 3)):
+            np.multiply(result[i - back] if i >= back else first, coefficient, out=step)
+            row += step
+    # backwards: start from what the forward pass would have done past the end (see edge_matrix)
+    ends = [result[n - 1 - k] if n - 1 - k >= 0 else first for k in range(3)]
+    after = [last + sum(edge_matrix(sigma)[j, k] * (ends[k] - last) for k in range(3)) for j in range(3)]
+    for i in range(n - 1, -1, -1):
+        row = result[i]
+        row *= b
+        for coefficient, ahead in ((a1, 1), (a2, 2), (a3, 3)):
+            np.multiply(result[i + ahead] if i + ahead < n else after[i + ahead - n], coefficient, out=step)
+            row += step
+    return np.moveaxis(result, 0, axis)
+
+def gaussian_kernel(sigma):
+    # a gaussian sampled at every pixel out to 4 sigma on each side (past that it's less than 0.04% of the peak),
+    # adding up to 1
+    radius = int(np.ceil(4 * sigma))
+    weights = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * sigma ** 2))
+    return weights / weights.sum()
+
+# below this sigma, the recursive filter is a poor match for a gaussian (it's off by several % of the peak), and the
+# explicit kernel is still short (at most 25 pixels), so we use that instead
+recursive_sigma = 3
+
+def gaussian(array, sigma):
+    # the math behind gaussian_blur, on a (floating point) array, with the edge pixels repeated
+    if sigma < 0.5:
+        raise ValueError('sigma should be at least 0.5, not %r' % sigma)
+    if sigma < recursive_sigma:
+        weights = gaussian_kernel(sigma)
+        r = len(weights) // 2
+        padded = np.pad(array, ((r, r), (r, r), (0, 0)), mode='edge')
+        return correlate_separable(padded, weights, weights)[r:-r, r:-r]
+    return recursive_gaussian(recursive_gaussian(array, sigma, axis=0), sigma, axis=1)
+
+@cached
+def gaussian_blur(image, sigma):
+    # blurs with a gaussian of standard deviation sigma pixels, the way a camera lens does when out of focus
+    # apply_kernel could do this too, but it needs a kernel about 8 sigma wide, so a big blur gets slow; here (unless
+    # sigma is small) the blur is done recursively (see young_van_vliet) down the image and then across it, which
+    # takes the same time for any sigma
+    # the edges are extended by repeating the edge pixels, so they don't get darker
+    x_pixels, y_pixels, num_channels = image.array.shape  # represents x, y pixels of image, # channels (R, G, B)
+    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=image.array.dtype)
+    array = image.array.astype(compute_dtype(image.array.dtype), copy=False)
+    new_im.array = to_dtype(gaussian(array, sigma), image.array.dtype)
     return new_im
 
-def apply_kernel(image, kernel):
+def gaussian_pyramid(image, levels, sigma=1.0):
+    # returns a list of levels images: image itself, then half its size, a quarter, and so on
+    # each level is the one before it blurred with a gaussian (so details too small for the smaller image are smoothed
+    # away instead of turning into jaggies) and then shrunk by keeping every other pixel
+    # each blur works on the level before, which is a quarter of the size of the one before that, so all the levels
+    # together take about 4/3 the time of one full size blur
+    dtype = image.array.dtype
+    pyramid = [image]
+    array = image.array.astype(compute_dtype(dtype), copy=False)
+    for level in range(1, levels):
+        if min(array.shape[0], array.shape[1]) < 2:
+            break
+        array = gaussian(array, sigma)[::2, ::2]
+        new_im = Image(x_pixels=array.shape[0], y_pixels=array.shape[1], num_channels=array.shape[2], dtype=dtype)
+        new_im.array = to_dtype(array, dtype)
+        pyramid.append(new_im)
+    return pyramid
+
+def correlate_direct(array, kernel):
+    # the straightforward way: for each spot in the kernel, shift the (zero padded) image by that much and add
+    # it to the result, times the kernel value
+    # the shifted images are just views of the padded one, so this is kernel.size whole-array multiply-adds
+    x_pixels, y_pixels = array.shape[0], array.shape[1]
+    x_range, y_range = kernel.shape[0] // 2, kernel.shape[1] // 2
+    padded = np.pad(array, ((x_range, x_range), (y_range, y_range), (0, 0)))
+    result = np.zeros_like(array)
+    for x_k in range(kernel.shape[0]):
+        for y_k in range(kernel.shape[1]):
+            result += float(kernel[x_k, y_k]) * padded[x_k:x_k + x_pixels, y_k:y_k + y_pixels]
+    return result
+
+def separate_kernel(kernel):
+    # if the kernel is a column times a row (like sobel: [1 2 1] times [1 0 -1]), return (column, row), otherwise None
+    # the singular value decomposition tells us: that's exactly when only the first singular value isn't 0
+    u, s, vt = np.linalg.svd(np.asarray(kernel, dtype=np.float64))
+    if s[0] == 0 or (len(s) > 1 and s[1] > 1e-10 * s[0]):
+        return None
+    scale = s[0] ** 0.5
+    return u[:, 0] * scale, vt[0] * scale
+
+def correlate_separable(array, column, row):
+    # applying a column times a row kernel is the same as applying the column down the image, then the row across it,
+    # which is len(column) + len(row) multiply-adds per pixel instead of len(column) * len(row)
+    return correlate_direct(correlate_direct(array, column[:, None]), row[None, :])
+
+def fft_size(n):
+    # the smallest number >= n made of only 2s, 3s and 5s (FFTs of those sizes are the fastest)
+    best = 2 * n
+    power_of_5 = 1
+    while power_of_5 < best:
+        size = power_of_5
+        while size < best:
+            candidate = size
+            while candidate < n:
+                candidate *= 2
+            best = min(best, candidate)
+            size *= 3
+        power_of_5 *= 5
+    return best
+
+def correlate_fft(array, kernel):
+    # a multiplication in the frequency domain is a convolution of the images, whatever the kernel size
+    # we pad both to the full result size so that nothing wraps around, which gives the same zero border as the other ways
+    x_pixels, y_pixels = array.shape[0], array.shape[1]
+    x_range, y_range = kernel.shape[0] // 2, kernel.shape[1] // 2
+    shape = (fft_size(x_pixels + kernel.shape[0] - 1), fft_size(y_pixels + kernel.shape[1] - 1))
+    # apply_kernel doesn't flip the kernel (convolution does), so we flip it here to cancel that out
+    flipped = np.asarray(kernel, dtype=np.float64)[::-1, ::-1]
+    spectrum = np.fft.rfft2(array, shape, axes=(0, 1)) * np.fft.rfft2(flipped, shape)[:, :, None]
+    result = np.fft.irfft2(spectrum, shape, axes=(0, 1))
+    return result[x_range:x_range + x_pixels, y_range:y_range + y_pixels].astype(array.dtype)
+
+# about how many whole-image multiply-adds one FFT correlation costs, used to pick the fastest way
+fft_cost = 25
+
+@cached
+def apply_kernel(image, kernel, method=None, dtype=None):
     # the kernel should be a 2D array that represents the kernel we'll use!
     # for the sake of simiplicity of this implementation, let's assume that the kernel is SQUARE
     # for example the sobel x kernel (detecting horizontal edges) is as follows:
     # [1 0 -1]
     # [2 0 -2]
     # [1 0 -1]
+    # method is 'direct', 'separable' or 'fft'; by default we pick whichever should be fastest for this kernel
+    # they all give the same results (up to rounding), treating pixels outside the image as 0
+    # dtype is the dtype of the result (by default the image's); integer results are rounded and clipped to 0..max_value,
+    # which drops the negative values a kernel like sobel gives, so for those pass a floating point dtype
     x_pixels, y_pixels, num_channels = image.array.shape  # represents x, y pixels of image, # channels (R, G, B)
-    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels)  # making a new array to copy values to!
-    neighbor_range = kernel.shape[0] // 2  # this is a variable that tells us how many neighbors we actually look at (ie for a 3x3 kernel, this value should be 1)
-    for x in range(x_pixels):
-        for y in range(y_pixels):
-            for c in range(num_channels):
-                total = 0
-                for x_i in range(max(0,x-neighbor_range), min(new_im.x_pixels-1, x+neighbor_range)+1):
-                    for y_i in range(max(0,y-neighbor_range), min(new_im.y_pixels-1, y+neighbor_range)+1):
-                        x_k = x_i + neighbor_range - x
-                        y_k = y_i + neighbor_range - y
-                        kernel_val = kernel[x_k, y_k]
-                        total += image.array[x_i, y_i, c] * kernel_val
-                new_im.array[x, y, c] = total
+    dtype = np.dtype(image.array.dtype if dtype is None else dtype)
+    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=dtype)  # making a new array to copy values to!
+
+    # # this is the non vectorized version
+    # neighbor_range = kernel.shape[0] // 2  # this is a variable that tells us how many neighbors we actually look at (ie for a 3x3 kernel, this value should be 1)
+    # for x in range(x_pixels):
+    #     for y in range(y_pixels):
+    #         for c in range(num_channels):
+    #             total = 0
+    #             for x_i in range(max(0,x-neighbor_range), min(new_im.x_pixels-1, x+neighbor_range)+1):
+    #                 for y_i in range(max(0,y-neighbor_range), min(new_im.y_pixels-1, y+neighbor_range)+1):
+    #                     x_k = x_i + neighbor_range - x
+    #                     y_k = y_i + neighbor_range - y
+    #                     kernel_val = kernel[x_k, y_k]
+    #                     total += image.array[x_i, y_i, c] * kernel_val
+    #             new_im.array[x, y, c] = total
+
+    # we add up floating point copies of the pixels (integer sums would overflow), and convert back at the end
+    array = image.array.astype(compute_dtype(image.array.dtype), copy=False)
+    result = correlate(array, kernel, method)
+    # the result is in the image's units, so we rescale it if the new dtype's max_value is different
+    scale = max_value(dtype) / max_value(image.array.dtype)
+    if scale != 1:
+        result *= scale
+    new_im.array = to_dtype(result, dtype)
     return new_im
 
-def combine_images(image1, image2):
+def correlate(array, kernel, method=None):
+    # the math behind apply_kernel, on a (floating point) array: picks a method if it isn't given and runs it
+    factors = separate_kernel(kernel) if method in (None, 'separable') else None
+    if method is None:
+        # the cost of each way, in whole-image multiply-adds
+        costs = {'direct': kernel.size, 'fft': fft_cost}
+        if factors is not None:
+            # plus about 4 for padding and going over the image twice
+            costs['separable'] = kernel.shape[0] + kernel.shape[1] + 4
+        method = min(costs, key=costs.get)
+    if method == 'direct':
+        return correlate_direct(array, kernel)
+    elif method == 'separable':
+        if factors is None:
+            raise ValueError('kernel is not separable (it is not a column times a row)')
+        return correlate_separable(array, *factors)
+    elif method == 'fft':
+        return correlate_fft(array, kernel)
+    raise ValueError('unknown method %r' % method)
+
+@cached
+def combine_images(image1, image2, out=None):
     # let's combine two images using the squared sum of squares: value = sqrt(value_1**2, value_2**2)
     # size of image1 and image2 MUST be the same
+    # out is an optional Image (the same size and dtype as image1) to write the result into, instead of making a new one
     x_pixels, y_pixels, num_channels = image1.array.shape  # represents x, y pixels of image, # channels (R, G, B)
-    new_im = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels)  # making a new array to copy values to!
-    for x in range(x_pixels):
-        for y in range(y_pixels):
-            for c in range(num_channels):
-                new_im.array[x, y, c] = (image1.array[x, y, c]**2 + image2.array[x, y, c]**2)**0.5
-    return new_im
-    
+    dtype = image1.array.dtype
+    if out is None:
+        out = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=dtype)  # making a new array to copy values to!
+
+    # # this is the non vectorized version
+    # for x in range(x_pixels):
+    #     for y in range(y_pixels):
+    #         for c in range(num_channels):
+    #             new_im.array[x, y, c] = (image1.array[x, y, c]**2 + image2.array[x, y, c]**2)**0.5
+
+    # faster version that leverages numpy
+    # (we use * and sqrt instead of ** because they always round exactly the same way, on single numbers and on arrays,
+    # while ** on single numbers goes through C's pow, which can be off in the last digit)
+    if dtype.kind == 'f':
+        squares = image2.array * image2.array
+        np.multiply(image1.array, image1.array, out=out.array)
+        out.array += squares
+        np.sqrt(out.array, out=out.array)
+    else:
+        # squaring integer pixels would overflow, so we square floating point copies of them
+        array1 = image1.array.astype(compute_dtype(dtype))
+        array2 = image2.array.astype(compute_dtype(dtype))
+        array1 *= array1
+        array2 *= array2
+        array1 += array2
+        out.array[...] = to_dtype(np.sqrt(array1, out=array1), dtype)
+    out.pixels_changed()  # so that out's levels and statistics are worked out again
+    return out
+
+def combine_images_in_place(image1, image2):
+    # same as combine_images, but puts the result in image1 instead of making a new image
+    return combine_images(image1, image2, out=image1)
+
+def sobel_rows(padded, start, stop, gradient_x, gradient_y, smooth, difference):
+    # the sobel_x and sobel_y edges (as in the demo below) for rows start to stop, from the zero padded image
+    # both kernels are a column times a row, and they share the same shifted views of the rows:
+    # sobel_x is [1 2 1] across, then [1 0 -1] down; sobel_y is [1 0 -1] across, then [1 2 1] down
+    rows = padded[start:stop + 2]
+    left, middle, right = rows[:, :-2], rows[:, 1:-1], rows[:, 2:]
+    np.add(left, right, out=smooth)
+    smooth += middle
+    smooth += middle
+    np.subtract(left, right, out=difference)
+    np.subtract(smooth[:-2], smooth[2:], out=gradient_x)
+    np.add(difference[:-2], difference[2:], out=gradient_y)
+    gradient_y += difference[1:-1]
+    gradient_y += difference[1:-1]
+
+def sobel(image, dtype=None, orientation=False):
+    # the sobel edge detector in one pass: the same as combine_images(apply_kernel(image, sobel_x), apply_kernel(image, sobel_y)),
+    # without making the two edge images in between (and, for integer images, without rounding and clipping them)
+    # dtype is the dtype of the result (by default the image's), so that eg np.uint8 edges can go straight to png.Writer
+    # with orientation, also returns the direction of the edges, arctan2(sobel_y, sobel_x) in radians (as a float image)
+    x_pixels, y_pixels, num_channels = image.array.shape
+    dtype = np.dtype(image.array.dtype if dtype is None else dtype)
+    work_dtype = compute_dtype(image.array.dtype)
+    # the edges are in the image's units, so we rescale them if the result's max_value is different
+    scale = max_value(dtype) / max_value(image.array.dtype)
+    # pad once (with zeros, like apply_kernel) and convert to floating point at the same time
+    padded = np.zeros((x_pixels + 2, y_pixels + 2, num_channels), dtype=work_dtype)
+    padded[1:-1, 1:-1] = image.array
+    magnitude = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=dtype)
+    if orientation:
+        angle = Image(x_pixels=x_pixels, y_pixels=y_pixels, num_channels=num_channels, dtype=work_dtype)
+    # we go a block of rows at a time (about 1 MB), so that the buffers in between stay in the CPU cache
+    block_rows = max(1, 2**17 // (y_pixels * num_channels))
+    gradient_x = np.empty((block_rows, y_pixels, num_channels), dtype=work_dtype)
+    gradient_y = np.empty_like(gradient_x)
+    smooth = np.empty((block_rows + 2, y_pixels, num_channels), dtype=work_dtype)
+    difference = np.empty_like(smooth)
+    for start in range(0, x_pixels, block_rows):
+        stop = min(start + block_rows, x_pixels)
+        rows = stop - start
+        gx, gy = gradient_x[:rows], gradient_y[:rows]
+        sobel_rows(padded, start, stop, gx, gy, smooth[:rows + 2], difference[:rows + 2])
+        if orientation:
+            np.arctan2(gy, gx, out=angle.array[start:stop])
+        # sqrt(gx**2 + gy**2), in place
+        gx *= gx
+        gy *= gy
+        gx += gy
+        np.sqrt(gx, out=gx)
+        if scale != 1:
+            gx *= scale
+        magnitude.array[start:stop] = to_dtype(gx, dtype)
+    if orientation:
+        return magnitude, angle
+    return magnitude
+
+@cached
+def sobel_magnitude(image, dtype=None):
+    # just the edges from sobel (which is what the cache can keep)
+    return sobel(image, dtype)
+
 if __name__ == '__main__':
     lake = Image(filename='lake.png')
     city = Image(filename='city.png')
@@ -122,7 +520,13 @@ if __name__ == '__main__':
     blur_15 = blur(city, 15)
     blur_15.write_image('blur_k15.png')
 
+    # a much wider, smoother blur (this takes no longer than a small one)
+    gaussian_20 = gaussian_blur(city, 20)
+    gaussian_20.write_image('gaussian_s20.png')
+
     # let's apply a sobel edge detection kernel on the x and y axis
+    # (the edges can be negative, which only floating point images like these can hold; for uint8 or uint16 images,
+    # pass dtype=np.float32 to apply_kernel, or use sobel_magnitude below)
     sobel_x = apply_kernel(city, np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]]))
     sobel_x.write_image('edge_x.png')
     sobel_y = apply_kernel(city, np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]]))
@@ -132,3 +536,7 @@ if __name__ == '__main__':
     sobel_xy = combine_images(sobel_x, sobel_y)
     sobel_xy.write_image('edge_xy.png')
 
+    # or do all three steps at once, which is much faster
+    edges = sobel_magnitude(city)
+    edges.write_image('edge_magnitude.png')
+